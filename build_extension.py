@@ -164,16 +164,17 @@ else:
 
 link_args = ['-fopenmp']
 
-extensions = []
-# extensions = [
-#     Extension("mmt_multipole_inversion.susceptibility_modules...",
-#               ["",
-#                ""],
-#               extra_compile_args=com_args,
-#               extra_link_args=link_args,
-#               include_dirs=[numpy.get_include()]
-#     )
-# ]
+# The OpenMP (CPU) library is optional: if the compiler does not support
+# OpenMP the build continues without it
+extensions = [
+    Extension("mmt_multipole_inversion.susceptibility_modules.openmp.cpulib",
+              ["mmt_multipole_inversion/susceptibility_modules/openmp/cpulib.pyx"],
+              extra_compile_args=com_args,
+              extra_link_args=link_args,
+              include_dirs=[numpy.get_include()],
+              optional=True
+    )
+]
 
 if CUDA:
     # Add cuda options to the com_args dict and the extra library
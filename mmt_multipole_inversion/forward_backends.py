@@ -0,0 +1,830 @@
+# Registry of the libraries (backends) that populate the forward matrix Q of a
+# MultipoleInversion instance. Every backend declares the susceptibility bases,
+# sensor geometries, multipole orders and floating point types that it
+# supports, together with a relative speed. The MultipoleInversion class uses
+# this registry to dispatch the calculation of Q to the fastest backend that
+# is available for a given problem, falling back to slower backends if the
+# calculation fails.
+#
+# New backends can be added with `register_backend`. A backend function has
+# the signature `populate(inv, **kwargs)` where `inv` is the
+# MultipoleInversion instance with an allocated (zero) `inv.Q` matrix, of one
+# of the dtypes declared by the backend. The keyword arguments include
+# `r_sources`, `r_sensors`, `sensor_dims` and `layout`, the arrangement of
+# the Q columns (see `inv.Q_layout`), which is always one of the layouts
+# declared by the backend. The positions of the sources and sensors, and the
+# sensor half lengths, must be taken from these arguments rather than from
+# `inv`, since they might be expressed in other length units (e.g. for single
+# precision matrices). Backends that only declare the default `float64` type
+# and `interleaved` layout can ignore them. The sensors are either a `SensorGrid` describing a
+# regular scan grid, or an `N_sensors x 3` array for arbitrary positions;
+# backends that only accept arrays can use `sensor_positions`. Area and
+# volume sensors must be populated with the flux integrated in the sensor,
+# the average flux is computed afterwards by the MultipoleInversion class.
+import numpy as np
+import numba
+import scipy.signal as ssig
+from collections.abc import Callable
+from typing import Union
+
+from . import susceptibility_modules as sus_mods
+from . import sensor_quadrature
+
+# CUDA modules for populating the suscept matrix (if available)
+try:
+    from .susceptibility_modules.cuda import cudalib as sus_cudalib
+    HASCUDA = True
+except ImportError:
+    HASCUDA = False
+
+# OpenMP (CPU) modules for populating the suscept matrix (if available)
+try:
+    from .susceptibility_modules.openmp import cpulib as sus_cpulib
+    HASOPENMP = True
+except ImportError:
+    HASOPENMP = False
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+
+POINT_BASES = ('spherical_harmonics_basis',
+               'maxwell_cartesian_polynomials',
+               'cartesian_spherical_harmonics')
+AREA_BASES = ('spherical_harmonics_basis_area',)
+VOLUME_BASES = ('spherical_harmonics_basis_volume',)
+
+# Sensor geometry from the number of sensor dimensions
+SENSOR_GEOMETRIES = {0: 'point', 2: 'area', 3: 'volume'}
+
+MP_ORDER = {'dipole': 1, 'quadrupole': 2, 'octupole': 3}
+
+# Highest multipole order of the recurrence kernels of the point sensors in
+# the spherical harmonics basis (see `multipole_Bz_sus`)
+MAX_ORDER = 12
+
+# Multipole orders of the numba kernels: the closed-form kernels of the
+# Cartesian bases and of the area and volume sensors reach the octupole, and
+# the recurrence kernels of the spherical harmonics basis reach MAX_ORDER
+NUMBA_ORDERS = {'point': (1, 2, 3), 'area': (1, 2, 3), 'volume': (1, 2, 3),
+                'spherical_harmonics_basis': range(1, MAX_ORDER + 1)}
+
+
+def multipole_order(expansion_limit: Union[str, int]) -> int:
+    """Multipole order of an expansion limit, given by name or as an integer"""
+    if isinstance(expansion_limit, str):
+        if expansion_limit not in MP_ORDER:
+            raise ValueError(f'Expansion limit {expansion_limit} not valid')
+        return MP_ORDER[expansion_limit]
+    if int(expansion_limit) != expansion_limit or expansion_limit < 1:
+        raise ValueError(f'Expansion limit {expansion_limit} not valid')
+    return int(expansion_limit)
+
+
+def n_multipoles(order: int) -> int:
+    """Number of multipole moments (Q columns per particle) up to `order`"""
+    return (order + 1) ** 2 - 1
+
+
+def order_columns(order: int) -> slice:
+    """Columns of the moments of a multipole order within those of a particle"""
+    return slice(order ** 2 - 1, (order + 1) ** 2 - 1)
+
+
+def sensor_geometry(sus_functions_module: str) -> str:
+    """Sensor geometry required by a susceptibility module"""
+    if sus_functions_module in AREA_BASES:
+        return 'area'
+    elif sus_functions_module in VOLUME_BASES:
+        return 'volume'
+    return 'point'
+
+
+def kernel_columns(sus_functions_module: str, order: int,
+                   r_sources: np.ndarray, r_sensors: np.ndarray,
+                   sensor_dims: tuple = (), average: bool = True) -> np.ndarray:
+    """Columns of the forward matrix of the sources at the sensor positions
+
+    Computes the (interleaved) `len(r_sensors) x len(r_sources) * n_cols`
+    forward matrix, with `n_cols` the number of multipole moments up to
+    `order`, using the numba susceptibility functions of the
+    `sus_functions_module`. Area and volume sensors (specified by the half
+    lengths in `sensor_dims`) are populated with the average flux in the
+    sensor if `average` is `True`, otherwise with the integrated flux
+    """
+    Q = np.zeros((len(r_sensors), len(r_sources) * n_multipoles(order)))
+    _populate_numba_block(getattr(sus_mods, sus_functions_module), order,
+                          r_sources, r_sensors, Q, sensor_dims, 'interleaved')
+    if average and len(sensor_dims) > 0:
+        Q /= np.prod(2 * np.array(sensor_dims))
+    return Q
+
+
+def kernel_gradient_columns(sus_functions_module: str, order: int,
+                            r_sources: np.ndarray, r_sensors: np.ndarray) -> np.ndarray:
+    """Derivatives of `kernel_columns` with respect to the sensor positions
+
+    Returns a `3 x len(r_sensors) x len(r_sources) * n_cols` array with the
+    derivatives of the (interleaved) forward matrix with respect to the
+    `x`, `y` and `z` coordinates of the sensors. The derivatives with
+    respect to the source positions have the opposite sign. Only
+    implemented for point sensors in the susceptibility modules with a
+    `multipole_Bz_sus_gradient` function
+    """
+    sus_mod = getattr(sus_mods, sus_functions_module)
+    if not hasattr(sus_mod, 'multipole_Bz_sus_gradient'):
+        raise ValueError(f'Kernel derivatives not implemented for {sus_functions_module}')
+    n_cols = n_multipoles(order)
+    dQ = np.zeros((3, len(r_sensors), len(r_sources) * n_cols))
+    sus_mod.multipole_Bz_sus_gradient(np.ascontiguousarray(r_sources, dtype=np.float64),
+                                      np.ascontiguousarray(r_sensors, dtype=np.float64),
+                                      dQ, n_cols, order)
+    return dQ
+
+
+# Pairs of coordinates of the second derivatives (see `kernel_hessian_columns`)
+HESSIAN_PAIRS = ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2))
+
+
+def kernel_hessian_columns(sus_functions_module: str, order: int,
+                           r_sources: np.ndarray, r_sensors: np.ndarray) -> np.ndarray:
+    """Second derivatives of `kernel_columns` with respect to the sensor positions
+
+    Returns a `6 x len(r_sensors) x len(r_sources) * n_cols` array with the
+    second derivatives of the (interleaved) forward matrix with respect to
+    the pairs of sensor coordinates in `HESSIAN_PAIRS`. The second
+    derivatives with respect to the source positions are the same. Only
+    implemented for point sensors in the susceptibility modules with a
+    `multipole_Bz_sus_hessian` function
+    """
+    sus_mod = getattr(sus_mods, sus_functions_module)
+    if not hasattr(sus_mod, 'multipole_Bz_sus_hessian'):
+        raise ValueError(f'Kernel derivatives not implemented for {sus_functions_module}')
+    n_cols = n_multipoles(order)
+    d2Q = np.zeros((6, len(r_sensors), len(r_sources) * n_cols))
+    sus_mod.multipole_Bz_sus_hessian(np.ascontiguousarray(r_sources, dtype=np.float64),
+                                     np.ascontiguousarray(r_sensors, dtype=np.float64),
+                                     d2Q, n_cols, order)
+    return d2Q
+
+
+def kernel_position_jacobian(sus_functions_module: str, order: int,
+                             r_sources: np.ndarray, r_sensors: np.ndarray,
+                             moments: np.ndarray, num_threads: int = 0) -> tuple:
+    """Field of the sources and its derivatives with respect to their positions
+
+    Returns the Bz array at the sensors, of length `len(r_sensors)`, for the
+    `len(r_sources) x n_cols` array of `moments` (in the column order of
+    `kernel_columns`), and the `len(r_sensors) x len(r_sources) x 3` array
+    with the derivatives of Bz with respect to the `x`, `y` and `z`
+    coordinates of every source. Only point sensors in the susceptibility
+    modules with a `multipole_Bz_position_jacobian` function are supported.
+    The sensors are distributed across `num_threads` numba threads (all the
+    threads by default)
+    """
+    sus_mod = getattr(sus_mods, sus_functions_module)
+    if not hasattr(sus_mod, 'multipole_Bz_position_jacobian'):
+        raise ValueError(f'Kernel derivatives not implemented for {sus_functions_module}')
+    Bz = np.zeros(len(r_sensors))
+    J = np.zeros((len(r_sensors), len(r_sources), 3))
+    default_threads = numba.get_num_threads()
+    if num_threads > 0:
+        numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+    try:
+        sus_mod.multipole_Bz_position_jacobian(np.ascontiguousarray(r_sources, dtype=np.float64),
+                                               np.ascontiguousarray(r_sensors, dtype=np.float64),
+                                               np.ascontiguousarray(moments, dtype=np.float64),
+                                               order, Bz, J)
+    finally:
+        numba.set_num_threads(default_threads)
+    return Bz, J
+
+
+class SensorGrid(object):
+    """Regular grid of sensors in a plane of constant height
+
+    The sensor coordinates are generated on demand from the grid parameters,
+    hence the `N_sensors x 3` array of positions does not need to be stored.
+    Sensors are ordered row by row, i.e. the sensor in the row `j` (along
+    `y`) and column `i` (along `x`) has the index `j * Nx + i`.
+
+    Parameters
+    ----------
+    origin
+        `(x, y)` coordinates of the lower left sensor
+    step
+        Grid spacing in the `x` and `y` directions
+    counts
+        Number of sensors `(Nx, Ny)` in the `x` and `y` directions
+    height
+        `z` coordinate of the sensors
+    """
+
+    def __init__(self, origin: tuple, step: tuple, counts: tuple,
+                 height: float) -> None:
+        self.origin = tuple(float(o) for o in origin)
+        self.step = tuple(float(s) for s in step)
+        self.counts = tuple(int(n) for n in counts)
+        self.height = float(height)
+
+    @property
+    def x_range(self) -> np.ndarray:
+        return self.origin[0] + np.arange(self.counts[0]) * self.step[0]
+
+    @property
+    def y_range(self) -> np.ndarray:
+        return self.origin[1] + np.arange(self.counts[1]) * self.step[1]
+
+    @property
+    def N_sensors(self) -> int:
+        return self.counts[0] * self.counts[1]
+
+    def scaled(self, length_scale: float) -> 'SensorGrid':
+        """Grid with all lengths multiplied by `length_scale`"""
+        return SensorGrid([o * length_scale for o in self.origin],
+                          [s * length_scale for s in self.step],
+                          self.counts, self.height * length_scale)
+
+    def row_positions(self, j: int) -> np.ndarray:
+        """`Nx x 3` array with the positions of the sensors in the row `j`"""
+        positions = np.empty((self.counts[0], 3))
+        positions[:, 0] = self.x_range
+        positions[:, 1] = self.y_range[j]
+        positions[:, 2] = self.height
+        return positions
+
+    def positions(self) -> np.ndarray:
+        """`N_sensors x 3` array with the positions of all the sensors"""
+        positions = np.empty((self.N_sensors, 3))
+        X_pos, Y_pos = np.meshgrid(self.x_range, self.y_range)
+        positions[:, 0] = X_pos.reshape(-1)
+        positions[:, 1] = Y_pos.reshape(-1)
+        positions[:, 2] = self.height
+        return positions
+
+    def __repr__(self):
+        return (f'SensorGrid(origin={self.origin}, step={self.step}, '
+                f'counts={self.counts}, height={self.height})')
+
+
+def sensor_positions(r_sensors: Union[SensorGrid, np.ndarray]) -> np.ndarray:
+    """Array with the sensor positions of a grid or an array of positions"""
+    if isinstance(r_sensors, SensorGrid):
+        return r_sensors.positions()
+    return r_sensors
+
+
+class ForwardBackend(object):
+    """Specification of a library to populate the forward matrix
+
+    Parameters
+    ----------
+    name
+        Name of the backend, used as the `optimization` argument of
+        `MultipoleInversion.generate_forward_matrix`
+    populate
+        Function with signature `populate(inv, **kwargs)` that fills `inv.Q`
+        (see module docs for the keyword arguments)
+    bases
+        Names of the supported susceptibility modules
+    sensor_geometries
+        Supported sensor geometries: `point`, `area` and/or `volume`
+    orders
+        Supported multipole orders: 1 (dipole), 2 (quadrupole), ... Can be a
+        dictionary with the orders for every sensor geometry and/or
+        susceptibility module. The orders of a module take precedence over
+        the orders of its sensor geometry
+    dtypes
+        Supported floating point types of the `Q` matrix
+    layouts
+        Column layouts of `Q` that the backend can populate directly:
+        `interleaved` and/or `order_blocked`. Can be a dictionary with the
+        layouts for every sensor geometry. For other layouts the
+        `interleaved` matrix is rearranged
+    speed
+        Relative speed of the backend, used to sort the backends. The `numba`
+        backend has a speed of 1
+    available
+        Function without arguments that returns `True` if the backend can be
+        used, e.g. if a compiled library was found
+    auto
+        If `False`, the backend is only used when it is requested
+        explicitly. Can be a function `auto(inv)` that returns `True` if the
+        automatic dispatch should use the backend for a MultipoleInversion
+        instance `inv`, e.g. if the positions of its particles suit the
+        backend
+    """
+
+    def __init__(self,
+                 name: str,
+                 populate: Callable,
+                 bases: tuple,
+                 sensor_geometries: tuple,
+                 orders: Union[tuple, dict],
+                 dtypes: tuple = ('float64',),
+                 layouts: Union[tuple, dict] = ('interleaved',),
+                 speed: float = 1.,
+                 available: Callable[[], bool] = lambda: True,
+                 auto: Union[bool, Callable] = True
+                 ) -> None:
+        self.name = name
+        self.populate = populate
+        self.bases = tuple(bases)
+        self.sensor_geometries = tuple(sensor_geometries)
+        self.orders = self._per_geometry(orders)
+        self.dtypes = tuple(np.dtype(d).name for d in dtypes)
+        self.layouts = self._per_geometry(layouts)
+        self.speed = speed
+        self.available = available
+        self.auto = auto
+
+    def _per_geometry(self, values):
+        if isinstance(values, dict):
+            return {k: tuple(v) for k, v in values.items()}
+        return {g: tuple(values) for g in self.sensor_geometries}
+
+    def supports(self, basis: str, geometry: str, order: int,
+                 dtype='float64') -> bool:
+        """Check if the backend supports the specified problem"""
+        return (basis in self.bases
+                and geometry in self.sensor_geometries
+                and order in self.orders.get(basis, self.orders.get(geometry, ()))
+                and np.dtype(dtype).name in self.dtypes)
+
+    def use_auto(self, inv) -> bool:
+        """Check if the automatic dispatch can use the backend for `inv`"""
+        if callable(self.auto):
+            return bool(self.auto(inv))
+        return bool(self.auto)
+
+    def __repr__(self):
+        return (f'ForwardBackend(name={self.name!r}, speed={self.speed}, '
+                f'available={self.available()})')
+
+
+BACKENDS = {}
+
+
+def register_backend(backend: ForwardBackend, overwrite: bool = False) -> None:
+    """Add a backend to the registry of forward matrix libraries"""
+    if backend.name in BACKENDS and not overwrite:
+        raise ValueError(f'Backend {backend.name} is already registered')
+    BACKENDS[backend.name] = backend
+
+
+def find_backends(basis: str, geometry: str, order: int,
+                  dtype='float64', inv=None) -> list:
+    """List the available backends supporting a problem, fastest first
+
+    If the MultipoleInversion instance `inv` is specified, only the backends
+    that the automatic dispatch can use for it are listed
+    """
+    backends = [b for b in BACKENDS.values()
+                if b.supports(basis, geometry, order, dtype) and b.available()
+                and (inv is None or b.use_auto(inv))]
+    return sorted(backends, key=lambda b: b.speed, reverse=True)
+
+# -----------------------------------------------------------------------------
+# Backends
+
+
+def _populate_numba_block(sus_mod, order, r_sources, r_sensors, Q, sensor_dims, layout):
+    """Populate the rows of `Q` of the sensors in the `r_sensors` array
+
+    `sus_mod` is the susceptibility module and `order` the multipole order
+    """
+    N = len(r_sources)
+    n_cols = n_multipoles(order)
+
+    # AREA or VOLUME SENSOR
+    if len(sensor_dims) > 0:
+        sus_mod.multipole_Bz_sus(r_sources, r_sensors, Q, n_cols,
+                                 *sensor_dims, order)
+    # Recurrence over the multipole orders (spherical harmonics basis)
+    elif hasattr(sus_mod, 'multipole_Bz_sus'):
+        if layout == 'order_blocked':
+            # Every order populates a contiguous block of Q with its own
+            # stride
+            for l in range(1, order + 1):
+                cols = order_columns(l)
+                sus_mod.multipole_Bz_sus(r_sources, r_sensors,
+                                         Q[:, cols.start * N:cols.stop * N],
+                                         2 * l + 1, l, l)
+        else:
+            sus_mod.multipole_Bz_sus(r_sources, r_sensors, Q, n_cols, order)
+    elif order > 3:
+        raise ValueError(f'Multipole order {order} not implemented in {sus_mod.__name__}')
+    # For all the particles, whose positions are stored in the pos array
+    # (N_particles x 3), compute the dipole (3 terms), quadrupole (5 terms)
+    # or octupole (7 terms) contributions
+    elif layout == 'order_blocked':
+        # The susceptibility functions populate the quadrupole (octupole)
+        # columns starting at the 3rd (8th) column of every stride. Here we
+        # pass views of Q shifted by these offsets, and strides equal to
+        # the number of columns of the multipole order, so that every
+        # function populates a contiguous block of Q
+        sus_mod.dipole_Bz_sus(r_sources, r_sensors, Q[:, :3 * N], 3)
+        if order > 1:
+            sus_mod.quadrupole_Bz_sus(r_sources, r_sensors,
+                                      Q[:, 3 * N - 3:8 * N], 5)
+        if order > 2:
+            sus_mod.octupole_Bz_sus(r_sources, r_sensors,
+                                    Q[:, 8 * N - 8:15 * N], 7)
+    else:
+        sus_mod.dipole_Bz_sus(r_sources, r_sensors, Q, n_cols)
+        if order > 1:
+            sus_mod.quadrupole_Bz_sus(r_sources, r_sensors, Q, n_cols)
+        if order > 2:
+            sus_mod.octupole_Bz_sus(r_sources, r_sensors, Q, n_cols)
+
+
+def _populate_numba(inv, r_sources, r_sensors, sensor_dims,
+                    layout='interleaved', cutoff_pairs=None, **kwargs):
+    """Populate Q using the numba-optimised susceptibility functions
+
+    If `cutoff_pairs` is specified, as a tuple of arrays with the indices of
+    the sensors and of the particles (sorted by particle), only the entries
+    of these pairs are computed
+    """
+    order = multipole_order(inv.expansion_limit)
+    if cutoff_pairs is not None:
+        if layout == 'interleaved':
+            columns = np.arange(inv.Q.shape[1]).reshape(inv.N_particles, -1)
+        else:
+            columns = inv.multipole_column_indices()
+        r_sensors = sensor_positions(r_sensors)
+        sensors, particles = cutoff_pairs
+        bounds = np.searchsorted(particles, np.arange(inv.N_particles + 1))
+        for p in range(inv.N_particles):
+            rows = sensors[bounds[p]:bounds[p + 1]]
+            if len(rows) == 0:
+                continue
+            block = np.zeros((len(rows), inv._N_cols))
+            _populate_numba_block(inv.sus_mod, order, r_sources[p:p + 1], r_sensors[rows],
+                                  block, sensor_dims, 'interleaved')
+            inv.Q[rows[:, np.newaxis], columns[p]] = block
+    elif isinstance(r_sensors, SensorGrid):
+        # Populate Q row by row of the grid, generating only the positions
+        # of the sensors of one row at a time
+        Nx = r_sensors.counts[0]
+        for j in range(r_sensors.counts[1]):
+            _populate_numba_block(inv.sus_mod, order, r_sources, r_sensors.row_positions(j),
+                                  inv.Q[j * Nx:(j + 1) * Nx], sensor_dims, layout)
+    else:
+        _populate_numba_block(inv.sus_mod, order, r_sources, r_sensors, inv.Q,
+                              sensor_dims, layout)
+
+
+def _corner_lattice(centres, half_length):
+    """Unique corner coordinates of sensors along one grid direction
+
+    Returns the sorted unique coordinates of the lower and upper sensor
+    corners `centres -/+ half_length`, and an `N x 2` array with the indices
+    of the corners of every sensor in that array. Corners closer than a
+    small fraction of the sensor size are merged.
+    """
+    corners = np.concatenate((centres - half_length, centres + half_length))
+    order = np.argsort(corners, kind='stable')
+    sorted_corners = corners[order]
+    new_node = np.ones(len(corners), dtype=bool)
+    new_node[1:] = np.diff(sorted_corners) > 1e-6 * half_length
+    indices = np.empty(len(corners), dtype=np.int64)
+    indices[order] = np.cumsum(new_node) - 1
+    return sorted_corners[new_node], indices.reshape(2, -1).T.copy()
+
+
+def _populate_numba_grid(inv, r_sources, r_sensors, sensor_dims, **kwargs):
+    """Populate Q evaluating the flux antiderivative on the corner lattice
+
+    Requires area or volume sensors whose centres form a regular grid
+    """
+    if isinstance(r_sensors, SensorGrid):
+        x_centres, y_centres = r_sensors.x_range, r_sensors.y_range
+        z_sensor = r_sensors.height
+    else:
+        # Check that the explicit positions form a grid
+        grid = r_sensors.reshape(inv.Ny_surf, inv.Nx_surf, 3)
+        x_centres, y_centres, z_sensor = grid[0, :, 0], grid[:, 0, 1], grid[0, 0, 2]
+        tol = 1e-6 * min(sensor_dims)
+        if not (np.allclose(grid[:, :, 0], x_centres[np.newaxis, :], rtol=0, atol=tol)
+                and np.allclose(grid[:, :, 1], y_centres[:, np.newaxis], rtol=0, atol=tol)
+                and np.allclose(grid[:, :, 2], z_sensor, rtol=0, atol=tol)):
+            raise ValueError('Sensor positions are not a regular grid')
+
+    _populate_corner_lattice(inv, r_sources, x_centres, y_centres, z_sensor,
+                             sensor_dims, inv.Q)
+
+
+def _populate_corner_lattice(inv, r_sources, x_centres, y_centres, z_sensor,
+                             sensor_dims, Q):
+    """Populate the interleaved `Q` of area or volume sensors in a grid"""
+    x_corners, ix_corners = _corner_lattice(x_centres, sensor_dims[0])
+    y_corners, iy_corners = _corner_lattice(y_centres, sensor_dims[1])
+    LOGGER.debug(f'Corner lattice with {len(x_corners)} x {len(y_corners)} nodes')
+
+    order = multipole_order(inv.expansion_limit)
+    if len(sensor_dims) == 2:
+        inv.sus_mod.multipole_Bz_sus_grid(r_sources, x_corners, y_corners,
+                                          z_sensor, ix_corners, iy_corners,
+                                          Q, inv._N_cols, order)
+    else:
+        z_corners = z_sensor + np.array([-1., 1.]) * sensor_dims[2]
+        inv.sus_mod.multipole_Bz_sus_grid(r_sources, x_corners, y_corners,
+                                          z_corners, ix_corners, iy_corners,
+                                          Q, inv._N_cols, order)
+
+
+def lattice_groups(r_sources: np.ndarray, grid: SensorGrid,
+                   tol: float = 1e-9) -> list:
+    """Group the sources that share a depth and an offset from the sensor grid
+
+    The `x, y` position of a source is decomposed as
+    `origin + (a + offset) * step`, with `a` an integer and
+    `-0.5 <= offset <= 0.5`, in every direction. Sources with the same depth
+    and offsets (within `tol` times the grid step) see the same field image,
+    shifted by `a` sensors, hence their columns of `Q` can be taken from one
+    image computed on an extended grid.
+
+    Returns
+    -------
+    list
+        List of `(sources, shifts)` tuples with the indices of the sources in
+        a group and an `n x 2` array with their integer shifts `(a_x, a_y)`
+    """
+    t = (r_sources[:, :2] - np.array(grid.origin)) / np.array(grid.step)
+    shifts = np.round(t).astype(np.int64)
+    # Use the grid step to make the depth tolerance dimensionless
+    keys = np.column_stack((t - shifts, r_sources[:, 2] / grid.step[0]))
+    keys = np.round(keys / tol).astype(np.int64)
+
+    _, labels = np.unique(keys, axis=0, return_inverse=True)
+    labels = labels.reshape(-1)
+    groups = []
+    for label in range(labels.max() + 1):
+        sources = np.where(labels == label)[0]
+        groups.append((sources, shifts[sources]))
+    return groups
+
+
+def _lattice_blocks(groups: list, Nx: int, Ny: int) -> list:
+    """Split the `lattice_groups` into the groups computed from one image
+
+    Sparse groups, whose extended image is larger than their columns, are
+    computed source by source
+    """
+    blocks = []
+    for sources, shifts in groups:
+        spread = shifts.max(axis=0) - shifts.min(axis=0)
+        if (Nx + spread[0]) * (Ny + spread[1]) > len(sources) * Nx * Ny:
+            blocks.extend((sources[k:k + 1], shifts[k:k + 1]) for k in range(len(sources)))
+        else:
+            blocks.append((sources, shifts))
+    return blocks
+
+
+def _lattice_saves_evaluations(inv) -> bool:
+    """Check if the field images of the lattice groups of the particles of
+    `inv` need at most half of the field evaluations of the full `Q`
+    """
+    if inv._explicit_scan_positions() is not None:
+        return False
+    Nx, Ny = inv.sensor_grid.counts
+    groups = lattice_groups(np.asarray(inv.particle_positions, dtype=np.float64), inv.sensor_grid)
+    n_image = sum((Nx + np.ptp(shifts[:, 0])) * (Ny + np.ptp(shifts[:, 1]))
+                  for _, shifts in _lattice_blocks(groups, Nx, Ny))
+    return n_image <= 0.5 * inv.N_particles * Nx * Ny
+
+
+def _populate_numba_lattice(inv, r_sources, r_sensors, sensor_dims,
+                            **kwargs):
+    """Populate Q from one field image per group of lattice-aligned sources
+
+    For every group of sources from `lattice_groups`, the field of a source
+    with the offset and depth of the group is computed on the sensor grid
+    extended by the spread of the shifts of the group. The columns of every
+    source are then a window of this image. Requires a `SensorGrid`
+    """
+    if not isinstance(r_sensors, SensorGrid):
+        raise ValueError('The numba_lattice method requires a sensor grid')
+
+    Nx, Ny = r_sensors.counts
+    n_cols = inv._N_cols
+    columns = inv.multipole_column_indices()
+    blocks = _lattice_blocks(lattice_groups(r_sources, r_sensors), Nx, Ny)
+    LOGGER.debug(f'{len(blocks)} field images of lattice-aligned sources')
+
+    for sources, shifts in blocks:
+        a_min, a_max = shifts.min(axis=0), shifts.max(axis=0)
+        Mx, My = (Nx, Ny) + a_max - a_min
+        # Sensor m of the image sees a source with shift 0 at the sensor
+        # m - a_max, so the source with shift a populates the window
+        # starting at a_max - a
+        image_grid = SensorGrid(
+            [o - a * d for o, a, d in zip(r_sensors.origin, a_max, r_sensors.step)],
+            r_sensors.step, (Mx, My), r_sensors.height)
+        source = r_sources[sources[:1]] - np.append(shifts[0] * r_sensors.step, 0.)
+
+        image = np.zeros((My * Mx, n_cols))
+        if len(sensor_dims) == 0:
+            _populate_numba_block(inv.sus_mod, multipole_order(inv.expansion_limit), source,
+                                  image_grid.positions(), image, sensor_dims, 'interleaved')
+        else:
+            _populate_corner_lattice(inv, source, image_grid.x_range,
+                                     image_grid.y_range, image_grid.height,
+                                     sensor_dims, image)
+        image.shape = (My, Mx, n_cols)
+
+        for source_index, (ax, ay) in zip(sources, a_max - shifts):
+            inv.Q[:, columns[source_index]] = image[ay:ay + Ny, ax:ax + Nx].reshape(-1, n_cols)
+
+
+def _populate_cuda(inv, r_sources, r_sensors, sensor_dims, **kwargs):
+    """Populate Q using the CUDA library (point sensors)"""
+    # Verbose only if logger is NOTSET, DEBUG or INFO
+    verb = 1 if LOGGER.getEffectiveLevel() <= 20 else 0
+    r_sensors = sensor_positions(r_sensors)
+    sus_cudalib.SHB_populate_matrix(r_sources, r_sensors, inv.Q,
+                                    inv.N_particles, inv.N_sensors,
+                                    multipole_order(inv.expansion_limit),
+                                    verb)
+
+
+def _populate_openmp(inv, r_sources, r_sensors, sensor_dims,
+                     num_threads: int = 0, **kwargs):
+    """Populate Q using the OpenMP library"""
+    order = multipole_order(inv.expansion_limit)
+    # The compiled functions require C-contiguous arrays of doubles
+    r_sources = np.ascontiguousarray(r_sources, dtype=np.float64)
+    r_sensors = np.ascontiguousarray(sensor_positions(r_sensors), dtype=np.float64)
+
+    if len(sensor_dims) == 0:
+        sus_cpulib.point_populate_matrix(r_sources, r_sensors, inv.Q,
+                                         inv._N_cols, order,
+                                         sus_cpulib.BASIS_IDS[inv.sus_functions_module],
+                                         num_threads)
+    elif len(sensor_dims) == 2:
+        sus_cpulib.area_populate_matrix(r_sources, r_sensors, inv.Q,
+                                        inv._N_cols, *sensor_dims,
+                                        order, num_threads)
+    elif len(sensor_dims) == 3:
+        sus_cpulib.volume_populate_matrix(r_sources, r_sensors, inv.Q,
+                                          inv._N_cols, *sensor_dims,
+                                          order, num_threads)
+
+
+def _populate_table(inv, r_sources, r_sensors, sensor_dims, **kwargs):
+    """Populate Q interpolating the kernel table `inv.kernel_table`
+
+    The table must have been computed (or loaded) for the basis, multipole
+    order and sensor dimensions of `inv`, see `KernelTable`
+    """
+    table = getattr(inv, 'kernel_table', None)
+    if table is None:
+        raise ValueError('The table method requires a kernel table, see '
+                         'generate_kernel_table or load_kernel_table')
+    if (table.sus_functions_module != inv.sus_functions_module
+            or table.order != multipole_order(inv.expansion_limit)
+            or not np.allclose(table.sensor_dims, sensor_dims, rtol=1e-12, atol=0.)):
+        raise ValueError('The kernel table does not match the basis, multipole '
+                         'order or sensor dimensions of the inversion')
+    table.populate(r_sources, sensor_positions(r_sensors), inv.Q,
+                   inv.multipole_column_indices())
+
+
+def _populate_quadrature(inv, r_sources, r_sensors, sensor_dims,
+                         layout='interleaved', quadrature_tol=1e-6, **kwargs):
+    """Populate Q integrating the point-sensor kernels over the sensors
+
+    See `sensor_quadrature`. The number of Gauss-Legendre nodes of every
+    sensor-particle pair is adapted to the relative accuracy `quadrature_tol`
+    """
+    n_evaluations = sensor_quadrature.integrate_point_kernel(
+        r_sources, sensor_positions(r_sensors), sensor_dims,
+        multipole_order(inv.expansion_limit), inv.Q,
+        inv.multipole_column_indices(), tol=quadrature_tol)
+    LOGGER.debug(f'{n_evaluations / (len(r_sources) * inv.N_sensors):.2f} '
+                 f'kernel evaluations per sensor-particle pair')
+
+
+def _populate_psf(inv, r_sources, r_sensors, sensor_dims,
+                  max_chunk_size: int = 2 ** 24, **kwargs):
+    """Populate Q convolving the point-sensor columns with `inv.sensor_psf`
+
+    The `Py x Px` point-spread function is sampled with the steps of the
+    sensor grid and centred at the sensor, i.e. the measured field of a
+    sensor is `sum_(v, u) psf[v, u] Bz(x + (u - Px // 2) dx, y + (v - Py // 2) dy)`.
+    The point-sensor columns of a block of particles are computed on the
+    sensor grid extended by the half width of the PSF, and all the columns
+    of the block are convolved with the PSF with one batched FFT. Requires
+    a `SensorGrid`
+    """
+    if not isinstance(r_sensors, SensorGrid):
+        raise ValueError('The psf method requires a sensor grid')
+    if inv.sensor_psf is None:
+        raise ValueError('The psf method requires a point-spread function, see sensor_psf')
+    psf = inv.sensor_psf
+    Py, Px = psf.shape
+    Nx, Ny = r_sensors.counts
+    Mx, My = Nx + Px - 1, Ny + Py - 1
+    extended = SensorGrid([o - (P // 2) * d for o, P, d in zip(r_sensors.origin, (Px, Py), r_sensors.step)],
+                          r_sensors.step, (Mx, My), r_sensors.height)
+    positions = extended.positions()
+
+    order = multipole_order(inv.expansion_limit)
+    n_cols = inv._N_cols
+    columns = inv.multipole_column_indices()
+    # fftconvolve computes a convolution, the PSF is a correlation
+    kernel = psf[np.newaxis, ::-1, ::-1]
+    n_block = max(1, max_chunk_size // (Mx * My * n_cols))
+    LOGGER.debug(f'Convolving {n_cols * len(r_sources)} columns with a '
+                 f'{Py} x {Px} PSF in blocks of {n_block} particles')
+
+    for start in range(0, len(r_sources), n_block):
+        block = np.arange(start, min(start + n_block, len(r_sources)))
+        image = np.zeros((My * Mx, len(block) * n_cols))
+        _populate_numba_block(inv.sus_mod, order, r_sources[block], positions,
+                              image, sensor_dims, 'interleaved')
+        image = image.T.reshape(-1, My, Mx)
+        image = ssig.fftconvolve(image, kernel, mode='valid', axes=(1, 2))
+        inv.Q[:, columns[block].reshape(-1)] = image.reshape(len(block) * n_cols, -1).T
+
+
+register_backend(ForwardBackend(
+    'numba', _populate_numba,
+    bases=POINT_BASES + AREA_BASES + VOLUME_BASES,
+    sensor_geometries=('point', 'area', 'volume'),
+    orders=NUMBA_ORDERS,
+    dtypes=('float64', 'float32'),
+    layouts={'point': ('interleaved', 'order_blocked'),
+             'area': ('interleaved',), 'volume': ('interleaved',)},
+    speed=1.))
+
+register_backend(ForwardBackend(
+    'numba_grid', _populate_numba_grid,
+    bases=AREA_BASES + VOLUME_BASES,
+    sensor_geometries=('area', 'volume'),
+    orders=(1, 2, 3),
+    dtypes=('float64', 'float32'),
+    speed=2.))
+
+register_backend(ForwardBackend(
+    'numba_lattice', _populate_numba_lattice,
+    bases=POINT_BASES + AREA_BASES + VOLUME_BASES,
+    sensor_geometries=('point', 'area', 'volume'),
+    orders=NUMBA_ORDERS,
+    dtypes=('float64', 'float32'),
+    layouts=('interleaved', 'order_blocked'),
+    speed=3.,
+    auto=_lattice_saves_evaluations))
+
+register_backend(ForwardBackend(
+    'openmp', _populate_openmp,
+    bases=POINT_BASES + AREA_BASES + VOLUME_BASES,
+    sensor_geometries=('point', 'area', 'volume'),
+    orders=(1, 2, 3),
+    speed=4.,
+    available=lambda: HASOPENMP))
+
+# Interpolation of a precomputed kernel table, for the area and volume
+# sensors (the point kernels are cheaper to evaluate than to interpolate).
+# It is excluded from the automatic selection, since its accuracy depends on
+# the table, and only used when requested explicitly
+register_backend(ForwardBackend(
+    'table', _populate_table,
+    bases=AREA_BASES + VOLUME_BASES,
+    sensor_geometries=('area', 'volume'),
+    orders=(1, 2, 3),
+    layouts=('interleaved', 'order_blocked'),
+    speed=0.5,
+    auto=False))
+
+# Gauss-Legendre quadrature of the point kernels in the spherical harmonics
+# basis, for the multipole orders without closed-form antiderivatives
+register_backend(ForwardBackend(
+    'quadrature', _populate_quadrature,
+    bases=AREA_BASES + VOLUME_BASES,
+    sensor_geometries=('area', 'volume'),
+    orders=range(1, MAX_ORDER + 1),
+    dtypes=('float64', 'float32'),
+    layouts=('interleaved', 'order_blocked'),
+    speed=0.8))
+
+# Convolution of the point-sensor columns with the point-spread function of
+# the sensors, used if `inv.sensor_psf` is set
+register_backend(ForwardBackend(
+    'psf', _populate_psf,
+    bases=POINT_BASES,
+    sensor_geometries=('point',),
+    orders=NUMBA_ORDERS,
+    dtypes=('float64', 'float32'),
+    layouts=('interleaved', 'order_blocked'),
+    speed=0.1))
+
+register_backend(ForwardBackend(
+    'cuda', _populate_cuda,
+    bases=('spherical_harmonics_basis',),
+    sensor_geometries=('point',),
+    orders=(1, 2, 3),
+    speed=10.,
+    available=lambda: HASCUDA))
@@ -0,0 +1,583 @@
+# Matrix-free representations of the forward matrix Q of a MultipoleInversion
+# instance. The operators compute the products `Q x` and `Q^T y` without
+# storing Q, and can be used with the iterative solvers of
+# `scipy.sparse.linalg`. Operators act on vectors ordered as the columns of
+# Q (see `MultipoleInversion.multipole_column_indices`), in SI units.
+import numpy as np
+import scipy.fft as sfft
+import scipy.sparse.linalg as spla
+from typing import Optional
+
+from . import forward_backends as fwb
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+
+
+def _kernel_columns(inv, r_sources, r_sensors):
+    """Q columns (in SI units) of the sources at the sensor positions
+
+    Returns a `len(r_sensors) x (len(r_sources) * n_cols)` matrix with the
+    interleaved layout
+    """
+    return fwb.kernel_columns(inv.sus_functions_module, fwb.multipole_order(inv.expansion_limit),
+                              r_sources, r_sensors, inv.sensor_dims)
+
+
+def _lagrange_stencil(u: np.ndarray, order: int):
+    """Lagrange interpolation stencil on the integer nodes
+
+    For every coordinate in `u` (in units of the node spacing), returns the
+    indices of the `order` closest integer nodes and the weights of the
+    Lagrange polynomial interpolation at `u`, both as `len(u) x order`
+    arrays.
+    """
+    start = np.floor(u).astype(np.int64) - (order - 1) // 2
+    nodes = start[:, np.newaxis] + np.arange(order)
+    weights = np.ones(nodes.shape)
+    for j in range(order):
+        for m in range(order):
+            if m != j:
+                weights[:, j] *= (u - nodes[:, m]) / (j - m)
+    return nodes, weights
+
+
+class FFTForwardOperator(spla.LinearOperator):
+    """Forward matrix as convolutions of particle layers with the field kernel
+
+    For sources at a fixed depth, the field at the sensors only depends on
+    the lateral displacement between the source and the sensor. The
+    particles are assigned to depth layers and, in every layer, the
+    multipole moments are spread onto a fine grid aligned with the scan grid
+    using Lagrange interpolation weights (the adjoint of interpolating from
+    the grid to the particle positions). The fine grid is then convolved,
+    using FFTs, with the field image of every multipole component of a
+    source at the depth of the layer. The sensors are nodes of the fine grid,
+    hence the field at the scan positions is sampled directly. A product
+    with this operator costs `O(L M log M)`, with `M` the number of nodes of
+    the fine grid and `L` the number of layers, instead of
+    `O(N_sensors x N_particles)`.
+
+    If the particles have a few distinct depths, every depth is a layer.
+    Otherwise the kernel is interpolated in depth: the layers are the nodes
+    of a uniform grid in `log(dz)`, with `dz` the vertical distance to the
+    sensors, and every particle is spread onto the `depth_order` closest
+    layers with Lagrange weights. The node spacing is halved until the
+    relative error of the interpolated kernel, measured at the midpoint of
+    every interval that contains particles, is below `depth_tol`. Hence the
+    number of layers depends on the range of depths and on `depth_tol`, not
+    on the number of particles.
+
+    The lateral accuracy is controlled by the `upsampling` of the fine grid
+    and the `interp_order` of the spreading stencil; particles located at
+    nodes of the fine grid are represented exactly. The error of a given
+    setup can be estimated with `error_estimate`.
+
+    Parameters
+    ----------
+    inv
+        `MultipoleInversion` instance, whose sensors must be described by
+        the regular `sensor_grid` (no explicit `scan_positions`)
+    upsampling
+        Number of fine grid nodes per scan step in every direction
+    interp_order
+        Number of nodes of the spreading stencil in every direction
+    depth_tol
+        Relative error of the depth interpolation of the kernel, with
+        respect to the largest entry of every multipole order
+    depth_order
+        Number of layers of the depth interpolation stencil
+    """
+
+    def __init__(self, inv,
+                 upsampling: int = 2,
+                 interp_order: int = 4,
+                 depth_tol: float = 1e-5,
+                 depth_order: int = 4):
+        if inv._explicit_scan_positions() is not None:
+            raise ValueError('The FFT forward operator requires sensors in a regular grid')
+
+        self.inv = inv
+        self.upsampling = int(upsampling)
+        self.interp_order = int(interp_order)
+        self.depth_order = int(depth_order)
+        self.n_cols = inv._N_cols
+        self.columns = inv.multipole_column_indices()
+        super().__init__(dtype=np.float64,
+                         shape=(inv.N_sensors, inv.N_particles * self.n_cols))
+
+        grid = inv.sensor_grid
+        Nx, Ny = grid.counts
+        self.h = np.array(grid.step) / self.upsampling
+        positions = inv.particle_positions
+
+        # Particles and depth interpolation weights of every layer
+        self.layers, self.layer_weights, self.layer_depths = self._depth_layers(depth_tol)
+
+        # Spreading stencils, in fine grid units relative to the scan origin
+        u = (positions[:, :2] - np.array(grid.origin)) / self.h
+        ix, wx = _lagrange_stencil(u[:, 0], self.interp_order)
+        iy, wy = _lagrange_stencil(u[:, 1], self.interp_order)
+
+        # Fine grid covering the sensors and the stencils
+        self.offset = np.array([min(0, ix.min()), min(0, iy.min())])
+        P = np.array([max((Nx - 1) * self.upsampling, ix.max()),
+                      max((Ny - 1) * self.upsampling, iy.max())]) - self.offset + 1
+        # FFT size for linear convolutions with displacements in [-(P-1), P-1]
+        self.fft_shape = (sfft.next_fast_len(int(2 * P[1] - 1), real=True),
+                          sfft.next_fast_len(int(2 * P[0] - 1), real=True))
+        Fy, Fx = self.fft_shape
+
+        # Flattened fine grid indices and weights of the stencil nodes of
+        # every particle, as N_particles x interp_order^2 arrays
+        self._stencil = ((iy - self.offset[1])[:, :, np.newaxis] * Fx
+                         + (ix - self.offset[0])[:, np.newaxis, :]).reshape(len(u), -1)
+        self._weights = (wy[:, :, np.newaxis] * wx[:, np.newaxis, :]).reshape(len(u), -1)
+
+        # Fine grid indices of the sensors, ordered as the rows of Q
+        sx = np.arange(Nx) * self.upsampling - self.offset[0]
+        sy = np.arange(Ny) * self.upsampling - self.offset[1]
+        self._sensors = (sy[:, np.newaxis] * Fx + sx[np.newaxis, :]).reshape(-1)
+
+        # Spectra of the field images of every multipole component
+        LOGGER.info(f'FFT forward operator: {len(self.layers)} layers for '
+                    f'{len(positions)} particles, '
+                    f'fine grid {P[1]} x {P[0]}, FFT size {Fy} x {Fx}')
+        self._P = P
+        self.kernel_spectra = np.empty((len(self.layers), self.n_cols, Fy, Fx // 2 + 1),
+                                       dtype=np.complex128)
+        for L, depth in enumerate(self.layer_depths):
+            image = self._kernel_image(depth)
+            self.kernel_spectra[L] = sfft.rfft2(image, s=self.fft_shape)
+
+    def _depth_layers(self, depth_tol: float):
+        """Depth layers of the particles
+
+        Returns the list of particles of every layer, their depth
+        interpolation weights and the depths of the layers
+        """
+        height = self.inv.sensor_grid.height
+        dz = height - self.inv.particle_positions[:, 2]
+        if np.any(dz <= 0.):
+            raise ValueError('The particles must be below the sensors')
+        w = np.log(dz)
+        # Distinct depths (up to round-off)
+        order = np.argsort(w, kind='stable')
+        new_depth = np.ones(len(w), dtype=bool)
+        new_depth[1:] = np.diff(w[order]) > 1e-12
+        labels = np.empty(len(w), dtype=np.int64)
+        labels[order] = np.cumsum(new_depth) - 1
+        n_depths = labels.max() + 1
+
+        kernels = {}
+
+        def kernel(log_dz):
+            # Kernel at lateral displacements in units of dz, around the
+            # source, where the field is largest
+            s = np.linspace(-3., 3., 13)
+            dz = np.exp(log_dz)
+            points = np.column_stack((np.repeat(s, len(s)) * dz, np.tile(s, len(s)) * dz,
+                                      np.full(len(s) ** 2, height)))
+            return _kernel_columns(self.inv, np.array([[0., 0., height - dz]]), points)
+
+        dw = max(w.max() - w.min(), 0.5)
+        while True:
+            nodes, weights = _lagrange_stencil((w - w.min()) / dw, self.depth_order)
+            used = np.unique(nodes)
+            if len(used) >= n_depths:
+                # Not fewer layers than depths: one layer per depth
+                layers = [np.where(labels == L)[0] for L in range(n_depths)]
+                depths = np.array([height - dz[p].mean() for p in layers])
+                return layers, [np.ones(len(p)) for p in layers], depths
+
+            # Interpolation error at the midpoint of the intervals with particles
+            error = 0.
+            for j in np.unique(np.floor((w - w.min()) / dw)):
+                mid_nodes, mid_weights = _lagrange_stencil(np.array([j + 0.5]), self.depth_order)
+                exact = kernel(w.min() + (j + 0.5) * dw)
+                approx = np.zeros_like(exact)
+                for n, c in zip(mid_nodes[0], mid_weights[0]):
+                    if (n, dw) not in kernels:
+                        kernels[(n, dw)] = kernel(w.min() + n * dw)
+                    approx += c * kernels[(n, dw)]
+                for l in range(1, fwb.MAX_ORDER + 1):
+                    cols = fwb.order_columns(l)
+                    if cols.start >= self.n_cols:
+                        break
+                    error = max(error, np.abs(approx[:, cols] - exact[:, cols]).max()
+                                / np.abs(exact[:, cols]).max())
+            LOGGER.debug(f'Depth interpolation with {len(used)} layers: '
+                         f'relative error {error:.3e}')
+            if error <= depth_tol:
+                break
+            dw /= 2
+
+        layers, layer_weights = [], []
+        for n in used:
+            particles, stencil = np.nonzero(nodes == n)
+            layers.append(particles)
+            layer_weights.append(weights[particles, stencil])
+        depths = height - np.exp(w.min() + used * dw)
+        return layers, layer_weights, depths
+
+    def _kernel_image(self, depth: float) -> np.ndarray:
+        """Field of a source at `(0, 0, depth)` on the fine grid displacements
+
+        Returns an `n_cols x Fy x Fx` array where the displacement `d` (in
+        fine grid units) is stored at the index `d mod F`
+        """
+        Px, Py = self._P
+        image_grid = fwb.SensorGrid((-(Px - 1) * self.h[0], -(Py - 1) * self.h[1]),
+                                    self.h, (2 * Px - 1, 2 * Py - 1),
+                                    self.inv.sensor_grid.height)
+        columns = _kernel_columns(self.inv, np.array([[0., 0., depth]]),
+                                  image_grid.positions())
+        image = np.zeros((self.n_cols,) + self.fft_shape)
+        image[:, :2 * Py - 1, :2 * Px - 1] = columns.T.reshape(self.n_cols, 2 * Py - 1, 2 * Px - 1)
+        return np.roll(image, (-(Py - 1), -(Px - 1)), axis=(1, 2))
+
+    def _spread(self, particles: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """Spread the values of the particles onto the fine grid"""
+        grid = np.bincount(self._stencil[particles].reshape(-1),
+                           weights=(self._weights[particles] * values[:, np.newaxis]).reshape(-1),
+                           minlength=self.fft_shape[0] * self.fft_shape[1])
+        return grid.reshape(self.fft_shape)
+
+    def _interpolate(self, particles: np.ndarray, grid: np.ndarray) -> np.ndarray:
+        """Interpolate the fine grid at the particle positions"""
+        return np.sum(grid.reshape(-1)[self._stencil[particles]] * self._weights[particles], axis=1)
+
+    def _matvec(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        field_spectrum = np.zeros(self.kernel_spectra.shape[2:], dtype=np.complex128)
+        for L, particles in enumerate(self.layers):
+            weights = self.layer_weights[L]
+            for k in range(self.n_cols):
+                grid = self._spread(particles, weights * x[self.columns[particles, k]])
+                field_spectrum += sfft.rfft2(grid) * self.kernel_spectra[L, k]
+        field = sfft.irfft2(field_spectrum, s=self.fft_shape)
+        return field.reshape(-1)[self._sensors]
+
+    def _rmatvec(self, y):
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        grid = np.zeros(self.fft_shape[0] * self.fft_shape[1])
+        grid[self._sensors] = y
+        y_spectrum = sfft.rfft2(grid.reshape(self.fft_shape))
+
+        x = np.zeros(self.shape[1])
+        for L, particles in enumerate(self.layers):
+            weights = self.layer_weights[L]
+            for k in range(self.n_cols):
+                # Correlation of the sensor values with the kernel
+                corr = sfft.irfft2(y_spectrum * np.conj(self.kernel_spectra[L, k]),
+                                   s=self.fft_shape)
+                x[self.columns[particles, k]] += weights * self._interpolate(particles, corr)
+        return x
+
+    def column_norms(self) -> np.ndarray:
+        """Approximate 2-norms of the columns of Q
+
+        The squared norm of a column is the sum of the squared field of the
+        particle at the sensors. It is computed for every node of the fine
+        grid by correlating the sensor positions with the squared kernel, and
+        interpolated at the particle positions (and in depth).
+        """
+        grid = np.zeros(self.fft_shape[0] * self.fft_shape[1])
+        grid[self._sensors] = 1.
+        sensors_spectrum = sfft.rfft2(grid.reshape(self.fft_shape))
+
+        norms2 = np.zeros(self.shape[1])
+        for L, particles in enumerate(self.layers):
+            image = self._kernel_image(self.layer_depths[L])
+            for k in range(self.n_cols):
+                corr = sfft.irfft2(sensors_spectrum * np.conj(sfft.rfft2(image[k] ** 2)),
+                                   s=self.fft_shape)
+                norms2[self.columns[particles, k]] += (self.layer_weights[L]
+                                                       * self._interpolate(particles, corr))
+        return np.sqrt(np.clip(norms2, 0., None))
+
+    def error_estimate(self, n_samples: int = 10, seed: Optional[int] = None) -> float:
+        """Relative error of the operator for a sample of particles
+
+        Compares the columns of the operator for `n_samples` random
+        particles with the exact columns of Q. Returns the largest relative
+        error, in the 2-norm, of the sampled multipole columns.
+        """
+        rng = np.random.default_rng(seed)
+        particles = rng.choice(self.inv.N_particles, min(n_samples, self.inv.N_particles),
+                               replace=False)
+        positions = self.inv.sensor_grid.positions()
+        error = 0.
+        for p in particles:
+            exact = _kernel_columns(self.inv, self.inv.particle_positions[p:p + 1], positions)
+            for k in range(self.n_cols):
+                unit = np.zeros(self.shape[1])
+                unit[self.columns[p, k]] = 1.
+                column_error = np.linalg.norm(self.matvec(unit) - exact[:, k])
+                error = max(error, column_error / np.linalg.norm(exact[:, k]))
+        return error
+
+
+class _ClusterTree(object):
+    """Binary tree of points, split at the median of the widest dimension"""
+
+    def __init__(self, points: np.ndarray, indices: np.ndarray, leaf_size: int):
+        self.indices = indices
+        self.bbox_min = points[indices].min(axis=0)
+        self.bbox_max = points[indices].max(axis=0)
+        self.diameter = np.linalg.norm(self.bbox_max - self.bbox_min)
+        self.children = []
+        if len(indices) > leaf_size:
+            dim = np.argmax(self.bbox_max - self.bbox_min)
+            order = np.argsort(points[indices, dim], kind='stable')
+            half = len(indices) // 2
+            self.children = [_ClusterTree(points, indices[order[:half]], leaf_size),
+                             _ClusterTree(points, indices[order[half:]], leaf_size)]
+
+    def distance(self, other: '_ClusterTree') -> float:
+        """Distance between the bounding boxes of two clusters"""
+        gap = np.maximum(0., np.maximum(self.bbox_min - other.bbox_max,
+                                        other.bbox_min - self.bbox_max))
+        return np.linalg.norm(gap)
+
+
+def _aca(get_row, get_col, shape, tol, max_rank):
+    """Adaptive cross approximation with partial pivoting
+
+    Builds a low rank approximation `U V` of a matrix of the given `shape`
+    from some of its rows and columns, obtained with the functions
+    `get_row(i)` and `get_col(j)`. The iterations stop when the norm of the
+    last rank-one update is smaller than `tol` times the estimated norm of
+    the matrix. Returns `None` if the rank exceeds `max_rank`.
+    """
+    U, V = [], []
+    unused_rows = np.ones(shape[0], dtype=bool)
+    i = 0
+    norm2 = 0.
+    while len(U) < max_rank:
+        unused_rows[i] = False
+        row = get_row(i) - sum(u[i] * v for u, v in zip(U, V))
+        j = np.argmax(np.abs(row))
+        if row[j] == 0.:
+            # Zero residual row: try another row
+            if not unused_rows.any():
+                break
+            i = np.where(unused_rows)[0][0]
+            continue
+        v = row / row[j]
+        u = get_col(j) - sum(vl[j] * ul for ul, vl in zip(U, V))
+
+        norm2 += (np.dot(u, u) * np.dot(v, v)
+                  + 2 * sum(np.dot(u, ul) * np.dot(v, vl) for ul, vl in zip(U, V)))
+        U.append(u)
+        V.append(v)
+        if np.linalg.norm(u) * np.linalg.norm(v) <= tol * np.sqrt(abs(norm2)):
+            return np.array(U).T, np.array(V)
+        if not unused_rows.any():
+            break
+        i = np.where(unused_rows)[0][np.argmax(np.abs(u[unused_rows]))]
+
+    if not unused_rows.any() and len(U) > 0:
+        # All the rows were used: the approximation is exact
+        return np.array(U).T, np.array(V)
+    return None
+
+
+class HMatrixForwardOperator(spla.LinearOperator):
+    """Hierarchical matrix compression of the forward matrix
+
+    The sensors and the particles are organised in binary cluster trees.
+    Blocks of `Q` that couple a cluster of sensors with a cluster of
+    particles whose bounding boxes are well separated (admissible blocks)
+    are approximated with low rank factors `U V`, computed with the adaptive
+    cross approximation from a few rows and columns of the block. Every
+    multipole order is compressed separately, since the magnitude of the
+    entries differs by orders of magnitude between orders. The remaining
+    blocks, of small clusters, are stored as dense matrices. The memory of
+    the operator grows almost linearly with the number of sensors and
+    particles.
+
+    Parameters
+    ----------
+    inv
+        `MultipoleInversion` instance. Both the sensor grid and explicit
+        sensor positions are supported
+    leaf_size
+        Maximum number of sensors or particles in the leaves of the trees
+    eta
+        Admissibility parameter: a block is compressed if the largest
+        diameter of its clusters is at most `eta` times their distance
+    tol
+        Relative accuracy of the low rank approximations
+    """
+
+    def __init__(self, inv,
+                 leaf_size: int = 64,
+                 eta: float = 2.,
+                 tol: float = 1e-6):
+        self.inv = inv
+        self.n_cols = inv._N_cols
+        self.columns = inv.multipole_column_indices()
+        self.tol = tol
+        self.eta = eta
+        super().__init__(dtype=np.float64,
+                         shape=(inv.N_sensors, inv.N_particles * self.n_cols))
+
+        self._sensor_positions = inv.scan_positions
+        self.sensor_tree = _ClusterTree(self._sensor_positions,
+                                        np.arange(inv.N_sensors), leaf_size)
+        self.particle_tree = _ClusterTree(inv.particle_positions,
+                                          np.arange(inv.N_particles), leaf_size)
+
+        # List of (sensors, Q columns, U, V) blocks. Dense blocks have V=None
+        self.blocks = []
+        self._build(self.sensor_tree, self.particle_tree)
+
+        stored = sum(U.size + (0 if V is None else V.size) for _, _, U, V in self.blocks)
+        self.compression_ratio = stored / (self.shape[0] * self.shape[1])
+        LOGGER.info(f'H-matrix with {len(self.blocks)} blocks, '
+                    f'compression ratio {self.compression_ratio:.4f}')
+
+    def _order_columns(self, particles):
+        """Column offsets and Q columns of every multipole order"""
+        for order in range(1, fwb.MAX_ORDER + 1):
+            cols = fwb.order_columns(order)
+            if cols.start >= self.n_cols:
+                break
+            yield cols, self.columns[particles, cols].reshape(-1)
+
+    def _build(self, sensors, particles):
+        admissible = (max(sensors.diameter, particles.diameter)
+                      <= self.eta * sensors.distance(particles))
+        if admissible:
+            self._add_low_rank(sensors.indices, particles.indices)
+        elif len(sensors.children) == 0 and len(particles.children) == 0:
+            self._add_dense(sensors.indices, particles.indices)
+        elif len(particles.children) == 0 or (len(sensors.children) > 0
+                                              and sensors.diameter >= particles.diameter):
+            for child in sensors.children:
+                self._build(child, particles)
+        else:
+            for child in particles.children:
+                self._build(sensors, child)
+
+    def _add_dense(self, rows, particles):
+        block = _kernel_columns(self.inv, self.inv.particle_positions[particles],
+                                self._sensor_positions[rows])
+        block.shape = (len(rows), len(particles), self.n_cols)
+        for cols, q_cols in self._order_columns(particles):
+            self.blocks.append((rows, q_cols, block[:, :, cols].reshape(len(rows), -1), None))
+
+    def _add_low_rank(self, rows, particles):
+        r_sources = self.inv.particle_positions[particles]
+        r_sensors = self._sensor_positions[rows]
+        row_cache, col_cache = {}, {}
+
+        def full_row(i):
+            if i not in row_cache:
+                row_cache[i] = _kernel_columns(self.inv, r_sources, r_sensors[i:i + 1]).reshape(
+                    len(particles), self.n_cols)
+            return row_cache[i]
+
+        def full_col(p):
+            if p not in col_cache:
+                col_cache[p] = _kernel_columns(self.inv, r_sources[p:p + 1], r_sensors)
+            return col_cache[p]
+
+        for cols, q_cols in self._order_columns(particles):
+            n = cols.stop - cols.start
+            shape = (len(rows), len(particles) * n)
+            # Low rank factors are only stored if they use less memory
+            max_rank = (shape[0] * shape[1]) // (shape[0] + shape[1])
+            factors = _aca(lambda i: full_row(i)[:, cols].reshape(-1),
+                           lambda j: full_col(j // n)[:, cols.start + j % n],
+                           shape, self.tol, max_rank)
+            if factors is None:
+                # Not compressible: store the block of this order
+                block = np.column_stack([full_col(p)[:, cols] for p in range(len(particles))])
+                self.blocks.append((rows, q_cols, block, None))
+            else:
+                self.blocks.append((rows, q_cols) + factors)
+
+    def _matvec(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        y = np.zeros(self.shape[0])
+        for rows, cols, U, V in self.blocks:
+            if V is None:
+                y[rows] += np.dot(U, x[cols])
+            else:
+                y[rows] += np.dot(U, np.dot(V, x[cols]))
+        return y
+
+    def _rmatvec(self, y):
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        x = np.zeros(self.shape[1])
+        for rows, cols, U, V in self.blocks:
+            if V is None:
+                x[cols] += np.dot(U.T, y[rows])
+            else:
+                x[cols] += np.dot(V.T, np.dot(U.T, y[rows]))
+        return x
+
+    def column_norms(self) -> np.ndarray:
+        """2-norms of the columns of the compressed matrix"""
+        norms2 = np.zeros(self.shape[1])
+        for rows, cols, U, V in self.blocks:
+            if V is None:
+                norms2[cols] += np.sum(U ** 2, axis=0)
+            else:
+                norms2[cols] += np.einsum('kj,kl,lj->j', V, np.dot(U.T, U), V)
+        return np.sqrt(np.clip(norms2, 0., None))
+
+    def factorize(self,
+                  rank: int,
+                  n_oversamples: int = 10,
+                  n_power_iter: int = 2,
+                  seed: Optional[int] = None):
+        """Approximate truncated SVD of the forward matrix
+
+        Computes `Q ≈ U diag(s) Vt` with the randomized range finder, using
+        only products of the compressed matrix with blocks of vectors. The
+        factors are stored in the `factors` variable and used by `lstsq`.
+
+        Parameters
+        ----------
+        rank
+            Number of singular values of the factorization
+        n_oversamples
+            Extra random vectors used to sample the range of `Q`
+        n_power_iter
+            Number of power iterations, which improve the accuracy for
+            slowly decaying singular values
+        seed
+            Seed of the random number generator
+
+        Returns
+        -------
+        tuple
+            `(U, s, Vt)` arrays
+        """
+        rng = np.random.default_rng(seed)
+        k = min(rank + n_oversamples, min(self.shape))
+        Y = self.matmat(rng.normal(size=(self.shape[1], k)))
+        basis, _ = np.linalg.qr(Y)
+        for _ in range(n_power_iter):
+            basis, _ = np.linalg.qr(self.rmatmat(basis))
+            basis, _ = np.linalg.qr(self.matmat(basis))
+        # Small matrix B = basis^T Q, computed with the transpose product
+        B = self.rmatmat(basis).T
+        Ub, s, Vt = np.linalg.svd(B, full_matrices=False)
+        self.factors = (np.dot(basis, Ub[:, :rank]), s[:rank], Vt[:rank])
+        return self.factors
+
+    def lstsq(self, b: np.ndarray, rcond: float = 1e-12) -> np.ndarray:
+        """Least squares solution from the truncated SVD (see `factorize`)
+
+        Singular values smaller than `rcond` times the largest singular value
+        are discarded
+        """
+        U, s, Vt = self.factors
+        keep = s > rcond * s[0]
+        return np.dot(Vt[keep].T, np.dot(U[:, keep].T, b) / s[keep])
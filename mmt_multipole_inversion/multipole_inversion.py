@@ -3,8 +3,11 @@ import numpy as np
 import time
 # import datetime
 import json
+import numbers
 # from scipy.special import sph_harm
 import scipy.linalg as slin
+import scipy.sparse.linalg as spla
+import scipy.signal as ssig
 # import warnings
 # try:
 #     import tensorflow as tf
@@ -12,12 +15,14 @@ import scipy.linalg as slin
 #     warnings.warn('Could not import Tensorflow')
 from pathlib import Path
 
-# CUDA modules for populating the suscept matrix (if available)
-try:
-    from .susceptibility_modules.cuda import cudalib as sus_cudalib
-    HASCUDA = True
-except ImportError:
-    HASCUDA = False
+# Libraries (backends) to populate the forward matrix
+from . import forward_backends as fwb
+from .forward_backends import HASCUDA, HASOPENMP
+# Matrix-free forward operators
+from . import forward_operators as fwo
+# Spatial index of particles and sensors
+from .spatial_index import SpatialIndex
+from .kernel_tables import KernelTable
 
 # Suscept modules:
 from . import susceptibility_modules as sus_mods
@@ -25,6 +30,7 @@ from . import susceptibility_modules as sus_mods
 from typing import Optional
 from typing import Literal  # Working with Python >3.8
 from typing import Union    # Working with Python >3.8
+from typing import Tuple
 from collections.abc import Callable
 from . import plot_tools as pt
 
@@ -44,9 +50,141 @@ _SusOptions = Literal['spherical_harmonics_basis',
                       'spherical_harmonics_basis_area',
                       'spherical_harmonics_basis_volume'
                       ]
-_ExpOptions = Literal['dipole', 'quadrupole', 'octupole']
-_MethodOptions = Literal['numba', 'cuda']
-_InvMethodOps = Literal['np_pinv', 'sp_pinv', 'sp_pinv2', 'direct']
+_ExpOptions = Union[Literal['dipole', 'quadrupole', 'octupole'], int]
+_MethodOptions = Literal['auto', 'numba', 'numba_grid', 'numba_lattice', 'cuda', 'openmp', 'table', 'quadrature', 'psf']
+_InvMethodOps = Literal['np_pinv', 'sp_pinv', 'sp_pinv2', 'direct', 'fft_lsqr', 'hmatrix_lsqr',
+                        'huber_irls', 'tukey_irls', 'group_lasso']
+_LayoutOptions = Literal['interleaved', 'order_blocked']
+_DtypeOptions = Literal['float64', 'float32']
+_ScalingOptions = Literal['column', 'block']
+_OperatorOptions = Literal['fft', 'hmatrix']
+
+# Classes of the matrix-free forward operators
+_OPERATORS = {'fft': fwo.FFTForwardOperator,
+              'hmatrix': fwo.HMatrixForwardOperator}
+
+# Length units (micrometres) used to compute single precision forward matrices
+_SINGLE_PRECISION_LENGTH_SCALE = 1e6
+
+# Names of the expansion limits of the first multipole orders
+_EXP_NAMES = {order: name for name, order in fwb.MP_ORDER.items()}
+
+
+def _n_cols(expansion_limit: _ExpOptions) -> int:
+    """Number of multipole moments per particle up to an expansion limit"""
+    return fwb.n_multipoles(fwb.multipole_order(expansion_limit))
+
+
+def _order_blocked_indices(N_particles: int, n_cols: int) -> np.ndarray:
+    """Indices of the multipoles of every particle in an order-blocked vector
+
+    In the order-blocked arrangement every block has the values of one
+    multipole order for all the particles: `N_particles * 3` dipole values,
+    then `N_particles * 5` quadrupole values, etc. Returns an
+    `N_particles x n_cols` array of integers.
+    """
+    blocks = []
+    col_start, col_block = 0, 0
+    order = 1
+    while col_start < n_cols:
+        n_order_cols = 2 * order + 1
+        order += 1
+        blocks.append(col_block + np.arange(N_particles * n_order_cols).reshape(N_particles, n_order_cols))
+        col_start += n_order_cols
+        col_block += N_particles * n_order_cols
+    return np.column_stack(blocks)
+
+
+def _matvec(Q: np.ndarray, x: np.ndarray, max_chunk_size: int = 2 ** 23) -> np.ndarray:
+    """Double precision product of a matrix with a vector
+
+    Single precision matrices are converted to double precision in blocks of
+    rows (with at most `max_chunk_size` elements), to avoid a full copy.
+    """
+    if Q.dtype == np.float64:
+        return np.dot(Q, x)
+
+    result = np.empty(Q.shape[0], dtype=np.float64)
+    n_rows = max(1, max_chunk_size // max(1, Q.shape[1]))
+    for i in range(0, Q.shape[0], n_rows):
+        result[i:i + n_rows] = np.dot(Q[i:i + n_rows].astype(np.float64), x)
+    return result
+
+
+def _row_blocks(Q: np.ndarray, rows: np.ndarray, max_chunk_size: int = 2 ** 23):
+    """Blocks of the `rows` of `Q`, in double precision
+
+    Yields the slices of `rows` and the (copied) blocks of rows, with at
+    most `max_chunk_size` elements
+    """
+    n_rows = max(1, max_chunk_size // max(1, Q.shape[1]))
+    for i in range(0, len(rows), n_rows):
+        yield slice(i, i + n_rows), Q[rows[i:i + n_rows]].astype(np.float64, copy=False)
+
+
+def _rmatvec(Q: np.ndarray, y: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Double precision product `Q[rows].T y`, without copying `Q[rows]`"""
+    result = np.zeros(Q.shape[1])
+    for block, Q_block in _row_blocks(Q, rows):
+        result += np.dot(y[block], Q_block)
+    return result
+
+
+def _weighted_gram(Q: np.ndarray, weights: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Double precision Gram matrix `Q[rows].T diag(weights) Q[rows]`
+
+    The rows are processed in blocks, to avoid a (weighted) copy of `Q`
+    """
+    G = np.zeros((Q.shape[1], Q.shape[1]))
+    for block, Q_block in _row_blocks(Q, rows):
+        G += np.dot(Q_block.T * weights[block], Q_block)
+    return G
+
+
+def _weighted_qr(Q: np.ndarray, sqrt_weights: np.ndarray, rows: np.ndarray, b: np.ndarray,
+                 max_chunk_size: int = 2 ** 23) -> Tuple[np.ndarray, np.ndarray]:
+    """Triangular factor of the weighted least squares problem
+
+    Returns the (double precision) upper triangular factor `R` of the QR
+    decomposition of `W^1/2 Q[rows]` and the rotated data `z = U^T W^1/2 b`,
+    so that the problem `min |W^1/2 (b - Q[rows] m)|` reduces to `R m = z`.
+    The rows are processed in blocks, updating the factor of the augmented
+    matrix `[R z]` with every block, to avoid a (weighted) copy of `Q`
+    """
+    n = Q.shape[1]
+    Rz = np.zeros((0, n + 1))
+    for block, Q_block in _row_blocks(Q, rows, max_chunk_size):
+        stacked = np.empty((len(Rz) + len(Q_block), n + 1))
+        stacked[:len(Rz)] = Rz
+        stacked[len(Rz):, :-1] = Q_block * sqrt_weights[block, np.newaxis]
+        stacked[len(Rz):, -1] = b[block] * sqrt_weights[block]
+        Rz = slin.qr(stacked, mode='r', overwrite_a=True)[0][:n + 1]
+
+    # With fewer rows than columns the factor is padded with zeros
+    R, z = np.zeros((n, n)), np.zeros(n)
+    R[:len(Rz[:n])] = Rz[:n, :-1]
+    z[:len(Rz[:n])] = Rz[:n, -1]
+    return R, z
+
+
+def _column_sums_of_squares(Q: np.ndarray, weights: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Double precision diagonal of `Q[rows].T diag(weights) Q[rows]`
+
+    The rows are processed in blocks, without forming the Gram matrix
+    """
+    result = np.zeros(Q.shape[1])
+    for block, Q_block in _row_blocks(Q, rows):
+        result += np.einsum('ij,ij->j', Q_block * weights[block, np.newaxis], Q_block)
+    return result
+
+
+# Weight functions of the robust losses of the IRLS inversion, for the
+# residuals `u` in units of the scale, and their default tuning constants
+# (95% efficiency for Gaussian noise)
+_ROBUST_LOSSES = {
+    'huber': (lambda u, c: np.minimum(1., c / np.maximum(np.abs(u), 1e-300)), 1.345),
+    'tukey': (lambda u, c: np.where(np.abs(u) < c, (1. - (u / c) ** 2) ** 2, 0.), 4.685),
+}
 
 
 class MultipoleInversion(object):
@@ -63,7 +201,8 @@ class MultipoleInversion(object):
                  sample_config_file: Union[str, Path],
                  sample_arrays: Optional[Union[str, Path]],  # TODO: set to npz file
                  expansion_limit: _ExpOptions = 'quadrupole',
-                 sus_functions_module: _SusOptions = 'spherical_harmonics_basis'
+                 sus_functions_module: _SusOptions = 'spherical_harmonics_basis',
+                 Q_layout: _LayoutOptions = 'interleaved'
                  ) -> None:
         """
         Parameters
@@ -96,7 +235,10 @@ class MultipoleInversion(object):
         expansion_limit
             Higher order multipole term to compute the field contribution from
             the potential of the magnetic particles. Options:
-                `dipole`, `quadrupole`, `octupole`
+                `dipole`, `quadrupole`, `octupole`, or the multipole order as
+                an integer, e.g. `4` for hexadecapoles. Orders larger than 3
+                are only implemented in the spherical harmonics bases (with
+                the `quadrature` method for area and volume sensors)
         sus_functions_module
             Spherical harmonic basis for the susceptibility matrix used for the
             multipole inversion. The fully orthogonal and linearly independent
@@ -110,6 +252,17 @@ class MultipoleInversion(object):
             dimension, e.g. a rectangle, where the magnetic flux is integrated
             within it. For details see the comments in the libraries in the
             `sus_functions_module/` directory and the Notes.
+        Q_layout
+            Arrangement of the columns of the forward matrix `Q`. With
+            `interleaved`, the columns of every particle are contiguous, i.e.
+            the dipole, quadrupole and octupole columns of particle 0, then
+            the columns of particle 1, etc. With `order_blocked`, all the
+            dipole columns come first (3 per particle), then all the
+            quadrupole columns (5 per particle) and then all the octupole
+            columns (7 per particle). The latter allows to use the lower
+            order subsystems of `Q` without copying the matrix, see
+            `get_forward_submatrix`. The results of the inversion, e.g.
+            `inv_multipole_moments`, do not depend on the layout.
 
         Notes
         -----
@@ -127,9 +280,11 @@ class MultipoleInversion(object):
         # Set the module from which to find the Bz susceptibility functions,
         # which is specified using the sus_functions_module argument
         self.sus_mod = getattr(sus_mods, sus_functions_module)
+        self.sus_functions_module = sus_functions_module
 
         self._expansion_limit = 'dipole'  # set default value
         self.expansion_limit = expansion_limit  # update def value
+        self.Q_layout = Q_layout
 
         # Optional sequence to set the origin of scan positions
         # self.scan_origin = (0.0, 0.0)
@@ -201,27 +356,186 @@ class MultipoleInversion(object):
 
         # Instantiate the forward matrix
         self.Q = np.empty(0)
+        self.Q_col_scale = None
+        self.forward_operator = None
+        self.kernel_table = None
+        self.Q_derivatives = None
+        self.Q_second_derivatives = None
+        self.sensor_psf = None
 
     @property
     def expansion_limit(self):
         return self._expansion_limit
 
     @expansion_limit.setter
-    def expansion_limit(self, string_value: str):
+    def expansion_limit(self, value: _ExpOptions):
         # This will determine the number of columns in the forward calculation
-        if string_value == 'dipole':
-            self._N_cols = 3
-        elif string_value == 'quadrupole':
-            self._N_cols = 8
-        elif string_value == 'octupole':
-            self._N_cols = 15
-        else:
+        try:
+            order = fwb.multipole_order(value)
+        except (TypeError, ValueError):
             raise Exception('Specify a valid expansion limit for the multipole calculation')
-        self._expansion_limit = string_value
+        self._N_cols = fwb.n_multipoles(order)
+        # The first orders are stored by name
+        self._expansion_limit = _EXP_NAMES.get(order, order)
 
         # Reset the Q matrix whose size depends on _N_cols
         self.Q = np.empty(0)
 
+    @property
+    def Q_layout(self):
+        return self._Q_layout
+
+    @Q_layout.setter
+    def Q_layout(self, string_value: str):
+        if string_value not in ['interleaved', 'order_blocked']:
+            raise ValueError('Specify a valid layout for the forward matrix')
+        self._Q_layout = string_value
+        # Reset the Q matrix whose columns depend on the layout
+        self.Q = np.empty(0)
+
+    @property
+    def sensor_psf(self) -> Optional[np.ndarray]:
+        """Point-spread function of the sensors, sampled on the scan grid
+
+        A `Py x Px` array, with odd `Py` and `Px`, where the entry `[v, u]`
+        is the weight of the point-sensor field displaced by
+        `(u - Px // 2) * Sdx` and `(v - Py // 2) * Sdy` from the sensor
+        centre, e.g. a normalised optical blur of the QDM pixels. If set, the
+        forward matrix is generated with the `psf` method, which convolves
+        the point-sensor columns with the PSF using FFTs. Set to `None` to
+        model point sensors
+        """
+        return self._sensor_psf
+
+    @sensor_psf.setter
+    def sensor_psf(self, psf: Optional[np.ndarray]):
+        if psf is not None:
+            psf = np.array(psf, dtype=np.float64)
+            if psf.ndim != 2 or psf.shape[0] % 2 == 0 or psf.shape[1] % 2 == 0:
+                raise ValueError('The sensor PSF must be a 2D array with an odd number of rows and columns')
+        self._sensor_psf = psf
+        # Reset the Q matrix which depends on the PSF
+        self.Q = np.empty(0)
+
+    def multipole_column_indices(self,
+                                 expansion_limit: Optional[_ExpOptions] = None
+                                 ) -> np.ndarray:
+        """Column indices of the multipole moments in the forward matrix
+
+        Parameters
+        ----------
+        expansion_limit
+            Return the indices of the multipoles up to this order. By default
+            the `expansion_limit` of the inversion is used
+
+        Returns
+        -------
+        ndarray
+            `N_particles x N_multipoles` array of integers, where the row `i`
+            has the indices of the `Q` columns with the multipole moments of
+            particle `i`, e.g. `Q[:, idx[i, 0]]` is the dipole `mx` column.
+            This array follows the layout set in `Q_layout`
+        """
+        if expansion_limit is None:
+            expansion_limit = self.expansion_limit
+        n_cols = _n_cols(expansion_limit)
+        N = self.N_particles
+
+        if self.Q_layout == 'interleaved':
+            idx = np.arange(N * self._N_cols).reshape(N, self._N_cols)
+            return idx[:, :n_cols]
+
+        return _order_blocked_indices(N, n_cols)
+
+    def get_forward_submatrix(self,
+                              expansion_limit: _ExpOptions,
+                              apply_field_mask: bool = False) -> np.ndarray:
+        """Forward matrix of the multipoles up to a given expansion limit
+
+        If the `order_blocked` layout is used, the sub-matrix is a view of
+        `Q` (no copy), otherwise the columns are gathered into a new array.
+        The columns follow the same layout as `Q`.
+
+        Parameters
+        ----------
+        expansion_limit
+            Higher order multipole of the sub-matrix. Must not be larger than
+            the `expansion_limit` of the inversion
+        apply_field_mask
+            Only return the rows of the sensors labeled as `True` in the
+            `fieldMask` array. This always makes a copy of the matrix
+        """
+        if _n_cols(expansion_limit) > self._N_cols:
+            raise ValueError(f'Expansion limit {expansion_limit} larger than {self.expansion_limit}')
+        if self.Q.size == 0:
+            raise ValueError('Forward matrix not generated')
+
+        if self.Q_layout == 'order_blocked':
+            subQ = self.Q[:, :_n_cols(expansion_limit) * self.N_particles]
+        elif _n_cols(expansion_limit) == self._N_cols:
+            subQ = self.Q
+        else:
+            LOGGER.info('Copying columns of the interleaved forward matrix')
+            subQ = self.Q[:, self.multipole_column_indices(expansion_limit).reshape(-1)]
+
+        if apply_field_mask:
+            subQ = subQ[self.fieldMask.reshape(-1)]
+        return subQ
+
+    def _column_norms(self,
+                      Qmatrix: Optional[np.ndarray],
+                      column_scaling: _ScalingOptions,
+                      squared_norms: Optional[np.ndarray] = None) -> np.ndarray:
+        """Scaling factors that equilibrate the columns of Q to unit norm
+
+        The norms are computed from the `Qmatrix` rows (which can be masked),
+        or from their `squared_norms` if given, and recorded in the
+        `column_scaling_factors` array. `Q` is not modified
+        """
+        if squared_norms is None:
+            squared_norms = np.einsum('ij,ij->j', Qmatrix, Qmatrix, dtype=np.float64)
+        norms = np.sqrt(squared_norms)
+
+        if column_scaling == 'block':
+            idx = self.multipole_column_indices()
+            for l in range(1, fwb.multipole_order(self.expansion_limit) + 1):
+                block = idx[:, fwb.order_columns(l)]
+                norms[block] = np.sqrt(np.sum(norms[block] ** 2, axis=1))[:, np.newaxis]
+        elif column_scaling != 'column':
+            raise ValueError(f'Column scaling {column_scaling} not valid')
+
+        # Columns without signal, e.g. if masked, are not scaled
+        norms[norms == 0.] = 1.
+        LOGGER.info(f'Scaling Q columns: norms in [{norms.min():.4e}, {norms.max():.4e}]')
+        self.column_scaling_factors = norms
+
+        return norms
+
+    def _refine_solution(self,
+                         Qmatrix: np.ndarray,
+                         Bzdata: np.ndarray,
+                         solve: Callable[[np.ndarray], np.ndarray],
+                         refinement_steps: int) -> np.ndarray:
+        """Mixed precision least squares solution with iterative refinement
+
+        `solve` returns the (single precision) solution of `Qmatrix m = b`.
+        The residuals are computed in double precision
+        """
+        solution = solve(Bzdata).astype(np.float64)
+        for k in range(refinement_steps):
+            residual = Bzdata - _matvec(Qmatrix, solution)
+            solution += solve(residual)
+            LOGGER.debug(f'Refinement step {k}: residual norm = {np.linalg.norm(residual):.6e}')
+        return solution
+
+    def _moments_from_solution(self, solution: np.ndarray) -> np.ndarray:
+        """Arrange a vector ordered as the `Q` columns by particles
+
+        Returns a `N_particles x N_multipoles` array
+        """
+        if self.Q_layout == 'interleaved':
+            return solution.reshape(self.N_particles, -1)
+        return solution[self.multipole_column_indices()]
 
     @property
     def Bz_array(self):
@@ -253,8 +567,11 @@ class MultipoleInversion(object):
 
         # TODO: Check that Sx/Sy correspond to the dimensions of the Bz array
         # Generate measurement mesh
-        self.Sx_range = self.sensor_origin_x + np.arange(round(self.Sx / self.Sdx)) * self.Sdx
-        self.Sy_range = self.sensor_origin_y + np.arange(round(self.Sy / self.Sdy)) * self.Sdy
+        self.sensor_grid = fwb.SensorGrid(
+            (self.sensor_origin_x, self.sensor_origin_y), (self.Sdx, self.Sdy),
+            (round(self.Sx / self.Sdx), round(self.Sy / self.Sdy)), self.Hz)
+        self.Sx_range = self.sensor_grid.x_range
+        self.Sy_range = self.sensor_grid.y_range
         self.Nx_surf = len(self.Sx_range)
         self.Ny_surf = len(self.Sy_range)
 
@@ -263,14 +580,93 @@ class MultipoleInversion(object):
 
         self.N_sensors = self.Nx_surf * self.Ny_surf
 
-        # TODO: Check the memory usage by saving the scan positions matrix 
-        self.scan_positions = np.ones((self.N_sensors, 3))
-        X_pos, Y_pos = np.meshgrid(self.Sx_range, self.Sy_range)
-        self.scan_positions[:, :2] = np.stack((X_pos, Y_pos), axis=2).reshape(-1, 2)
-        self.scan_positions[:, 2] *= self.Hz
-        LOGGER.info('Scan positions array memory: {:.4f} Mb'.format(self.scan_positions.nbytes / (1024 * 1024)))
+        # Scan positions are generated from the sensor grid unless an array
+        # with explicit positions is set. The positions of the grid are
+        # cached on first access, see `scan_positions`
+        self._scan_positions = None
+        self._grid_positions = None
+        self._grid_positions_key = None
 
-    def generate_forward_matrix(self, optimization: _MethodOptions = 'numba'):
+    @property
+    def scan_positions(self):
+        """`N_sensors x 3` array with the sensor positions
+
+        If no explicit positions have been set, the array is generated from
+        `sensor_grid` on first access and cached until the grid changes.
+        Explicit positions, e.g. for sensors that are not in a regular grid,
+        can be set by assigning an array with the same shape, or by
+        modifying the entries of this array in place; the sensors are still
+        ordered as the `Bz_array` entries. Assigning `None` restores the
+        positions of the grid.
+        """
+        if self._scan_positions is not None:
+            return self._scan_positions
+        key = repr(self.sensor_grid)
+        if self._grid_positions_key != key:
+            self._grid_positions = self.sensor_grid.positions()
+            self._grid_positions_key = key
+        return self._grid_positions
+
+    @scan_positions.setter
+    def scan_positions(self, positions: Optional[np.ndarray]):
+        self._grid_positions = None
+        self._grid_positions_key = None
+        if positions is None:
+            self._scan_positions = None
+            return
+        positions = np.array(positions, dtype=np.float64)
+        if positions.shape != (self.N_sensors, 3):
+            raise ValueError(f'Scan positions must have shape ({self.N_sensors}, 3)')
+        self._scan_positions = positions
+        LOGGER.info('Scan positions array memory: {:.4f} Mb'.format(positions.nbytes / (1024 * 1024)))
+
+    def _explicit_scan_positions(self) -> Optional[np.ndarray]:
+        """Sensor positions that are not given by `sensor_grid`, or `None`
+
+        Cached positions of the grid that were modified in place (see
+        `scan_positions`) become explicit positions
+        """
+        if self._scan_positions is None and self._grid_positions is not None:
+            grid = self.sensor_grid
+            if self._grid_positions_key != repr(grid):
+                # Cache of a previous grid
+                self._grid_positions = self._grid_positions_key = None
+                return None
+            positions = self._grid_positions.reshape(grid.counts[1], grid.counts[0], 3)
+            shape = positions.shape[:2]
+            if not (np.array_equal(positions[:, :, 0], np.broadcast_to(grid.x_range, shape))
+                    and np.array_equal(positions[:, :, 1], np.broadcast_to(grid.y_range[:, np.newaxis], shape))
+                    and np.all(positions[:, :, 2] == grid.height)):
+                LOGGER.info('Scan positions modified: using explicit sensor positions')
+                self._scan_positions = self._grid_positions
+                self._grid_positions = self._grid_positions_key = None
+        return self._scan_positions
+
+    @property
+    def spatial_index(self) -> SpatialIndex:
+        """KD-tree index of the particle and sensor positions
+
+        The index is built on first use and rebuilt only when the particle
+        positions or the sensor positions change. See `SpatialIndex` for the
+        available queries
+        """
+        if self._explicit_scan_positions() is None:
+            sensors_key = repr(self.sensor_grid)
+        else:
+            sensors_key = hash(self._scan_positions.tobytes())
+        key = (hash(np.asarray(self.particle_positions).tobytes()), sensors_key)
+        if getattr(self, '_spatial_index_key', None) != key:
+            LOGGER.info('Building spatial index of particles and sensors')
+            self._spatial_index = SpatialIndex(self.particle_positions, self.scan_positions)
+            self._spatial_index_key = key
+        return self._spatial_index
+
+    def generate_forward_matrix(self,
+                                optimization: Union[_MethodOptions, str] = 'numba',
+                                num_threads: int = 0,
+                                dtype: _DtypeOptions = 'float64',
+                                cutoff_radius: Optional[float] = None,
+                                quadrature_tol: float = 1e-6):
         """
         Generate the forward matrix adding the field contribution from all
         the particles for every grid point at the scan surface. The field is
@@ -281,14 +677,64 @@ class MultipoleInversion(object):
         Parameters
         ----------
         optimization
-            The method to optimize the calculation of the matrix elements:
-            `numba` or `cuda`
+            The method (backend) to optimize the calculation of the matrix
+            elements: `numba`, `numba_grid`, `numba_lattice`, `cuda`,
+            `openmp`, `table`, `quadrature` or `psf`. The `openmp` option uses the compiled CPU library, which
+            is parallelised over the sensors with OpenMP threads. The
+            `numba_grid` option, for area and volume sensors, evaluates the
+            flux at the corners shared by neighbouring sensors of the scan
+            grid only once. The `numba_lattice` option groups particles with
+            the same depth and offset from the scan grid, e.g. particles in
+            voxels aligned with the grid, and computes the field of every
+            group once, see `forward_backends.lattice_groups`. It is only
+            selected by `auto` if the groups save at least half of the field
+            evaluations. The `table`
+            option interpolates the entries of area and volume sensors from
+            `kernel_table`, see `generate_kernel_table`, and is only used if
+            specified. The
+            `quadrature` option integrates the point-sensor kernels over
+            area and volume sensors with Gauss-Legendre rules, see
+            `sensor_quadrature`, which supports any multipole order. The
+            `psf` option convolves the point-sensor columns with the
+            `sensor_psf` of the sensors and is used whenever it is set. Backends
+            registered with `forward_backends.register_backend` are also
+            accepted. If `auto`, the fastest available backend that supports
+            the susceptibility module, sensor geometry and expansion limit is
+            used, and slower backends are tried if the calculation fails.
+            Different backends can differ in the round-off of the matrix
+            elements
+        num_threads
+            Number of threads used by the `openmp` method. If smaller than 1,
+            the OpenMP default is used (see the `OMP_NUM_THREADS` variable)
+        dtype
+            Floating point type of the `Q` matrix. A `float32` matrix uses half
+            of the memory of the default `float64` matrix. In this case the
+            matrix elements are computed with lengths in micrometres, to keep
+            the multipole prefactors, e.g. `1e-7 / r^9` for octupoles, within
+            the range of single precision numbers. See Notes
+        cutoff_radius
+            If specified, only the entries of `Q` of the sensors within this
+            distance (in metres) of every particle are computed, and the
+            rest are set to zero. The pairs are obtained from
+            `spatial_index`. Only supported by the `numba` method
+        quadrature_tol
+            Relative accuracy of the `quadrature` method. The number of
+            integration nodes of every sensor-particle pair is chosen from
+            their distance, and far sensors use the point kernel
 
         Notes
         -----
         In case of using one of the `_area` or `_volume` susceptibility
         modules, where the sensor is modelled in 2D or 3D, remember to specify
         the `self.sensor_dims` tuple with the dimensions of the sensor
+
+        The forward matrix in SI units is `Q * Q_col_scale`, where every
+        column of `Q` is multiplied by the corresponding entry of
+        `Q_col_scale`. If `Q_col_scale` is `None`, `Q` is in SI units. For
+        example, a `float32` matrix computed in micrometres has a
+        `Q_col_scale` of `1e18` in the dipole columns, `1e24` in the
+        quadrupole columns and `1e30` in the octupole columns. The
+        `compute_inversion` method takes this scaling into account.
         """
         # WARNING: Not checking wrong types here, we rely on Type hints
 
@@ -297,83 +743,816 @@ class MultipoleInversion(object):
         # Generate  forward matrix
         # Q[i, j] =
 
-        # The total flux array according to the specified expansion limit
-        self.Q = np.zeros(shape=(self.N_sensors, self._N_cols * self.N_particles))
-        LOGGER.info('Green matrix memory: {:.4f} Mb'.format(self.Q.nbytes / (1024 * 1024)))
+        geometry = fwb.SENSOR_GEOMETRIES.get(len(self.sensor_dims))
+        if geometry is None or geometry != fwb.sensor_geometry(self.sus_functions_module):
+            raise ValueError('Wrong sensor dimensions')
+        order = fwb.multipole_order(self.expansion_limit)
+        dtype = np.dtype(dtype)
+
+        populate_kwargs = dict(quadrature_tol=quadrature_tol)
+        if cutoff_radius is not None:
+            if optimization not in ['auto', 'numba']:
+                raise ValueError('cutoff_radius is only supported by the numba method')
+            optimization = 'numba'
+            populate_kwargs['cutoff_pairs'] = self.spatial_index.sensor_particle_pairs(cutoff_radius)
+            LOGGER.info(f'Computing {len(populate_kwargs["cutoff_pairs"][0])} sensor-particle '
+                        f'pairs within the cut-off radius')
+        if self.sensor_psf is not None:
+            # The psf method convolves the columns computed with numba
+            if optimization not in ['auto', 'numba', 'psf']:
+                raise ValueError('The sensor_psf is only supported by the psf method')
+            optimization = 'psf'
+
+        if optimization == 'auto':
+            backends = fwb.find_backends(self.sus_functions_module, geometry, order, dtype,
+                                         inv=self)
+            if len(backends) == 0:
+                self.Q = np.empty(0)
+                raise ValueError(f'Expansion limit {self.expansion_limit} for '
+                                 f'{geometry} sensors not implemented')
+        else:
+            if optimization not in fwb.BACKENDS:
+                raise ValueError(f'Optimization {optimization} not valid')
+            backend = fwb.BACKENDS[optimization]
+            if not backend.available():
+                raise RuntimeError(f'The {optimization} method is not available. Stopping calculation')
+            if not backend.supports(self.sus_functions_module, geometry, order, dtype):
+                self.Q = np.empty(0)
+                raise ValueError(f'Expansion limit {self.expansion_limit} for '
+                                 f'{geometry} sensors with {self.sus_functions_module} '
+                                 f'and {dtype.name} not implemented by the {optimization} method')
+            backends = [backend]
+
+        # Single precision matrices are computed in micrometres. Lengths are
+        # rescaled here and the backends populate Q with the same expressions
+        length_scale = 1. if dtype == np.float64 else _SINGLE_PRECISION_LENGTH_SCALE
+        r_sources = self.particle_positions * length_scale
+        if self._explicit_scan_positions() is None:
+            r_sensors = self.sensor_grid.scaled(length_scale)
+        else:
+            r_sensors = self._scan_positions * length_scale
+        sensor_dims = tuple(d * length_scale for d in self.sensor_dims)
 
         # print('pos array:', particle_positions.shape)
         t0 = time.time()
 
-        mp_order = {'dipole': 1, 'quadrupole': 2, 'octupole': 3}
-
-        if optimization == 'cuda':
-            if len(self.sensor_dims) == 0:
-                if HASCUDA is False:
-                    raise RuntimeError('The cuda method is not available. Stopping calculation')
-
-                # Verbose only if logger is NOTSET, DEBUG or INFO
-                verb = 1 if LOGGER.level <= 20 else 0
-                sus_cudalib.SHB_populate_matrix(self.particle_positions,
-                                                self.scan_positions,
-                                                self.Q,
-                                                self.N_particles, self.N_sensors,
-                                                mp_order[self.expansion_limit],
-                                                verb)
-
-        # For all the particles, whose positions are stored in the pos array
-        # (N_particles x 3), compute the dipole (3 terms), quadrupole (5 terms)
-        # or octupole (7 terms) contributions. Here we populate the Q array
-        # using the numba-optimised susceptibility functions
-        elif optimization == 'numba':
-            if len(self.sensor_dims) == 0:
-                self.sus_mod.dipole_Bz_sus(self.particle_positions, self.scan_positions,
-                                           self.Q, self._N_cols)
-                if self.expansion_limit in ['quadrupole', 'octupole']:
-                    self.sus_mod.quadrupole_Bz_sus(self.particle_positions,
-                                                   self.scan_positions,
-                                                   self.Q, self._N_cols)
-                if self.expansion_limit in ['octupole']:
-                    self.sus_mod.octupole_Bz_sus(self.particle_positions,
-                                                 self.scan_positions,
-                                                 self.Q, self._N_cols)
-
-            # AREA SENSOR
-            elif len(self.sensor_dims) == 2:
-                if self._expansion_limit == 'octupole':
+        for i, backend in enumerate(backends):
+            # The total flux array according to the specified expansion limit
+            self.Q = np.zeros(shape=(self.N_sensors, self._N_cols * self.N_particles), dtype=dtype)
+            LOGGER.info('Green matrix memory: {:.4f} Mb'.format(self.Q.nbytes / (1024 * 1024)))
+
+            # Backends that cannot populate Q in the requested layout use the
+            # interleaved layout and the columns are rearranged afterwards
+            layout = self.Q_layout
+            if layout not in backend.layouts.get(geometry, ()):
+                layout = 'interleaved'
+
+            LOGGER.info(f'Populating forward matrix using the {backend.name} method')
+            try:
+                backend.populate(self, r_sources=r_sources, r_sensors=r_sensors,
+                                 sensor_dims=sensor_dims, num_threads=num_threads,
+                                 layout=layout, **populate_kwargs)
+            except Exception as e:
+                if i == len(backends) - 1:
                     self.Q = np.empty(0)
-                    raise ValueError('Octupole expansion_limit for area sensors not implemented')
-                self.sus_mod.multipole_Bz_sus(self.particle_positions, self.scan_positions,
-                                              self.Q, self._N_cols,
-                                              *self.sensor_dims,
-                                              mp_order[self.expansion_limit]
-                                              )
-                aream = 1 / (4 * self.sensor_dims[0] * self.sensor_dims[1])
-                # Convert area flux to average flux per sensor
-                np.multiply(self.Q, aream, out=self.Q)
-
-            # VOLUME SENSOR
-            elif len(self.sensor_dims) == 3:
-                if self._expansion_limit == 'octupole':
-                    self.Q = np.empty(0)
-                    raise ValueError('Octupole expansion_limit for volume sensors not implemented')
-                self.sus_mod.multipole_Bz_sus(self.particle_positions, self.scan_positions,
-                                              self.Q, self._N_cols,
-                                              *self.sensor_dims,
-                                              mp_order[self.expansion_limit]
-                                              )
-                volm = 1 / (8 * self.sensor_dims[0] * self.sensor_dims[1] * self.sensor_dims[2])
-                # Convert volume flux to average flux per sensor
-                np.multiply(self.Q, volm, out=self.Q)
+                    raise
+                LOGGER.warning(f'The {backend.name} method failed ({e}). Trying next method')
             else:
-                raise ValueError('Wrong sensor dimensions')
+                self.forward_backend = backend.name
+                break
+
+        if layout != self.Q_layout:
+            LOGGER.info(f'Rearranging forward matrix columns into the {self.Q_layout} layout')
+            Q_interleaved = self.Q
+            self.Q = np.empty_like(Q_interleaved)
+            self.Q[:, self.multipole_column_indices().reshape(-1)] = Q_interleaved
+            del Q_interleaved
+
+        # Convert area flux to average flux per sensor
+        if geometry == 'area':
+            aream = 1 / (4 * sensor_dims[0] * sensor_dims[1])
+            np.multiply(self.Q, aream, out=self.Q, casting='unsafe')
+        # Convert volume flux to average flux per sensor
+        elif geometry == 'volume':
+            volm = 1 / (8 * sensor_dims[0] * sensor_dims[1] * sensor_dims[2])
+            np.multiply(self.Q, volm, out=self.Q, casting='unsafe')
+
+        # The multipole terms of order l scale as 1 / r^(l + 2)
+        if length_scale == 1.:
+            self.Q_col_scale = None
         else:
-            raise ValueError(f'Optimization {optimization} not valid')
+            self.Q_col_scale = np.empty(self.Q.shape[1])
+            idx = self.multipole_column_indices()
+            for l in range(1, order + 1):
+                self.Q_col_scale[idx[:, fwb.order_columns(l)].reshape(-1)] = length_scale ** (l + 2)
 
         t1 = time.time()
         LOGGER.info(f'Generation of Q matrix took: {t1 - t0:.4f} s')
         # print('Q shape:', Q.shape)
 
 
+    def generate_kernel_table(self,
+                              tol: float = 1e-6,
+                              max_lateral: Optional[float] = None,
+                              dz_range: Optional[tuple] = None,
+                              filename: Optional[Union[str, Path]] = None,
+                              **build_kwargs):
+        """Tabulate the susceptibility kernels for the `table` method
+
+        The entries of the forward matrix, for the susceptibility module,
+        expansion limit and sensor dimensions of this inversion, are
+        tabulated as a function of the sensor-particle displacement, with a
+        relative interpolation error below `tol` at randomly sampled
+        displacements (see `KernelTable.build`). The table is stored in the
+        `kernel_table` variable and the sampled error estimate in
+        `kernel_table.max_rel_error`. Only area and volume sensors are
+        tabulated.
+
+        Parameters
+        ----------
+        tol
+            Target relative error of the interpolated entries
+        max_lateral
+            Largest lateral displacement (in metres) covered by the table. By
+            default, the largest displacement between the sensors and the
+            particles of this inversion
+        dz_range
+            Smallest and largest vertical distance (in metres) covered by the
+            table. By default, the range of this inversion
+        filename
+            If specified, the table is saved in this `npz` file, which can be
+            loaded with `load_kernel_table`
+        build_kwargs
+            Extra arguments for `KernelTable.build`
+        """
+        geometry = fwb.SENSOR_GEOMETRIES.get(len(self.sensor_dims))
+        if not fwb.BACKENDS['table'].supports(self.sus_functions_module, geometry,
+                                              fwb.multipole_order(self.expansion_limit)):
+            raise ValueError('Kernel tables are only used for area and volume sensors '
+                             'up to the octupole')
+
+        r_sensors = self.scan_positions
+        if max_lateral is None:
+            max_lateral = np.max(np.maximum(
+                r_sensors[:, :2].max(axis=0) - self.particle_positions[:, :2].min(axis=0),
+                self.particle_positions[:, :2].max(axis=0) - r_sensors[:, :2].min(axis=0)))
+        if dz_range is None:
+            dz_range = (r_sensors[:, 2].min() - self.particle_positions[:, 2].max(),
+                        r_sensors[:, 2].max() - self.particle_positions[:, 2].min())
+
+        t0 = time.time()
+        self.kernel_table = KernelTable.build(self.sus_functions_module,
+                                              fwb.multipole_order(self.expansion_limit),
+                                              self.sensor_dims, max_lateral, dz_range,
+                                              tol=tol, **build_kwargs)
+        LOGGER.info(f'Kernel table with {self.kernel_table.values.size} entries and max '
+                    f'relative error {self.kernel_table.max_rel_error:.3e} took '
+                    f'{time.time() - t0:.4f} s')
+        if filename is not None:
+            self.kernel_table.save(filename)
+
+    def load_kernel_table(self, filename: Union[str, Path]):
+        """Load a kernel table saved by `generate_kernel_table`"""
+        self.kernel_table = KernelTable.load(filename)
+        LOGGER.info(f'Loaded kernel table with max relative error '
+                    f'{self.kernel_table.max_rel_error:.3e}')
+
+    def generate_forward_derivatives(self, second_order: bool = False):
+        """Derivatives of the forward matrix with respect to the sensor positions
+
+        Computes the `Q_derivatives` array, with shape
+        `3 x N_sensors x (N_particles * N_multipoles)`, where `Q_derivatives[a]`
+        is the derivative of the forward matrix in SI units (`Q * Q_col_scale`)
+        with respect to the coordinate `a` (`x`, `y` or `z`) of the sensors,
+        with the columns in the same layout as `Q`. Since every entry depends
+        on the displacement between a sensor and a particle, the derivatives
+        with respect to the position of particle `i` are the columns
+        `-Q_derivatives[a][:, idx[i]]`, with `idx` from
+        `multipole_column_indices`. The derivatives are computed analytically
+        and are only implemented for point sensors in the
+        `spherical_harmonics_basis` (see
+        `forward_backends.kernel_gradient_columns`)
+
+        Parameters
+        ----------
+        second_order
+            Also compute the `Q_second_derivatives` array, with shape
+            `6 x N_sensors x (N_particles * N_multipoles)`, with the second
+            derivatives with respect to the pairs of coordinates in
+            `forward_backends.HESSIAN_PAIRS`. The second derivatives with
+            respect to the particle positions have the same sign
+        """
+        if len(self.sensor_dims) > 0 or self.sensor_psf is not None:
+            raise ValueError('Derivatives of the forward matrix are only implemented for point sensors')
+        t0 = time.time()
+        order = fwb.multipole_order(self.expansion_limit)
+        derivatives = [('Q_derivatives', fwb.kernel_gradient_columns)]
+        if second_order:
+            derivatives.append(('Q_second_derivatives', fwb.kernel_hessian_columns))
+        for name, kernel in derivatives:
+            dQ = kernel(self.sus_functions_module, order,
+                        self.particle_positions, self.scan_positions)
+            if self.Q_layout == 'order_blocked':
+                dQ_blocked = np.empty_like(dQ)
+                dQ_blocked[:, :, self.multipole_column_indices().reshape(-1)] = dQ
+                dQ = dQ_blocked
+            setattr(self, name, dQ)
+        LOGGER.info(f'Generation of the Q derivatives took: {time.time() - t0:.4f} s')
+
+    def _forward_matrix_si(self, apply_field_mask: bool = False) -> np.ndarray:
+        """Double precision copy of the forward matrix in SI units"""
+        Qmatrix = self.get_forward_submatrix(self.expansion_limit, apply_field_mask=apply_field_mask)
+        Qmatrix = np.array(Qmatrix, dtype=np.float64)
+        if self.Q_col_scale is not None:
+            Qmatrix *= self.Q_col_scale
+        return Qmatrix
+
+    def _shift_sensors(self, dx: float, dy: float, dz: float):
+        """Move all the sensors, updating the scan height and sensor origin"""
+        self.sensor_origin_x += dx
+        self.sensor_origin_y += dy
+        self.Hz += dz
+        positions = self._explicit_scan_positions()
+        self.generate_measurement_mesh()
+        if positions is not None:
+            self._scan_positions = positions + np.array([dx, dy, dz])
+
+    def calibrate_sensor_offsets(self,
+                                 apply_field_mask: bool = False,
+                                 max_iterations: int = 20,
+                                 max_rebuilds: int = 4,
+                                 xtol: float = 1e-12,
+                                 **forward_matrix_kwargs) -> dict:
+        """Calibrate the scan height and the sensor origin against the data
+
+        The offsets `(dx, dy, dz)` of the sensors, which update
+        `sensor_origin_x`, `sensor_origin_y` and `Hz`, are optimised with
+        Gauss-Newton iterations on the misfit `|Bz - Q m|`, where the
+        moments `m` are the least squares solution for the current offsets
+        (variable projection). In the iterations the forward matrix is not
+        rebuilt but extrapolated to first order from the derivatives with
+        respect to the sensor positions (see `generate_forward_derivatives`):
+
+            Q(dx, dy, dz) = Q + dx dQ/dx + dy dQ/dy + dz dQ/dz
+
+        and the Jacobian of the residual with respect to the offset `a` is
+        `-(I - P) dQ/da m`, with `P` the projection onto the columns of `Q`.
+        After the iterations the forward matrix and its derivatives are
+        rebuilt at the new offsets, and the iterations are repeated if the
+        sensors moved more than `xtol`. Only point sensors in the
+        `spherical_harmonics_basis` are supported. Call `compute_inversion`
+        afterwards to obtain the moments with the calibrated sensors.
+
+        Parameters
+        ----------
+        apply_field_mask
+            Only use the sensors labeled as `True` in the `fieldMask` array
+        max_iterations
+            Maximum number of Gauss-Newton iterations per rebuild of `Q`
+        max_rebuilds
+            Maximum number of times the forward matrix is rebuilt
+        xtol
+            The iterations stop when the offset update is smaller than this
+            length (in metres)
+        **forward_matrix_kwargs
+            Parameters of `generate_forward_matrix`, e.g. `optimization`
+
+        Returns
+        -------
+        dict
+            Dictionary with the calibrated `Hz`, `sensor_origin_x` and
+            `sensor_origin_y`, the total `offset` (`dx, dy, dz`) with respect
+            to the initial values, the `residual_norm` of every iteration and
+            the number of forward matrix builds `n_rebuilds`. The dictionary
+            is also stored in the `sensor_calibration` variable
+        """
+        Bzdata = self._Bz_array.reshape(-1)
+        mask = self.fieldMask.reshape(-1) if apply_field_mask else slice(None)
+        Bzdata = Bzdata[mask]
+        offset = np.zeros(3)
+        residual_norms = []
+        converged = False
+
+        for rebuild in range(max_rebuilds):
+            self.generate_forward_matrix(**forward_matrix_kwargs)
+            self.generate_forward_derivatives()
+            Q0 = self._forward_matrix_si(apply_field_mask)
+            dQ = self.Q_derivatives[:, mask]
+            norms = np.linalg.norm(Q0, axis=0)
+            norms[norms == 0.] = 1.
+
+            shift = np.zeros(3)
+            for k in range(max_iterations):
+                Qmatrix = Q0 + np.tensordot(shift, dQ, axes=1)
+                U, R = slin.qr(Qmatrix / norms, mode='economic', overwrite_a=True)
+                UtB = np.dot(U.T, Bzdata)
+                moments = slin.solve_triangular(R, UtB) / norms
+                residual = Bzdata - np.dot(U, UtB)
+                residual_norms.append(np.linalg.norm(residual))
+
+                J = np.column_stack([np.dot(dQ[a], moments) for a in range(3)])
+                J -= np.dot(U, np.dot(U.T, J))
+                step = np.linalg.lstsq(J, residual, rcond=None)[0]
+                shift += step
+                LOGGER.info(f'Sensor calibration iteration {k}: residual norm = '
+                            f'{residual_norms[-1]:.6e}, offset update = {step}')
+                if np.linalg.norm(step) < xtol:
+                    break
+
+            self._shift_sensors(*shift)
+            offset += shift
+            if np.linalg.norm(shift) < xtol:
+                converged = True
+                break
+
+        if not converged:
+            LOGGER.warning('The sensor calibration did not converge')
+            self.generate_forward_matrix(**forward_matrix_kwargs)
+            self.generate_forward_derivatives()
+
+        self.sensor_calibration = dict(Hz=self.Hz,
+                                       sensor_origin_x=self.sensor_origin_x,
+                                       sensor_origin_y=self.sensor_origin_y,
+                                       offset=offset,
+                                       residual_norm=np.array(residual_norms),
+                                       n_rebuilds=rebuild + 1 + (not converged))
+        return self.sensor_calibration
+
+    def refine_particle_positions(self,
+                                  z_only: bool = False,
+                                  apply_field_mask: bool = False,
+                                  max_iterations: int = 50,
+                                  damping: float = 1e-3,
+                                  xtol: float = 1e-12,
+                                  num_threads: int = 0) -> dict:
+        """Refine the particle positions jointly with the multipole moments
+
+        The positions (or only their `z` coordinates if `z_only` is `True`)
+        and the moments are fitted to the scan data with Levenberg-Marquardt
+        iterations on the misfit `|Bz - Q(positions) m|`, starting from the
+        least squares moments at the current `particle_positions`. The
+        Jacobian with respect to the moments is the forward matrix, and the
+        Jacobian with respect to the position of particle `i` has only three
+        columns, the derivatives of its field `Q[:, idx[i]] m[i]`, which are
+        computed analytically in blocks per particle (see
+        `forward_backends.kernel_position_jacobian`) with the sensors
+        distributed across `num_threads` threads. Hence every iteration costs
+        one evaluation of the kernels and their gradients, instead of the
+        `3 N_particles` forward matrices of a finite difference Jacobian. The
+        columns of the Jacobian are scaled to unit norm and the damping
+        parameter is updated from the gain ratio of every step (Nielsen's
+        strategy). Only point sensors in the `spherical_harmonics_basis` are
+        supported.
+
+        The refined positions replace `particle_positions`, which resets `Q`,
+        and the fitted moments and field are stored in
+        `inv_multipole_moments` and `inv_Bz_array`.
+
+        Parameters
+        ----------
+        z_only
+            Only refine the depth of the particles
+        apply_field_mask
+            Only use the sensors labeled as `True` in the `fieldMask` array
+        max_iterations
+            Maximum number of Levenberg-Marquardt steps (accepted or rejected)
+        damping
+            Initial damping parameter, relative to the (unit) diagonal of the
+            scaled normal matrix
+        xtol
+            The iterations stop when no particle moves more than this length
+            (in metres) in a step
+        num_threads
+            Number of threads to evaluate the kernels, all by default
+
+        Returns
+        -------
+        dict
+            Dictionary with the refined `positions`, the `displacement` of
+            every particle from the initial positions, the `residual_norm` of
+            every accepted step, the number of kernel evaluations
+            `n_evaluations` and whether the iterations `converged`. The
+            dictionary is also stored in the `position_refinement` variable
+        """
+        if len(self.sensor_dims) > 0 or self.sensor_psf is not None:
+            raise ValueError('The position refinement is only implemented for point sensors')
+        order = fwb.multipole_order(self.expansion_limit)
+        N, n_cols = self.N_particles, self._N_cols
+        rows = self.fieldMask.reshape(-1) if apply_field_mask else slice(None)
+        r_sensors = self.scan_positions[rows]
+        Bzdata = self._Bz_array.reshape(-1)[rows]
+        dims = [2] if z_only else [0, 1, 2]
+        initial_positions = np.array(self.particle_positions, dtype=np.float64)
+        positions = initial_positions.copy()
+
+        def evaluate(positions, moments):
+            Bz, J = fwb.kernel_position_jacobian(self.sus_functions_module, order,
+                                                 positions, r_sensors,
+                                                 moments.reshape(N, n_cols), num_threads)
+            return Bzdata - Bz, J[:, :, dims].reshape(len(Bzdata), -1)
+
+        # Initial moments (interleaved, in SI units)
+        Q = fwb.kernel_columns(self.sus_functions_module, order, positions, r_sensors)
+        norms = np.linalg.norm(Q, axis=0)
+        norms[norms == 0.] = 1.
+        moments = slin.lstsq(Q / norms, Bzdata)[0] / norms
+        residual, Jp = evaluate(positions, moments)
+        cost = np.dot(residual, residual)
+        residual_norms = [np.sqrt(cost)]
+        n_evaluations = 1
+
+        mu, nu = damping, 2.
+        converged, accepted = False, True
+        for k in range(max_iterations):
+            if accepted:
+                if k > 0:
+                    Q = fwb.kernel_columns(self.sus_functions_module, order, positions, r_sensors)
+                J = np.concatenate((Q, Jp), axis=1)
+                norms = np.linalg.norm(J, axis=0)
+                norms[norms == 0.] = 1.
+                J /= norms
+                A = np.dot(J.T, J)
+                g = np.dot(J.T, residual)
+                del J
+
+            scaled_step = slin.solve(A + mu * np.eye(len(A)), g, assume_a='pos')
+            step = scaled_step / norms
+            trial_moments = moments + step[:N * n_cols]
+            trial_positions = positions.copy()
+            trial_positions[:, dims] += step[N * n_cols:].reshape(N, len(dims))
+            trial_residual, trial_Jp = evaluate(trial_positions, trial_moments)
+            trial_cost = np.dot(trial_residual, trial_residual)
+            n_evaluations += 1
+
+            # Gain ratio: actual over predicted reduction of the cost
+            predicted = np.dot(scaled_step, mu * scaled_step + g)
+            gain = (cost - trial_cost) / predicted if predicted > 0. else -1.
+            accepted = gain > 0.
+            if accepted:
+                positions, moments = trial_positions, trial_moments
+                residual, Jp, cost = trial_residual, trial_Jp, trial_cost
+                residual_norms.append(np.sqrt(cost))
+                mu *= max(1. / 3., 1. - (2. * gain - 1.) ** 3)
+                nu = 2.
+            else:
+                mu *= nu
+                nu *= 2.
+
+            max_shift = np.abs(step[N * n_cols:]).max()
+            LOGGER.info(f'Position refinement step {k}: residual norm = {np.sqrt(cost):.6e}, '
+                        f'max displacement = {max_shift:.4e}, damping = {mu:.3e}, '
+                        f'accepted = {accepted}')
+            if max_shift < xtol:
+                converged = True
+                break
+
+        if not converged:
+            LOGGER.warning('The position refinement did not converge')
+
+        self.particle_positions = positions
+        self.Q = np.empty(0)
+        self.Q_derivatives = None
+        self.Q_second_derivatives = None
+        self.forward_operator = None
+        self.inv_multipole_moments = moments.reshape(N, n_cols)
+        Bz_model, _ = fwb.kernel_position_jacobian(self.sus_functions_module, order,
+                                                   positions, self.scan_positions,
+                                                   self.inv_multipole_moments, num_threads)
+        self.inv_Bz_array = Bz_model.reshape(self.Ny_surf, self.Nx_surf)
+
+        self.position_refinement = dict(positions=positions,
+                                        displacement=positions - initial_positions,
+                                        residual_norm=np.array(residual_norms),
+                                        n_evaluations=n_evaluations,
+                                        converged=converged)
+        return self.position_refinement
+
+    def propagate_position_uncertainty(self,
+                                       sigma_position: Union[float, np.ndarray],
+                                       n_samples: int = 200,
+                                       taylor_order: Literal[1, 2] = 1,
+                                       apply_field_mask: bool = False,
+                                       seed: Optional[int] = None,
+                                       quantiles: tuple = (0.025, 0.5, 0.975),
+                                       batch_size: int = 64,
+                                       tol: float = 1e-10,
+                                       max_iterations: int = 50) -> dict:
+        """Monte Carlo propagation of the particle position errors to the moments
+
+        Draws `n_samples` random displacements of the particles, with
+        normally distributed coordinates of standard deviation
+        `sigma_position`, and computes the least squares moments for every
+        displaced sample. The forward matrix is not rebuilt for the samples
+        but expanded to first or second order in the displacements `d` from
+        the derivatives of `Q` (see `generate_forward_derivatives`), which
+        are computed once::
+
+            Q(d)[:, idx[i]] = Q[:, idx[i]] - sum_a d[i, a] dQ_a[:, idx[i]]
+                              + 1/2 sum_ab d[i, a] d[i, b] d2Q_ab[:, idx[i]]
+
+        The products with the expanded matrices are computed from the
+        cached matrices without forming them. Every sample is solved with
+        CGLS iterations preconditioned with the `R` factor of the QR
+        factorization of the (unperturbed, column scaled) forward matrix,
+        computed once, which converge in a few iterations since the
+        displacements are small corrections to `Q`. The samples are
+        processed in batches of `batch_size`, solved together with matrix
+        products (which run in parallel in the BLAS library). Only point
+        sensors in the `spherical_harmonics_basis` are supported.
+
+        Low-rank updates of the factorization are not used because, when
+        all the particles are displaced, every column of `Q` changes and
+        the update `Q(d) - Q` has full rank `P` (the number of columns).
+        Updating the QR factors with it costs `O(N_sensors P^2)` per sample,
+        as much as a new factorization. A CGLS iteration instead costs a
+        product with `Q` and with the 3 first (plus 6 second) derivative
+        matrices and with their transposes, `O(N_sensors P)` each, plus two
+        triangular solves with `R`, `O(P^2)`. Hence a sample costs
+        `O(k N_sensors P)` for `k` iterations, and `k` is usually much
+        smaller than `P`. The factorization, `O(N_sensors P^2)`, is computed
+        once. The number of iterations of every batch is logged.
+
+        Parameters
+        ----------
+        sigma_position
+            Standard deviation of the position errors in metres: a float, a
+            length 3 array with the deviation of every coordinate (e.g. zero
+            for `x` and `y` to only perturb the depth), or a
+            `N_particles x 3` array
+        n_samples
+            Number of Monte Carlo samples
+        taylor_order
+            Order of the expansion of `Q` in the displacements
+        apply_field_mask
+            Only use the sensors labeled as `True` in the `fieldMask` array
+        seed
+            Seed of the random number generator
+        quantiles
+            Quantiles of the moment distributions
+        batch_size
+            Number of samples solved together
+        tol
+            Tolerance of the CGLS iterations, relative to the residual norm
+        max_iterations
+            Maximum number of CGLS iterations
+
+        Returns
+        -------
+        dict
+            Dictionary with the `displacements` of the particles in every
+            sample (`n_samples x N_particles x 3` array), the moments of every
+            sample in `samples` (`n_samples x N_particles x N_multipoles`
+            array, in SI units), their `mean` and `std`, and the requested
+            `quantiles` (`len(quantiles) x N_particles x N_multipoles`). The
+            dictionary is also stored in the `position_uncertainty` variable
+        """
+        if taylor_order not in (1, 2):
+            raise ValueError('The Taylor expansion of Q must be of order 1 or 2')
+        if self.Q.size == 0:
+            LOGGER.info('Generating forward matrix')
+            self.generate_forward_matrix()
+        if (self.Q_derivatives is None or self.Q_derivatives.shape[1] != self.N_sensors
+                or (taylor_order == 2 and self.Q_second_derivatives is None)):
+            self.generate_forward_derivatives(second_order=taylor_order == 2)
+
+        N = self.N_particles
+        rows = self.fieldMask.reshape(-1) if apply_field_mask else slice(None)
+        Bzdata = self._Bz_array.reshape(-1)[rows]
+        Q0 = self._forward_matrix_si(apply_field_mask)
+        # Derivatives with respect to the particle positions
+        dQ = -self.Q_derivatives[:, rows]
+        d2Q = self.Q_second_derivatives[:, rows] if taylor_order == 2 else None
+        idx = self.multipole_column_indices()
+        particle = np.empty(idx.size, dtype=int)
+        particle[idx] = np.arange(N)[:, np.newaxis]
+
+        # Factorization of the column scaled forward matrix, used as the
+        # right preconditioner: Q m = (Q / norms R^-1) y, with y = R norms m
+        norms = np.linalg.norm(Q0, axis=0)
+        norms[norms == 0.] = 1.
+        U, R = slin.qr(Q0 / norms, mode='economic')
+        y0 = np.dot(U.T, Bzdata)
+        del U
+
+        def to_moments(y):
+            return slin.solve_triangular(R, y) / norms[:, np.newaxis]
+
+        def from_residual(r):
+            return slin.solve_triangular(R, r / norms[:, np.newaxis], trans='T')
+
+        sigma = np.broadcast_to(np.asarray(sigma_position, dtype=np.float64), (N, 3))
+        rng = np.random.default_rng(seed)
+        displacements = rng.normal(size=(n_samples, N, 3)) * sigma
+        samples = np.empty((n_samples, N, self._N_cols))
+
+        for start in range(0, n_samples, batch_size):
+            d = displacements[start:start + batch_size]
+            # Coefficients of the derivative matrices for every column and sample
+            c1 = d[:, particle].transpose(2, 1, 0)
+            if taylor_order == 2:
+                c2 = np.array([(0.5 if a == b else 1.) * c1[a] * c1[b]
+                               for a, b in fwb.HESSIAN_PAIRS])
+
+            def matvec(m):
+                out = np.dot(Q0, m)
+                for a in range(3):
+                    out += np.dot(dQ[a], c1[a] * m)
+                if taylor_order == 2:
+                    for k in range(6):
+                        out += np.dot(d2Q[k], c2[k] * m)
+                return out
+
+            def rmatvec(r):
+                out = np.dot(Q0.T, r)
+                for a in range(3):
+                    out += c1[a] * np.dot(dQ[a].T, r)
+                if taylor_order == 2:
+                    for k in range(6):
+                        out += c2[k] * np.dot(d2Q[k].T, r)
+                return out
+
+            # Block CGLS, with a column per sample, from the unperturbed solution
+            y = np.repeat(y0[:, np.newaxis], len(d), axis=1)
+            residual = Bzdata[:, np.newaxis] - matvec(to_moments(y))
+            s = from_residual(rmatvec(residual))
+            p = s.copy()
+            gamma = np.sum(s * s, axis=0)
+            for k in range(max_iterations):
+                if np.all(np.sqrt(gamma) <= tol * np.linalg.norm(residual, axis=0)):
+                    break
+                q = matvec(to_moments(p))
+                q_norm2 = np.sum(q * q, axis=0)
+                alpha = np.divide(gamma, q_norm2, out=np.zeros_like(gamma), where=q_norm2 > 0.)
+                y += alpha * p
+                residual -= alpha * q
+                s = from_residual(rmatvec(residual))
+                gamma_new = np.sum(s * s, axis=0)
+                beta = np.divide(gamma_new, gamma, out=np.zeros_like(gamma), where=gamma > 0.)
+                p = s + beta * p
+                gamma = gamma_new
+            else:
+                LOGGER.warning(f'CGLS did not converge for the samples {start}-{start + len(d)}')
+            LOGGER.info(f'Samples {start}-{start + len(d)} solved in {k} CGLS iterations')
+
+            samples[start:start + len(d)] = to_moments(y).T[:, idx]
+
+        self.position_uncertainty = dict(displacements=displacements,
+                                         samples=samples,
+                                         mean=samples.mean(axis=0),
+                                         std=samples.std(axis=0),
+                                         quantiles=np.quantile(samples, quantiles, axis=0))
+        return self.position_uncertainty
+
+    def _noise_field(self,
+                     rng: np.random.Generator,
+                     sigma: float,
+                     correlation_length: Optional[float] = None) -> np.ndarray:
+        """Random noise on the scan grid, with the shape of `Bz_array`
+
+        Uncorrelated noise if `correlation_length` is `None`, otherwise
+        Gaussian noise with covariance `sigma^2 exp(-d^2 / (2 l^2))` between
+        sensors at a distance `d`, obtained by convolving white noise with a
+        Gaussian kernel of width `l / sqrt(2)`. The white noise is sampled in
+        a grid extended by the kernel size, so that the standard deviation
+        does not decrease at the edges of the scan
+        """
+        shape = (self.Ny_surf, self.Nx_surf)
+        if correlation_length is None:
+            return rng.normal(scale=sigma, size=shape)
+        if self._explicit_scan_positions() is not None:
+            raise ValueError('Correlated noise requires sensors in the regular scan grid')
+
+        def gaussian(step):
+            width = correlation_length / (np.sqrt(2.) * step)
+            u = np.arange(-int(np.ceil(4 * width)), int(np.ceil(4 * width)) + 1)
+            return np.exp(-0.5 * (u / width) ** 2)
+
+        kernel = np.outer(gaussian(self.Sdy), gaussian(self.Sdx))
+        # Unit norm, hence the variance of the convolution is sigma^2
+        kernel /= np.linalg.norm(kernel)
+        white = rng.normal(scale=sigma, size=(shape[0] + kernel.shape[0] - 1,
+                                              shape[1] + kernel.shape[1] - 1))
+        return ssig.fftconvolve(white, kernel, mode='valid')
+
+    def bootstrap_noise(self,
+                        sigma_field_noise: float,
+                        n_samples: int = 500,
+                        correlation_length: Optional[float] = None,
+                        apply_field_mask: bool = False,
+                        seed: Optional[int] = None,
+                        quantiles: tuple = (0.025, 0.5, 0.975),
+                        batch_size: int = 256) -> dict:
+        """Moment distributions of the inversion of noisy scan data
+
+        Adds `n_samples` random noise fields to `Bz_array`, as in
+        `MagneticSample.generate_noised_Bz_array`, and computes the least
+        squares moments of every noisy field. The forward matrix (with
+        scaled columns) is factorized once, `Q = U R`, and the fields are
+        solved together, in batches of `batch_size`, as the multiple right
+        hand sides of `R m = U^T Bz`. Every noise field is sampled from its
+        own random stream, spawned from `seed`, so that the samples are
+        reproducible and do not depend on the `batch_size`. Unlike the
+        covariance of `compute_inversion`, the noise can be spatially
+        correlated. Only the inversion of the full forward matrix `Q` is
+        supported.
+
+        Parameters
+        ----------
+        sigma_field_noise
+            Standard deviation of the noise, in the units of `Bz_array`
+        n_samples
+            Number of noise fields
+        correlation_length
+            If specified, the noise is correlated between sensors, with the
+            covariance `sigma^2 exp(-d^2 / (2 l^2))` for sensors at a
+            distance `d`, where `l` is the `correlation_length` in metres.
+            Requires sensors in the regular scan grid
+        apply_field_mask
+            Only use the sensors labeled as `True` in the `fieldMask` array
+        seed
+            Seed of the random streams
+        quantiles
+            Quantiles of the moment distributions
+        batch_size
+            Number of noise fields solved together
+
+        Returns
+        -------
+        dict
+            Dictionary with the moments of every noise field in `samples`
+            (`n_samples x N_particles x N_multipoles` array, in SI units),
+            their `mean` and `std`, and the requested `quantiles`
+            (`len(quantiles) x N_particles x N_multipoles`). The dictionary
+            is also stored in the `noise_bootstrap` variable
+        """
+        if self.Q.size == 0:
+            LOGGER.info('Generating forward matrix')
+            self.generate_forward_matrix()
+
+        rows = self.fieldMask.reshape(-1) if apply_field_mask else slice(None)
+        Bzdata = self._Bz_array.reshape(-1)[rows]
+        Qmatrix = self._forward_matrix_si(apply_field_mask)
+        norms = np.linalg.norm(Qmatrix, axis=0)
+        norms[norms == 0.] = 1.
+        Qmatrix /= norms
+        U, R = slin.qr(Qmatrix, mode='economic', overwrite_a=True)
+        del Qmatrix
+
+        idx = self.multipole_column_indices()
+        generators = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_samples)]
+        samples = np.empty((n_samples, self.N_particles, self._N_cols))
+
+        t0 = time.time()
+        for start in range(0, n_samples, batch_size):
+            batch = generators[start:start + batch_size]
+            fields = np.empty((len(Bzdata), len(batch)))
+            for k, rng in enumerate(batch):
+                noise = self._noise_field(rng, sigma_field_noise, correlation_length)
+                fields[:, k] = Bzdata + noise.reshape(-1)[rows]
+            solution = slin.solve_triangular(R, np.dot(U.T, fields)) / norms[:, np.newaxis]
+            samples[start:start + len(batch)] = solution.T[:, idx]
+        LOGGER.info(f'Bootstrap of {n_samples} noise fields took: {time.time() - t0:.4f} s')
+
+        self.noise_bootstrap = dict(samples=samples,
+                                    mean=samples.mean(axis=0),
+                                    std=samples.std(axis=0),
+                                    quantiles=np.quantile(samples, quantiles, axis=0))
+        return self.noise_bootstrap
+
+    def generate_forward_operator(self,
+                                  operator: _OperatorOptions = 'fft',
+                                  **operator_kwargs):
+        """Generate a matrix-free representation of the forward matrix
+
+        The operator computes the products of the forward matrix and its
+        transpose with vectors without storing `Q`. It is stored in the
+        `forward_operator` variable and used by `compute_inversion` with the
+        `fft_lsqr` and `hmatrix_lsqr` methods.
+
+        Parameters
+        ----------
+        operator
+            `fft`: the particles are assigned to depth layers (with the
+            kernel interpolated in depth) that are convolved with the field
+            kernel on a fine grid, using FFTs. The products cost
+            `O(L M log M)` operations, with `M` the number of nodes of the
+            fine grid and `L` the number of layers. The sensors must be in the regular
+            `sensor_grid`. See `forward_operators.FFTForwardOperator`.
+            `hmatrix`: hierarchical matrix where the blocks coupling distant
+            clusters of sensors and particles are compressed into low rank
+            factors. Memory and products scale almost linearly with the
+            problem size, and an approximate factorization is available. See
+            `forward_operators.HMatrixForwardOperator`
+        **operator_kwargs
+            Parameters of the operator class, which control its accuracy.
+            For `fft`: `upsampling`, `interp_order`, `depth_tol` and
+            `depth_order`. For
+            `hmatrix`: `leaf_size`, `eta` and `tol`
+        """
+        t0 = time.time()
+        self.forward_operator = _OPERATORS[operator](self, **operator_kwargs)
+        LOGGER.info(f'Generation of the forward operator took: {time.time() - t0:.4f} s')
+
     def generate_field_mask(self, fieldMaskTool: Union[Callable[[np.ndarray], bool], np.ndarray, str, Path]):
         """Creates a mask array for the Bz field array
 
@@ -452,19 +1631,37 @@ class MultipoleInversion(object):
         self.fieldMask.astype(bool)
 
 
+    def generate_proximity_mask(self,
+                                radius: float,
+                                particles: Optional[np.ndarray] = None):
+        """Mask the sensors that are far from the particles
+
+        Sets the `fieldMask` array to `True` for the sensors within a distance
+        `radius` (in metres) of any of the `particles` (indices, by default
+        all of them), and `False` otherwise. The sensors are found with the
+        `spatial_index`
+        """
+        mask = np.zeros(self.N_sensors, dtype=bool)
+        for sensors in self.spatial_index.sensors_within(radius, particles):
+            mask[sensors] = True
+        self.fieldMask[:] = mask.reshape(self.Ny_surf, self.Nx_surf)
+        LOGGER.info(f'Proximity mask keeps {mask.sum()} of {self.N_sensors} sensors')
+
     def compute_inversion(self,
                           method: _InvMethodOps = 'sp_pinv',
                           apply_field_mask: bool = False,
-                          sigma_field_noise: Optional[float] = None,
+                          sigma_field_noise: Optional[Union[float, np.ndarray]] = None,
+                          refinement_steps: int = 2,
+                          column_scaling: Optional[_ScalingOptions] = None,
                           **method_kwargs
                           ):
         """
         Computes the multipole inversion. Results are saved in the
         `inv_multipole_moments` and `inv_Bz_array` variables. This method
         requires the generation of the `Q` matrix, hence the
-        `generate_forward_matrix` method using `numba` is called if `Q` has not
-        been set. To optimize the calculation of `Q`, call the function before
-        this method.
+        `generate_forward_matrix` method using `numba` is called if `Q` has
+        not been set. To optimize the calculation of `Q`,
+        call the function before this method.
 
         Parameters
         ----------
@@ -474,6 +1671,32 @@ class MultipoleInversion(object):
                 sp_pinv  -> Scipy's pinv (not recommended -> memory issues)
                 sp_pinv2 -> Scipy's pinv2 (this will call sp_pinv instead)
                 direct   -> direct inverse (quickest and most memory efficient)
+                fft_lsqr -> LSQR iterations with the matrix-free FFT forward
+                            operator (see `generate_forward_operator`). `Q`
+                            is not used. The columns are scaled by their
+                            norms and `method_kwargs` are passed to
+                            `scipy.sparse.linalg.lsqr`, e.g. `atol`, `btol`
+                            and `iter_lim`. No covariance matrix is computed
+                hmatrix_lsqr -> as `fft_lsqr` using the hierarchical matrix
+                            forward operator
+                huber_irls -> robust inversion, with outlier sensors down
+                            weighted by iteratively reweighted least squares
+                            with the Huber loss. See `_compute_robust_inversion`
+                            for the `method_kwargs`. The robust weights of
+                            the sensors (which multiply the noise weights if
+                            a noise map is given) are stored in the
+                            `robust_weights` array
+                tukey_irls -> as `huber_irls` with Tukey's biweight loss,
+                            which rejects outliers completely
+                group_lasso -> sparse inversion, where the moments of the
+                            particles without a measurable signal are set
+                            to zero. See `_compute_group_lasso_inversion`
+                            for the `method_kwargs`. The particles with
+                            non-zero moments are labeled in the
+                            `active_particles` array. A noise map weights
+                            the sensors, and with `sigma_field_noise` the
+                            covariance matrix of the debiased moments of the
+                            active particles is computed
         apply_field_mask
             Set `True` if a masking array is used for the magnetic field. The
             mask must be created using the `generate_field_mask` method, which
@@ -483,21 +1706,79 @@ class MultipoleInversion(object):
             If a `float` is specified, a covariance matrix is produced and
             stored in the `covariance_matrix` variable. This matrix uses
             the value of `sigma` as the standard deviation of uncorrelated
-            noise in the magnetic flux field. Units are T m^2. In addition, the
+            noise in the magnetic flux field. Units are T m^2. Rows and columns
+            of the matrix are ordered by particles, i.e. the multipoles of
+            particle 0, then of particle 1, etc. In addition, the
             standard deviation of the magnetic moments are calculated and
             stored in the `inv_moments_std` 2D array where every row has the
             results per grain. For details, see
             [F. Out et al. Geochemistry, Geophysics, Geosystems 23(4). 2022]
+            If an array with the shape of `Bz_array` is specified, with the
+            standard deviation of the noise of every sensor, the inversion
+            is a weighted least squares fit with weights `1 / sigma^2`
+            (sensors with `sigma = inf` are ignored), solved from the QR
+            factorization of the whitened matrix `W^1/2 Q` (see
+            `_compute_weighted_inversion`). The `method`, `column_scaling`
+            and `method_kwargs` options are used as in the unweighted
+            inversion, the `pinv` methods store the weighted pseudo-inverse
+            `(Q^T W Q)^-1 Q^T W` in `IQ`, and the covariance matrix
+            `(Q^T W Q)^-1` is always computed. With the `fft_lsqr` and
+            `hmatrix_lsqr` methods the rows of the forward operator are
+            weighted, and with the IRLS methods the noise weights multiply
+            the robust weights
+        refinement_steps
+            Only used if `Q` is a single precision matrix (see the `dtype`
+            option of `generate_forward_matrix`). The inversion is computed in
+            single precision and the solution is improved by this number of
+            iterative refinement steps, where the residual `Bz - Q m` is
+            computed in double precision and the correction is obtained from
+            the single precision inverse (or factorization). Not used with
+            a noise map, which is inverted in double precision
+        column_scaling
+            Rescale the columns of `Q` before the inversion to improve the
+            conditioning of the system, since the dipole, quadrupole and
+            octupole columns differ by many orders of magnitude. With `column`
+            every column is scaled to unit norm, with `block` the columns of
+            every multipole order of a particle are scaled by the norm of the
+            whole block. The scaling is applied to a working copy of `Q`
+            (which uses as much memory as `Q` unless the field mask is
+            applied), hence `Q` is not modified, and the scaling factors are
+            recorded in the `column_scaling_factors` array. The multipole
+            moments, their standard deviation and the covariance matrix are
+            returned in SI units
         **method_kwargs
             Extra parameters passed to Numpy or Scipy functions. For Numpy, the
             tolerance can be set using `rcond` while for `Scipy` it is
             recommended to use `atol` and `rtol`. See their documentations for
             detailed information.
         """
+        if method in ['fft_lsqr', 'hmatrix_lsqr']:
+            self._compute_operator_inversion(method.split('_')[0], apply_field_mask,
+                                             sensor_sigma=(sigma_field_noise if
+                                                           isinstance(sigma_field_noise, np.ndarray)
+                                                           else None),
+                                             **method_kwargs)
+            return
+
         if self.Q.size == 0:
             LOGGER.info('Generating forward matrix')
             self.generate_forward_matrix()
 
+        if method in ['huber_irls', 'tukey_irls']:
+            self._compute_robust_inversion(method.split('_')[0], apply_field_mask,
+                                           sigma_field_noise, **method_kwargs)
+            return
+
+        if method == 'group_lasso':
+            self._compute_group_lasso_inversion(apply_field_mask, sigma_field_noise,
+                                                column_scaling, **method_kwargs)
+            return
+
+        if isinstance(sigma_field_noise, np.ndarray):
+            self._compute_weighted_inversion(method, apply_field_mask, sigma_field_noise,
+                                             column_scaling, **method_kwargs)
+            return
+
         #idx = np.arange(len(self.Q))
         #if mask is not None:
         #    assert len(mask) == len(self.Q), ('mask has incorrect length, '
@@ -506,8 +1787,6 @@ class MultipoleInversion(object):
 
         # Reshape Bz (without copy!) to pass it to the C/cuda/numba libraries
         # NOTE: This reshape of Bz_array assumes it is using C order in memory (default in np)
-
-
         self._Bz_array.shape = (self.N_sensors,)  # Can also use -1
         if apply_field_mask:
             LOGGER.info('Using field mask from the self.fieldMask array. '
@@ -518,14 +1797,32 @@ class MultipoleInversion(object):
             Qmatrix = self.Q
             Bzdata = self._Bz_array
 
+        if column_scaling is not None:
+            norms = self._column_norms(Qmatrix, column_scaling)
+            # The scaling is applied to a working copy of Q. A masked Q
+            # matrix is already a copy
+            if Qmatrix is self.Q:
+                Qmatrix = np.divide(self.Q, norms, dtype=self.Q.dtype, casting='unsafe')
+            else:
+                np.divide(Qmatrix, norms, out=Qmatrix, casting='unsafe')
+
+        single_precision = self.Q.dtype != np.float64
+        if single_precision:
+            LOGGER.info(f'Using {self.Q.dtype} forward matrix with {refinement_steps} '
+                        'iterative refinement steps')
+
         if method == 'direct':
             LOGGER.info('Using direct inversion')
-            self.inv_multipole_moments, res, rnk, s = slin.lstsq(
-                self.Q, Bzdata, **method_kwargs)
-            self.inv_multipole_moments.shape = (self.N_particles, self._N_cols)
-            # Forward field
-            self.inv_Bz_array = np.matmul(self.Q, self.inv_multipole_moments.reshape(-1))
-            self.inv_Bz_array.shape = (self.Ny_surf, self.Nx_surf)
+            if not single_precision:
+                solution, res, rnk, s = slin.lstsq(Qmatrix, Bzdata, **method_kwargs)
+            else:
+                # Factorize once and reuse the factors in the refinement steps
+                U, R = slin.qr(Qmatrix, mode='economic')
+                solution = self._refine_solution(
+                    Qmatrix, Bzdata,
+                    lambda r: slin.solve_triangular(R, np.dot(U.T, r.astype(U.dtype))),
+                    refinement_steps)
+                del U, R
         else:
             if method == 'np_pinv':
                 LOGGER.info('Using numpy.pinv for inversion')
@@ -542,24 +1839,583 @@ class MultipoleInversion(object):
 
             LOGGER.info('Finished inversion')  # Useful to check calc timing
 
-            self.inv_multipole_moments = np.dot(self.IQ, Bzdata)
-            self.inv_multipole_moments.shape = (self.N_particles, self._N_cols)
-
-            # Forward field
-            self.inv_Bz_array = np.matmul(self.Q, self.inv_multipole_moments.reshape(-1))
-            self.inv_Bz_array.shape = (self.Ny_surf, -1)
-
-            # Generate covariance matrix if sigma not none
-            if isinstance(sigma_field_noise, float):
-                self.covariance_matrix = (sigma_field_noise ** 2) * np.matmul(self.IQ, self.IQ.transpose())
-                # Compute the std deviation in the mag moments solutions
-                self.inv_moments_std = np.sqrt(np.diag(self.covariance_matrix))
-                # Reshape into (N_particles, N_multipoles) matrix
-                self.inv_moments_std.shape = (self.N_particles, -1)
+            if not single_precision:
+                solution = np.dot(self.IQ, Bzdata)
+            else:
+                solution = self._refine_solution(
+                    Qmatrix, Bzdata,
+                    lambda r: np.dot(self.IQ, r.astype(self.IQ.dtype)),
+                    refinement_steps)
+
+        # Solution (and inverse) for the columns of the unscaled Q
+        if column_scaling is not None:
+            solution /= norms
+            if method != 'direct':
+                self.IQ /= norms[:, np.newaxis]
+        del Qmatrix
+
+        # Forward field (using the solution for the columns of Q)
+        self.inv_Bz_array = _matvec(self.Q, solution)
+        self.inv_Bz_array.shape = (self.Ny_surf, self.Nx_surf)
+
+        # Solution in SI units
+        if self.Q_col_scale is not None:
+            solution = solution / self.Q_col_scale
+        self.inv_multipole_moments = self._moments_from_solution(solution)
+
+        # Generate covariance matrix if sigma not none
+        if method != 'direct' and isinstance(sigma_field_noise, numbers.Real):
+            self._set_covariance((sigma_field_noise ** 2) * np.matmul(self.IQ, self.IQ.transpose()).astype(np.float64))
 
         # Assuming that Sx/Sy ranges correspond to the computed sizes for the scanning array
         self._Bz_array.shape = (self.Sy_range.shape[0], -1)
 
+    def _set_covariance(self, covariance: np.ndarray):
+        """Store the covariance matrix of the solution for the columns of `Q`
+
+        Sets the `covariance_matrix` (in SI units, ordered by particles) and
+        the `inv_moments_std` arrays
+        """
+        self.covariance_matrix = covariance
+        if self.Q_col_scale is not None:
+            self.covariance_matrix /= np.outer(self.Q_col_scale, self.Q_col_scale)
+        # Compute the std deviation in the mag moments solutions and
+        # reshape into (N_particles, N_multipoles) matrix
+        self.inv_moments_std = self._moments_from_solution(np.sqrt(np.diag(self.covariance_matrix)))
+        # Order the covariance rows/cols by particles, as in the
+        # interleaved layout
+        if self.Q_layout == 'order_blocked':
+            idx = self.multipole_column_indices().reshape(-1)
+            self.covariance_matrix = self.covariance_matrix[np.ix_(idx, idx)]
+
+    def _sensor_weights(self, sensor_sigma: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Inverse noise variances `1 / sigma^2` of the sensors in `rows`"""
+        sensor_sigma = np.asarray(sensor_sigma, dtype=np.float64)
+        if sensor_sigma.size != self.N_sensors:
+            raise ValueError(f'The noise array must have the shape of Bz_array {self._Bz_array.shape}')
+        sensor_sigma = sensor_sigma.reshape(-1)[rows]
+        if not np.all(sensor_sigma > 0.):
+            raise ValueError('The noise standard deviations must be positive')
+        return 1. / sensor_sigma ** 2
+
+    def _compute_weighted_inversion(self,
+                                    method: _InvMethodOps,
+                                    apply_field_mask: bool,
+                                    sensor_sigma: np.ndarray,
+                                    column_scaling: Optional[_ScalingOptions] = None,
+                                    **method_kwargs):
+        """Weighted least squares inversion with the noise of every sensor
+
+        Solves `min |W^1/2 (Bz - Q m)|` with `W = diag(1 / sigma^2)`. The
+        triangular factor `R` of the QR decomposition of the whitened matrix
+        `W^1/2 Q` is accumulated over blocks of rows of `Q` (see
+        `_weighted_qr`), hence `Q` is not copied and, unlike the normal
+        equations, the condition number of the system is not squared. The
+        `direct` method solves `R m = z` with `scipy.linalg.lstsq` and the
+        `pinv` methods compute the pseudo-inverse `R^+`, with the
+        `method_kwargs`. Since `R` has the singular values of `W^1/2 Q`, the
+        tolerances have the same meaning as in the unweighted inversion. The
+        column scaling factors are the column norms of `R`, i.e. of
+        `W^1/2 Q`. The `pinv` methods store the weighted pseudo-inverse::
+
+            (Q^T W Q)^-1 Q^T W = R^+ R^+^T Q^T W
+
+        in `IQ`, computed by blocks of rows. The covariance matrix
+        `(Q^T W Q)^-1 = R^+ R^+^T` is always computed
+        """
+        if method not in ['direct', 'np_pinv', 'sp_pinv', 'sp_pinv2']:
+            raise ValueError(f'Method {method} not implemented')
+
+        rows = np.arange(self.N_sensors)
+        if apply_field_mask:
+            rows = rows[self.fieldMask.reshape(-1)]
+        weights = self._sensor_weights(sensor_sigma, rows)
+        LOGGER.info('Using weighted least squares with the noise of every sensor')
+        R, z = _weighted_qr(self.Q, np.sqrt(weights), rows, self._Bz_array.reshape(-1)[rows])
+
+        norms = np.ones(len(R))
+        if column_scaling is not None:
+            norms = self._column_norms(R, column_scaling)
+            R /= norms
+
+        if method == 'direct':
+            LOGGER.info('Using direct inversion')
+            solution = slin.lstsq(R, z, **method_kwargs)[0]
+            # Inverse of R, with normalised columns
+            R_norms = np.linalg.norm(R, axis=0)
+            R_norms[R_norms == 0.] = 1.
+            R_inv = slin.solve_triangular(R / R_norms, np.eye(len(R))) / R_norms[:, np.newaxis]
+        else:
+            if method == 'np_pinv':
+                LOGGER.info('Using numpy.pinv for inversion')
+                R_inv = np.linalg.pinv(R, **method_kwargs)
+            else:
+                LOGGER.info('Using scipy.linalg.pinv for inversion')
+                R_inv = slin.pinv(R, **method_kwargs)
+            solution = np.dot(R_inv, z)
+        LOGGER.info('Finished inversion')
+
+        # Solution and covariance for the columns of the unscaled Q
+        solution /= norms
+        covariance = np.dot(R_inv, R_inv.T) / np.outer(norms, norms)
+        if method != 'direct':
+            self.IQ = np.empty((len(R), len(rows)), dtype=self.Q.dtype)
+            for block, Q_block in _row_blocks(self.Q, rows):
+                self.IQ[:, block] = np.dot(covariance, Q_block.T * weights[block])
+        self._set_covariance(covariance)
+
+        self.inv_Bz_array = _matvec(self.Q, solution).reshape(self.Ny_surf, self.Nx_surf)
+
+        # Solution in SI units
+        if self.Q_col_scale is not None:
+            solution = solution / self.Q_col_scale
+        self.inv_multipole_moments = self._moments_from_solution(solution)
+
+    def _compute_robust_inversion(self,
+                                  loss: Literal['huber', 'tukey'] = 'huber',
+                                  apply_field_mask: bool = False,
+                                  sigma_field_noise: Optional[Union[float, np.ndarray]] = None,
+                                  tuning_constant: Optional[float] = None,
+                                  max_iterations: int = 50,
+                                  tol: float = 1e-8,
+                                  weight_tol: float = 1e-2,
+                                  gram_refresh: int = 10):
+        """Robust inversion by iteratively reweighted least squares
+
+        The weighted least squares problem `min |W^1/2 (Bz - Q m)|` is
+        solved repeatedly, with the weights of the sensors obtained from
+        their residuals `u` (in units of the residual scale, estimated from
+        the median absolute residual) with the weight function of the loss:
+        `min(1, c / |u|)` for `huber` and `(1 - (u / c)^2)^2` for `|u| < c`
+        (zero otherwise) for `tukey`. Every iteration solves the (column
+        scaled) normal equations for the correction of the previous moments,
+        `G dm = Q^T W (Bz - Q m)`, with a Cholesky factorization of the small
+        matrix `G`, an approximation of the weighted Gram matrix `Q^T W Q`.
+        `G` is only updated with the rows whose weights changed by more than
+        `weight_tol` (relative) since they were added to `G`, e.g. the
+        outliers of the Huber loss, and recomputed from scratch every
+        `gram_refresh` iterations, or when more than half of the rows
+        changed (as with the Tukey loss). Since the right-hand side uses the
+        exact weights, the approximation only slows down the convergence
+        and the solution is the weighted least squares solution with the
+        final weights. `Q` is not copied.
+
+        If `sigma_field_noise` is specified, the covariance of the moments
+        is computed with the final weights (sandwich estimator)::
+
+            (Q^T W Q)^-1 Q^T W S W Q (Q^T W Q)^-1
+
+        where `S` is the diagonal matrix with the noise variances. If
+        `sigma_field_noise` is an array with the noise of every sensor, the
+        residuals are standardised by `sigma` and the robust weights are
+        multiplied by `1 / sigma^2`
+
+        Parameters
+        ----------
+        loss
+            `huber` or `tukey`
+        apply_field_mask, sigma_field_noise
+            See `compute_inversion`
+        tuning_constant
+            Tuning constant `c` of the loss. By default 1.345 for `huber`
+            and 4.685 for `tukey`
+        max_iterations
+            Maximum number of reweighting iterations
+        tol
+            The iterations stop when the largest correction of the (scaled)
+            moments is smaller than `tol` times the largest moment
+        weight_tol
+            Relative change of the weight of a sensor that updates its row in
+            the Gram matrix
+        gram_refresh
+            Number of iterations between full recalculations of the Gram
+            matrix, which remove the accumulated approximation and round-off
+        """
+        if loss not in _ROBUST_LOSSES:
+            raise ValueError(f'Robust loss {loss} not implemented')
+        weight_function, default_constant = _ROBUST_LOSSES[loss]
+        c = default_constant if tuning_constant is None else tuning_constant
+
+        rows = np.arange(self.N_sensors)
+        if apply_field_mask:
+            rows = rows[self.fieldMask.reshape(-1)]
+        Bzdata = self._Bz_array.reshape(-1)[rows]
+
+        if isinstance(sigma_field_noise, np.ndarray):
+            noise_weights = self._sensor_weights(sigma_field_noise, rows)
+        else:
+            noise_weights = np.ones(len(rows))
+        # Robust weights of the sensors, which multiply the noise weights
+        psi = np.ones(len(rows))
+        weights = noise_weights.copy()
+        # Weights of the rows in the Gram matrix
+        gram_weights = weights.copy()
+        G = _weighted_gram(self.Q, weights, rows)
+        norms = np.sqrt(np.diag(G))
+        norms[norms == 0.] = 1.
+        solution = np.zeros(self.Q.shape[1])
+        residual = Bzdata.copy()
+        LOGGER.info(f'Using IRLS with the {loss} loss for inversion')
+
+        for k in range(max_iterations):
+            cho = slin.cho_factor(G / np.outer(norms, norms))
+            step = slin.cho_solve(cho, _rmatvec(self.Q, weights * residual, rows) / norms)
+            solution += step / norms
+            residual = Bzdata - _matvec(self.Q, solution)[rows]
+
+            step_norm = np.abs(step).max() / max(np.abs(solution * norms).max(), 1e-300)
+            standardised = residual * np.sqrt(noise_weights)
+            scale = np.median(np.abs(standardised[noise_weights > 0.])) / 0.6745
+            LOGGER.info(f'IRLS iteration {k}: residual scale = {scale:.6e}, '
+                        f'relative step = {step_norm:.3e}')
+            if step_norm < tol or scale == 0.:
+                break
+            if k == max_iterations - 1:
+                LOGGER.warning('The IRLS iterations did not converge')
+                break
+            psi = weight_function(standardised / scale, c)
+            weights = noise_weights * psi
+            changed = np.flatnonzero(np.abs(weights - gram_weights)
+                                     > weight_tol * np.maximum(weights, gram_weights))
+            if (k + 1) % gram_refresh == 0 or len(changed) > len(rows) // 2:
+                G = _weighted_gram(self.Q, weights, rows)
+                gram_weights = weights.copy()
+            elif len(changed) > 0:
+                # Update the Gram matrix with the rows whose weights changed
+                G += _weighted_gram(self.Q, weights[changed] - gram_weights[changed], rows[changed])
+                gram_weights[changed] = weights[changed]
+            LOGGER.debug(f'IRLS iteration {k}: {len(changed)} rows with new weights')
+
+        self.robust_weights = np.zeros(self.N_sensors)
+        self.robust_weights[rows] = psi
+        self.robust_weights.shape = (self.Ny_surf, self.Nx_surf)
+        self.inv_Bz_array = _matvec(self.Q, solution).reshape(self.Ny_surf, self.Nx_surf)
+
+        if sigma_field_noise is not None:
+            if np.any(gram_weights != weights):
+                G = _weighted_gram(self.Q, weights, rows)
+                cho = slin.cho_factor(G / np.outer(norms, norms))
+            G_inv = slin.cho_solve(cho, np.diag(1. / norms)) / norms[:, np.newaxis]
+            if isinstance(sigma_field_noise, np.ndarray):
+                meat = _weighted_gram(self.Q, noise_weights * psi ** 2, rows)
+            else:
+                meat = (sigma_field_noise ** 2) * _weighted_gram(self.Q, weights ** 2, rows)
+            self._set_covariance(G_inv @ meat @ G_inv)
+
+        # Solution in SI units
+        if self.Q_col_scale is not None:
+            solution = solution / self.Q_col_scale
+        self.inv_multipole_moments = self._moments_from_solution(solution)
+
+    def _compute_group_lasso_inversion(self,
+                                       apply_field_mask: bool = False,
+                                       sigma_field_noise: Optional[Union[float, np.ndarray]] = None,
+                                       column_scaling: Optional[_ScalingOptions] = None,
+                                       regularization: Union[float, np.ndarray] = 1e-2,
+                                       n_path: int = 10,
+                                       max_iterations: int = 2000,
+                                       tol: float = 1e-8,
+                                       debias: bool = True):
+        """Group sparse inversion with the moments of every particle as a group
+
+        Solves the group lasso problem::
+
+            min 1/2 |W^1/2 (Bz - Q m)|^2 + λ sum_i |D m_i|
+
+        where `m_i` are the moments of particle `i`, `W = diag(1 / sigma^2)`
+        if `sigma_field_noise` is a noise map (the identity otherwise) and
+        `D` scales the columns of `W^1/2 Q` to unit norm (or, with the
+        `block` column scaling, the columns of every multipole order of a
+        particle by the norm of the block), so that the penalty does not
+        depend on the units of the multipole orders. Hence the moments of a particle
+        are either all zero or all active. The problem is solved with FISTA
+        (accelerated proximal gradient) iterations with adaptive restarts,
+        which only require products with `Q` and `Q^T`, for a geometric
+        sequence of `λ` from `λ_max`, the smallest value for which all the
+        moments are zero, to `regularization * λ_max`. Every problem is
+        warm-started from the solution of the previous `λ`. The moments of
+        the last `λ` are stored in `inv_multipole_moments`; with `debias`,
+        they are re-fitted by least squares using only the columns of the
+        active particles, which removes the shrinkage of the penalty.
+
+        The particles with non-zero moments are labeled in the
+        `active_particles` array and the solutions of the path are stored in
+        the `group_lasso_path` dictionary, with the `regularization` values
+        (relative to `λ_max`), the `moments` (`n_path x N_particles x
+        N_multipoles`, in SI units, not debiased) and the `n_active`
+        particles of every `λ`.
+
+        If `sigma_field_noise` is specified, the covariance matrix of the
+        debiased moments is computed, for the (fixed) set of active
+        particles. The rows and columns of the inactive particles are zero.
+
+        Parameters
+        ----------
+        apply_field_mask, sigma_field_noise
+            See `compute_inversion`. The covariance requires `debias`
+        column_scaling
+            `column` (the default if `None`) or `block`, see
+            `compute_inversion`
+        regularization
+            Smallest `λ / λ_max` of the path. If an array is given, it is
+            used as the (decreasing) sequence of relative `λ` values
+        n_path
+            Number of `λ` values of the path
+        max_iterations
+            Maximum number of FISTA iterations per `λ`
+        tol
+            The iterations stop when the largest update of the (scaled)
+            moments is smaller than `tol` times the largest moment
+        debias
+            Re-fit the moments of the active particles by least squares
+        """
+        if sigma_field_noise is not None and not debias:
+            raise ValueError('The covariance matrix requires the debiased moments')
+
+        rows = np.arange(self.N_sensors)
+        if apply_field_mask:
+            rows = rows[self.fieldMask.reshape(-1)]
+        idx = self.multipole_column_indices()
+        if isinstance(sigma_field_noise, np.ndarray):
+            weights = self._sensor_weights(sigma_field_noise, rows)
+        else:
+            weights = np.ones(len(rows))
+        sqrt_weights = np.sqrt(weights)
+        # Whitened data
+        Bzdata = self._Bz_array.reshape(-1)[rows] * sqrt_weights
+
+        norms = self._column_norms(None, 'column' if column_scaling is None else column_scaling,
+                                   squared_norms=_column_sums_of_squares(self.Q, weights, rows))
+
+        def matvec(x):
+            return _matvec(self.Q, x / norms)[rows] * sqrt_weights
+
+        def rmatvec(y):
+            return _rmatvec(self.Q, y * sqrt_weights, rows) / norms
+
+        def prox(x, threshold):
+            group_norms = np.linalg.norm(x[idx], axis=1)
+            shrink = np.maximum(0., 1. - threshold / np.maximum(group_norms, 1e-300))
+            out = np.empty_like(x)
+            out[idx] = x[idx] * shrink[:, np.newaxis]
+            return out
+
+        # Lipschitz constant of the gradient, |Q D^-1|^2, by power iterations
+        v = np.random.default_rng(0).normal(size=self.Q.shape[1])
+        for k in range(50):
+            w = rmatvec(matvec(v))
+            lipschitz = np.linalg.norm(w) / np.linalg.norm(v)
+            v = w
+        lipschitz *= 1.05
+
+        lambda_max = np.linalg.norm(rmatvec(Bzdata)[idx], axis=1).max()
+        if np.ndim(regularization) == 0:
+            path = np.geomspace(1., regularization, n_path)
+        else:
+            path = np.asarray(regularization, dtype=np.float64)
+        LOGGER.info(f'Using group lasso with lambda_max = {lambda_max:.6e} '
+                    f'and {len(path)} regularization values')
+
+        x = np.zeros(self.Q.shape[1])
+        path_moments = np.empty((len(path), self.N_particles, self._N_cols))
+        n_active = np.empty(len(path), dtype=int)
+        for j, relative_lambda in enumerate(path):
+            threshold = relative_lambda * lambda_max / lipschitz
+            y, t = x.copy(), 1.
+            for k in range(max_iterations):
+                x_new = prox(y - rmatvec(matvec(y) - Bzdata) / lipschitz, threshold)
+                step = x_new - x
+                # Restart the momentum if it points uphill
+                if np.dot(y - x_new, step) > 0.:
+                    t = 1.
+                t_new = 0.5 * (1. + np.sqrt(1. + 4. * t * t))
+                y = x_new + ((t - 1.) / t_new) * step
+                x, t = x_new, t_new
+                if np.abs(step).max() <= tol * max(np.abs(x).max(), 1e-300):
+                    break
+            else:
+                LOGGER.warning(f'FISTA did not converge for lambda = {relative_lambda:.3e} lambda_max')
+            active = np.linalg.norm(x[idx], axis=1) > 0.
+            n_active[j] = active.sum()
+            path_moments[j] = (x / norms)[idx]
+            LOGGER.info(f'lambda = {relative_lambda:.3e} lambda_max: {n_active[j]} active '
+                        f'particles after {k + 1} iterations')
+
+        solution = x / norms
+        self.active_particles = active
+        if debias and active.any():
+            # Least squares with the columns of the active particles only
+            columns = idx[active].reshape(-1)
+            Q_active = self.Q[rows[:, np.newaxis], columns].astype(np.float64)
+            Q_active *= sqrt_weights[:, np.newaxis] / norms[columns]
+            solution = np.zeros(self.Q.shape[1])
+            solution[columns] = slin.lstsq(Q_active, Bzdata)[0] / norms[columns]
+            if sigma_field_noise is not None:
+                R = np.linalg.qr(Q_active, mode='r')
+                R_inv = slin.solve_triangular(R, np.eye(len(R))) / norms[columns, np.newaxis]
+                covariance = np.zeros((self.Q.shape[1], self.Q.shape[1]))
+                covariance[np.ix_(columns, columns)] = np.dot(R_inv, R_inv.T)
+                if not isinstance(sigma_field_noise, np.ndarray):
+                    covariance *= sigma_field_noise ** 2
+                self._set_covariance(covariance)
+            del Q_active
+
+        self.inv_Bz_array = _matvec(self.Q, solution).reshape(self.Ny_surf, self.Nx_surf)
+        # Solution in SI units
+        if self.Q_col_scale is not None:
+            solution = solution / self.Q_col_scale
+            path_moments /= self.Q_col_scale[idx]
+        self.inv_multipole_moments = self._moments_from_solution(solution)
+        self.group_lasso_path = dict(regularization=path, moments=path_moments,
+                                     n_active=n_active)
+
+    def _compute_operator_inversion(self,
+                                    operator: _OperatorOptions = 'fft',
+                                    apply_field_mask: bool = False,
+                                    sensor_sigma: Optional[np.ndarray] = None,
+                                    **lsqr_kwargs):
+        """Least squares inversion with LSQR and the forward operator
+
+        If the noise of every sensor is given in `sensor_sigma`, the rows of
+        the operator and the data are weighted by `1 / sigma`
+        """
+        if not isinstance(self.forward_operator, _OPERATORS[operator]):
+            LOGGER.info('Generating forward operator')
+            self.generate_forward_operator(operator)
+        op = self.forward_operator
+
+        rows = np.arange(self.N_sensors)
+        if apply_field_mask:
+            rows = rows[self.fieldMask.reshape(-1)]
+        Bzdata = self._Bz_array.reshape(-1)[rows]
+        row_scale = 1.
+        if sensor_sigma is not None:
+            row_scale = np.sqrt(self._sensor_weights(sensor_sigma, rows))
+            Bzdata = Bzdata * row_scale
+
+        # Scale the columns by their norms, which differ by many orders of
+        # magnitude between multipole orders
+        col_scale = op.column_norms()
+        col_scale[col_scale == 0.] = 1.
+
+        def matvec(z):
+            return op.matvec(z.reshape(-1) / col_scale)[rows] * row_scale
+
+        def rmatvec(y):
+            y_full = np.zeros(self.N_sensors)
+            y_full[rows] = y.reshape(-1) * row_scale
+            return op.rmatvec(y_full) / col_scale
+
+        scaled_op = spla.LinearOperator((len(rows), op.shape[1]), matvec=matvec,
+                                        rmatvec=rmatvec, dtype=np.float64)
+        LOGGER.info(f'Using LSQR with the {operator} forward operator for inversion')
+        result = spla.lsqr(scaled_op, Bzdata, **lsqr_kwargs)
+        LOGGER.info(f'LSQR finished after {result[2]} iterations (stop reason {result[1]})')
+
+        solution = result[0] / col_scale
+        self.inv_Bz_array = op.matvec(solution).reshape(self.Ny_surf, self.Nx_surf)
+        self.inv_multipole_moments = self._moments_from_solution(solution)
+
+    def compare_expansion_limits(self,
+                                 apply_field_mask: bool = False,
+                                 sigma_field_noise: Optional[float] = None
+                                 ) -> dict:
+        """Invert the scan data for every multipole order up to the expansion limit
+
+        The forward matrix is generated (or reused) only once, for the
+        `expansion_limit` of the inversion. Since the columns of the lower
+        order multipoles are a subset of `Q`, a single QR factorization of
+        `Q`, with its columns arranged in blocks by multipole order, gives
+        the least squares solutions of all the nested models. For the leading
+        `k` columns of `Q = U R`, the solution is
+        `R[:k, :k]^-1 (U^T Bz)[:k]` and the residual norm is obtained from
+        `|Bz|^2 - |(U^T Bz)[:k]|^2`.
+
+        Parameters
+        ----------
+        apply_field_mask
+            Set `True` to only use the sensors labeled as `True` in the
+            `fieldMask` array
+        sigma_field_noise
+            Standard deviation of the noise in the magnetic flux field. If
+            specified, the information criteria are computed from the
+            chi-squared statistic `RSS / sigma^2`, otherwise the noise variance
+            is estimated from the residuals: `n log(RSS / n)`, with `n` as the
+            number of data points
+
+        Returns
+        -------
+        dict
+            Dictionary with the expansion limits as keys, e.g. `dipole` (or
+            the multipole order for orders larger than 3), and
+            dictionaries as values with the keys: `inv_multipole_moments`
+            (`N_particles x N_multipoles` array), `residual_norm` (2-norm of
+            `Bz - Q m`), `n_params`, `AIC` and `BIC`. The dictionary is also
+            stored in the `nested_inversions` variable
+
+        Notes
+        -----
+        The Akaike and Bayesian information criteria are defined as
+        `AIC = L + 2 k` and `BIC = L + k log(n)` where `L` is the
+        log-likelihood term described above and `k` is the number of
+        multipole moments. Models with smaller scores are preferred.
+        """
+        if self.Q.size == 0:
+            LOGGER.info('Generating forward matrix')
+            self.generate_forward_matrix()
+
+        Bzdata = self._Bz_array.reshape(-1)
+        if apply_field_mask:
+            Bzdata = Bzdata[self.fieldMask.reshape(-1)]
+        n_data = Bzdata.shape[0]
+
+        # Arrange the Q columns in blocks by multipole order (no copy if the
+        # order_blocked layout is used)
+        Qmatrix = self.get_forward_submatrix(self.expansion_limit,
+                                             apply_field_mask=apply_field_mask)
+        col_scale = self.Q_col_scale
+        if self.Q_layout == 'interleaved':
+            order_cols = self.multipole_column_indices()
+            perm = np.empty(order_cols.size, dtype=int)
+            perm[_order_blocked_indices(self.N_particles, self._N_cols).reshape(-1)] = order_cols.reshape(-1)
+            Qmatrix = Qmatrix[:, perm]
+            if col_scale is not None:
+                col_scale = col_scale[perm]
+
+        LOGGER.info('Computing QR factorization of the forward matrix')
+        U, R = slin.qr(Qmatrix, mode='economic', overwrite_a=not np.shares_memory(Qmatrix, self.Q))
+        UtB = np.dot(U.T, Bzdata)
+        del U
+        Bz_norm2 = np.dot(Bzdata, Bzdata)
+
+        self.nested_inversions = {}
+        for order in range(1, fwb.multipole_order(self.expansion_limit) + 1):
+            limit = _EXP_NAMES.get(order, order)
+            n_cols = fwb.n_multipoles(order)
+            k = n_cols * self.N_particles
+            solution = slin.solve_triangular(R[:k, :k], UtB[:k])
+            if col_scale is not None:
+                solution = solution / col_scale[:k]
+            # Residual sum of squares; clip negative values from round-off
+            rss = max(Bz_norm2 - np.dot(UtB[:k], UtB[:k]), 0.)
+
+            if sigma_field_noise is not None:
+                log_lk = rss / sigma_field_noise ** 2
+            else:
+                log_lk = n_data * np.log(rss / n_data)
+
+            self.nested_inversions[limit] = dict(
+                inv_multipole_moments=solution[_order_blocked_indices(self.N_particles, n_cols)],
+                residual_norm=np.sqrt(rss),
+                n_params=k,
+                AIC=log_lk + 2 * k,
+                BIC=log_lk + k * np.log(n_data))
+            LOGGER.info(f'{limit}: residual norm = {np.sqrt(rss):.4e}  '
+                        f'AIC = {self.nested_inversions[limit]["AIC"]:.4e}  '
+                        f'BIC = {self.nested_inversions[limit]["BIC"]:.4e}')
+
+        return self.nested_inversions
+
     def save_multipole_moments(self,
                                save_name: str = 'TIME_STAMP',
                                basedir: Union[Path, str] = '.',
@@ -0,0 +1,205 @@
+# Gauss-Legendre integration of the point-sensor susceptibility kernels over
+# the sensors. The closed-form antiderivatives of the `_area` and `_volume`
+# modules are limited to the orders generated by `_kernel_codegen.py`; here
+# the flux of any multipole order of the spherical harmonics basis is
+# integrated numerically over rectangular (area) or cuboid (volume) sensors,
+# e.g. a slab with the thickness of the NV layer under a pixel.
+#
+# The Gauss-Legendre nodes and weights of every rule are precomputed. For
+# every sensor-particle pair the number of nodes along a sensor dimension is
+# chosen from the distance between the sensor and the particle: the kernel
+# is analytic in the sensor coordinates except at the complex positions of
+# the particle, so the n-point rule converges as `rho^(-2n)`, where `rho`
+# is the Bernstein ellipse through the singularity (Trefethen, Approximation
+# Theory and Approximation Practice, Ch. 19), times a power of `n` that
+# grows with the order of the pole. The error is measured relative to the
+# largest entry of the column, which decays with the distance as the dipole
+# field. Far sensors are integrated with a single node, i.e. the
+# point kernel at the sensor centre.
+import numpy as np
+import numba
+
+from .susceptibility_modules import spherical_harmonics_basis as shb
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+
+# Largest number of nodes along a sensor dimension
+MAX_NODES = 32
+
+
+def gauss_legendre_rules(max_nodes: int = MAX_NODES) -> tuple:
+    """Nodes and weights of the Gauss-Legendre rules with up to `max_nodes`
+
+    Returns two `(max_nodes + 1) x max_nodes` arrays, where the row `n` has
+    the nodes in `[-1, 1]` (weights) of the `n`-point rule, padded with
+    zeros
+    """
+    nodes = np.zeros((max_nodes + 1, max_nodes))
+    weights = np.zeros((max_nodes + 1, max_nodes))
+    for n in range(1, max_nodes + 1):
+        nodes[n, :n], weights[n, :n] = np.polynomial.legendre.leggauss(n)
+    return nodes, weights
+
+
+_NODES, _WEIGHTS = gauss_legendre_rules()
+
+
+@numba.jit(nopython=True)
+def _n_nodes(a, b, h, decay, power, tol, max_nodes):
+    """Number of nodes to integrate along a sensor half length `h`
+
+    `a` is the displacement of the particle along the integration axis and
+    `b` its distance to the axis, hence the kernel is singular at
+    `t = (a +- i b) / h` in the reference interval `[-1, 1]`. The error of
+    the `n`-point rule is estimated as `100 n^power decay rho^(-2n)`
+    """
+    if h == 0.:
+        return 1
+    # Close to the integration axis the two conjugate poles act as a pole
+    # of twice the order
+    if b < h:
+        power *= 2
+    # Bernstein ellipse through the singularity: rho + 1 / rho = S
+    ta, tb = a / h, b / h
+    S = np.sqrt((ta - 1.) ** 2 + tb ** 2) + np.sqrt((ta + 1.) ** 2 + tb ** 2)
+    rho2 = (0.5 * S + np.sqrt(max(0.25 * S * S - 1., 0.))) ** 2
+    # Far sensors
+    if 100. * decay <= tol * rho2:
+        return 1
+    n = 2
+    error = 100. * decay * 2. ** power / (rho2 * rho2)
+    while error > tol and n < max_nodes:
+        error *= ((n + 1.) / n) ** power / rho2
+        n += 1
+    return n
+
+
+@numba.jit(nopython=True)
+def _integrate_point_kernel(r_sources, r_sensors, half_lengths, multipole_order,
+                            nodes, weights, tol, Q, columns):
+    """Populate `Q[i, columns[p]]` with the flux integrated in the sensors
+
+    Returns the total number of kernel evaluations
+    """
+    L = multipole_order
+    c = shb._bz_normalisation(L)
+    re = np.zeros((L + 2, L + 2))
+    im = np.zeros((L + 2, L + 2))
+    re[0, 0] = 1.
+    n_cols = columns.shape[1]
+    out = np.zeros(n_cols)
+    # The kernels of order L have poles of order (L + 2) / 2, which slow
+    # down the convergence by a power of the number of nodes
+    power = 0.5 * (L + 2)
+    max_nodes = nodes.shape[1]
+    hx, hy, hz = half_lengths[0], half_lengths[1], half_lengths[2]
+    # Weight factors of the rules in [-h, h]. Dimensions without length have
+    # one node with weight 2 at the centre, which must not be scaled
+    sx = hx if hx > 0 else 0.5
+    sy = hy if hy > 0 else 0.5
+    sz = hz if hz > 0 else 0.5
+    # The errors of the integrated dimensions add up
+    n_dims = (hx > 0) + (hy > 0) + (hz > 0)
+    h2_max = max(hx, hy, hz) ** 2
+    n_evaluations = 0
+
+    for i in range(len(r_sensors)):
+        for p in range(len(r_sources)):
+            dx = r_sensors[i, 0] - r_sources[p, 0]
+            dy = r_sensors[i, 1] - r_sources[p, 1]
+            dz = r_sensors[i, 2] - r_sources[p, 2]
+            d2 = dx * dx + dy * dy + dz * dz
+            # The dipole field decays as 1 / r^3 from the closest sensors
+            q = dz * dz / d2
+            decay = n_dims * q * np.sqrt(q)
+            # Closest distances to the particle across the sensor
+            ex = max(abs(dx) - hx, 0.)
+            ey = max(abs(dy) - hy, 0.)
+            ez = max(abs(dz) - hz, 0.)
+            # Far sensors: since rho > distance / h along every dimension,
+            # the point kernel at the centre is accurate enough
+            if 100. * decay * h2_max <= tol * (ex * ex + ey * ey + ez * ez):
+                nx, ny, nz = 1, 1, 1
+            else:
+                nx = _n_nodes(dx, np.sqrt(ey * ey + ez * ez), hx, decay, power, tol, max_nodes)
+                ny = _n_nodes(dy, np.sqrt(ex * ex + ez * ez), hy, decay, power, tol, max_nodes)
+                nz = _n_nodes(dz, np.sqrt(ex * ex + ey * ey), hz, decay, power, tol, max_nodes)
+            n_evaluations += nx * ny * nz
+
+            for k in range(n_cols):
+                out[k] = 0.
+            for a in range(nx):
+                x = dx + nodes[nx, a] * hx
+                wx = weights[nx, a] * sx
+                for b in range(ny):
+                    y = dy + nodes[ny, b] * hy
+                    wxy = wx * weights[ny, b] * sy
+                    for e in range(nz):
+                        z = dz + nodes[nz, e] * hz
+                        r2 = x * x + y * y + z * z
+                        shb._solid_harmonics(x, y, z, r2, L + 1, re, im)
+                        # Point kernel, see `multipole_Bz_sus` (written here
+                        # since function calls with arrays are slow in numba)
+                        inv_r2 = 1. / r2
+                        f = wxy * weights[nz, e] * sz * 1e-7 * inv_r2 * inv_r2 / np.sqrt(r2)
+                        out[0] += f * c[1, 1] * re[2, 1]
+                        out[1] += f * c[1, 1] * im[2, 1]
+                        out[2] += f * c[1, 0] * re[2, 0]
+                        for l in range(2, L + 1):
+                            f *= inv_r2
+                            col = l * l - 1
+                            out[col] += f * c[l, 0] * re[l + 1, 0]
+                            for m in range(1, l + 1):
+                                out[col + 2 * m - 1] += f * c[l, m] * re[l + 1, m]
+                                out[col + 2 * m] += f * c[l, m] * im[l + 1, m]
+            for k in range(n_cols):
+                Q[i, columns[p, k]] = out[k]
+
+    return n_evaluations
+
+
+def integrate_point_kernel(r_sources: np.ndarray,
+                           r_sensors: np.ndarray,
+                           sensor_dims: tuple,
+                           multipole_order: int,
+                           Q: np.ndarray,
+                           columns: np.ndarray,
+                           tol: float = 1e-6) -> int:
+    """Integrate the point-sensor kernels over rectangular or cuboid sensors
+
+    Fills `Q[i, columns[p]]` with the Bz flux of the multipoles of the
+    particle `p`, in the spherical harmonics basis, integrated over the
+    sensor `i` (not averaged, as the `_area` and `_volume` modules).
+
+    Parameters
+    ----------
+    r_sources, r_sensors
+        Positions of the particles and of the sensor centres
+    sensor_dims
+        Half lengths of the sensors: `(hx, hy)` for area sensors or
+        `(hx, hy, hz)` for volume sensors
+    multipole_order
+        Highest multipole order
+    Q
+        Forward matrix
+    columns
+        `N_particles x N_multipoles` array with the column indices of every
+        particle, see `MultipoleInversion.multipole_column_indices`
+    tol
+        Relative accuracy of the quadrature, with respect to the largest
+        entry of every column
+
+    Returns
+    -------
+    int
+        Number of evaluations of the point kernel
+    """
+    half_lengths = np.zeros(3)
+    half_lengths[:len(sensor_dims)] = sensor_dims
+    return _integrate_point_kernel(np.ascontiguousarray(r_sources, dtype=np.float64),
+                                   np.ascontiguousarray(r_sensors, dtype=np.float64),
+                                   half_lengths, multipole_order, _NODES, _WEIGHTS,
+                                   tol, Q, columns)
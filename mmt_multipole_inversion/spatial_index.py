@@ -0,0 +1,106 @@
+# Spatial index over the magnetic particles and the sensors of a scan
+# surface. Geometric queries, e.g. the sensors within a cut-off radius of
+# the particles or the particles in a tile of the scan surface, are answered
+# with KD-trees from `scipy.spatial` instead of comparing all the pairs of
+# positions. All the queries accept batches of particles or points.
+import numpy as np
+import scipy.spatial as ss
+from typing import Optional
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+
+
+class SpatialIndex(object):
+    """KD-tree index of the particle and sensor positions
+
+    Parameters
+    ----------
+    particle_positions
+        `N_particles x 3` array with the positions of the particles
+    sensor_positions
+        `N_sensors x 3` array with the positions of the sensors
+    """
+
+    def __init__(self,
+                 particle_positions: np.ndarray,
+                 sensor_positions: np.ndarray) -> None:
+        self.particle_positions = np.array(particle_positions, dtype=np.float64)
+        self.sensor_positions = np.array(sensor_positions, dtype=np.float64)
+        self.particle_tree = ss.cKDTree(self.particle_positions)
+        self.sensor_tree = ss.cKDTree(self.sensor_positions)
+        # Index of the lateral particle positions, for queries in the scan plane
+        self.particle_tree_xy = ss.cKDTree(self.particle_positions[:, :2])
+
+    def sensors_within(self, radius: float,
+                       particles: Optional[np.ndarray] = None) -> list:
+        """Sensors within a distance `radius` of the particles
+
+        Returns a list with an array of sensor indices for every particle in
+        `particles` (all of them by default)
+        """
+        if particles is None:
+            particles = np.arange(len(self.particle_positions))
+        neighbours = self.sensor_tree.query_ball_point(self.particle_positions[particles],
+                                                       radius, return_sorted=True)
+        return [np.array(n, dtype=np.int64) for n in neighbours]
+
+    def particles_within(self, points: np.ndarray, radius: float) -> list:
+        """Particles within a distance `radius` of every point of `points`
+
+        `points` is an `n x 3` array. Returns a list of `n` arrays with
+        particle indices
+        """
+        neighbours = self.particle_tree.query_ball_point(np.atleast_2d(points), radius,
+                                                         return_sorted=True)
+        return [np.array(n, dtype=np.int64) for n in neighbours]
+
+    def particles_in_tile(self, x_lim: tuple, y_lim: tuple) -> np.ndarray:
+        """Particles whose lateral position is in the rectangle `x_lim x y_lim`"""
+        centre = np.array([np.mean(x_lim), np.mean(y_lim)])
+        half_sizes = np.array([x_lim[1] - x_lim[0], y_lim[1] - y_lim[0]]) / 2
+        candidates = np.array(self.particle_tree_xy.query_ball_point(
+            centre, half_sizes.max(), p=np.inf), dtype=np.int64)
+        inside = np.all(np.abs(self.particle_positions[candidates, :2] - centre)
+                        <= half_sizes, axis=1)
+        return np.sort(candidates[inside])
+
+    def nearest_particles(self, k: int,
+                          particles: Optional[np.ndarray] = None) -> tuple:
+        """`k` nearest neighbours of the particles (excluding themselves)
+
+        Returns
+        -------
+        tuple
+            `(distances, indices)` arrays of shape `n x k`, with `n` the
+            number of `particles` (all of them by default). Missing neighbours
+            have an infinite distance and the index `N_particles`
+        """
+        if particles is None:
+            particles = np.arange(len(self.particle_positions))
+        distances, indices = self.particle_tree.query(self.particle_positions[particles],
+                                                      k=k + 1)
+        distances.shape = indices.shape = (len(particles), k + 1)
+        # Remove the particle itself, which is not necessarily the first
+        # result if several particles share its position
+        not_self = indices != np.asarray(particles)[:, np.newaxis]
+        keep = np.cumsum(not_self, axis=1) <= k
+        keep &= not_self
+        distances = distances[keep].reshape(len(particles), k)
+        indices = indices[keep].reshape(len(particles), k)
+        return distances, indices
+
+    def sensor_particle_pairs(self, radius: float) -> tuple:
+        """All the pairs of sensors and particles closer than `radius`
+
+        Returns
+        -------
+        tuple
+            `(sensors, particles)` arrays of indices, sorted by particle
+        """
+        pairs = self.particle_tree.query_ball_tree(self.sensor_tree, radius)
+        particles = np.repeat(np.arange(len(pairs)), [len(p) for p in pairs])
+        sensors = np.concatenate([np.sort(p) for p in pairs] + [np.empty(0)]).astype(np.int64)
+        return sensors, particles
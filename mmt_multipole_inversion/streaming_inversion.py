@@ -0,0 +1,220 @@
+# Streaming multipole inversion of scans that are acquired row by row, e.g.
+# by scanning magnetometers that take hours to map a sample. The least
+# squares solution is updated with every new block of sensors, using the
+# geometry (particles, multipole basis and sensor grid) of a
+# MultipoleInversion instance, so that the moments are available while the
+# scan is running and no inversion of the full forward matrix is needed when
+# it finishes.
+#
+# The recursive least squares problem is solved with QR row updates of the
+# augmented triangular factor
+#
+#     [R  z]          [R  z]
+#     [0  ρ]  <-  qr  [0  ρ]
+#                     [Q_new  Bz_new]
+#
+# where `R` is the triangular factor of the forward matrix of all the
+# ingested sensors, `z` the rotated data and `ρ` the residual norm. Only the
+# rows of `Q` of the new sensors are generated, and the cost of an update is
+# `O((P + k) P^2)` for `k` new sensors and `P` unknowns, independent of the
+# number of sensors ingested before. Unlike the covariance form of recursive
+# least squares, the QR update is numerically stable.
+import numpy as np
+import scipy.linalg as slin
+from typing import Optional
+
+from . import forward_backends as fwb
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+
+
+class StreamingInversion(object):
+    """Recursive least squares inversion of a scan acquired row by row
+
+    The particles, multipole expansion, susceptibility module and sensors
+    are taken from a `MultipoleInversion` instance, whose `Bz_array` is not
+    used. The rows of the forward matrix are generated for every new block
+    of sensors with the numba kernels (see
+    `forward_backends.kernel_columns`), with the moments of every particle
+    in consecutive columns (the `interleaved` layout). Sensors with a
+    point-spread function are not supported.
+
+    Parameters
+    ----------
+    inversion
+        `MultipoleInversion` instance with the geometry of the problem
+    apply_field_mask
+        Ignore the sensors labeled as `False` in the `fieldMask` array of
+        the inversion
+    sigma_field_noise
+        Standard deviation of the noise of the sensors, used for the
+        covariance matrix. If `None`, the covariance is not computed
+
+    Examples
+    --------
+    Ingest the scan rows as they are measured::
+
+        stream = StreamingInversion(inversion)
+        for Bz_row in scan:
+            stream.add_scan_rows(Bz_row)
+            moments = stream.inv_multipole_moments
+    """
+
+    def __init__(self,
+                 inversion,
+                 apply_field_mask: bool = False,
+                 sigma_field_noise: Optional[float] = None) -> None:
+        if inversion.sensor_psf is not None:
+            raise ValueError('Sensors with a point-spread function are not supported')
+        self.sus_functions_module = inversion.sus_functions_module
+        self.multipole_order = fwb.multipole_order(inversion.expansion_limit)
+        self.particle_positions = np.array(inversion.particle_positions, dtype=np.float64)
+        self.sensor_dims = tuple(inversion.sensor_dims)
+        self.scan_positions = np.array(inversion.scan_positions)
+        self.Nx_surf, self.Ny_surf = inversion.Nx_surf, inversion.Ny_surf
+        self.sensor_mask = None
+        if apply_field_mask:
+            self.sensor_mask = np.array(inversion.fieldMask, dtype=bool).reshape(-1)
+        self.sigma_field_noise = sigma_field_noise
+
+        self.N_particles = len(self.particle_positions)
+        self.N_cols = fwb.n_multipoles(self.multipole_order)
+        n = self.N_particles * self.N_cols
+        # Augmented triangular factor [R z; 0 ρ]
+        self._Rz = np.zeros((n + 1, n + 1))
+        self.n_sensors = 0
+        self.next_row = 0
+        # Scan rows ingested by add_scan_rows
+        self.ingested_rows = np.zeros(self.Ny_surf, dtype=bool)
+        # Solution and covariance of the ingested sensors, until the next update
+        self._solution_cache = None
+        self._covariance_cache = None
+
+    @property
+    def R(self) -> np.ndarray:
+        """Triangular factor of the forward matrix of the ingested sensors"""
+        return self._Rz[:-1, :-1]
+
+    @property
+    def residual_norm(self) -> float:
+        """Norm of the residual of the least squares fit of the ingested data"""
+        return abs(self._Rz[-1, -1])
+
+    def add_sensors(self, positions: np.ndarray, Bz: np.ndarray):
+        """Update the inversion with the data of new sensors
+
+        Parameters
+        ----------
+        positions
+            `k x 3` array with the positions of the new sensors
+        Bz
+            Array with the `k` measurements of the new sensors
+        """
+        positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+        Bz = np.asarray(Bz, dtype=np.float64).reshape(-1)
+        if len(positions) != len(Bz):
+            raise ValueError('The number of positions and measurements must be the same')
+        if len(Bz) == 0:
+            return
+
+        rows = np.empty((len(Bz), self._Rz.shape[1]))
+        rows[:, :-1] = fwb.kernel_columns(self.sus_functions_module, self.multipole_order,
+                                          self.particle_positions, positions, self.sensor_dims)
+        rows[:, -1] = Bz
+        # Householder QR of the stacked factor and new rows. The last
+        # diagonal entry of the new factor accumulates the residual norm
+        R_new = slin.qr(np.vstack((self._Rz, rows)), mode='r', overwrite_a=True)[0]
+        self._Rz = R_new[:len(self._Rz)]
+        self.n_sensors += len(Bz)
+        self._solution_cache = None
+        self._covariance_cache = None
+
+    def add_scan_rows(self, Bz_rows: np.ndarray, first_row: Optional[int] = None):
+        """Update the inversion with the data of new rows of the scan grid
+
+        Parameters
+        ----------
+        Bz_rows
+            `k x Nx` array with the measurements of `k` scan rows
+            (a single row can be passed as a 1D array)
+        first_row
+            Index (along `y`) of the first row of `Bz_rows`. By default the
+            rows follow the last ingested rows. Rows that were already
+            ingested cannot be added again
+        """
+        Bz_rows = np.atleast_2d(np.asarray(Bz_rows, dtype=np.float64))
+        if Bz_rows.shape[1] != self.Nx_surf:
+            raise ValueError(f'The scan rows must have {self.Nx_surf} sensors')
+        if first_row is None:
+            first_row = self.next_row
+        if first_row < 0 or first_row + len(Bz_rows) > self.Ny_surf:
+            raise ValueError(f'Scan rows out of the grid of {self.Ny_surf} rows')
+        scan_rows = slice(first_row, first_row + len(Bz_rows))
+        if self.ingested_rows[scan_rows].any():
+            repeated = first_row + np.flatnonzero(self.ingested_rows[scan_rows])
+            raise ValueError(f'Scan rows {repeated.tolist()} were already ingested')
+
+        sensors = slice(first_row * self.Nx_surf, (first_row + len(Bz_rows)) * self.Nx_surf)
+        positions = self.scan_positions[sensors]
+        Bz = Bz_rows.reshape(-1)
+        if self.sensor_mask is not None:
+            mask = self.sensor_mask[sensors]
+            positions, Bz = positions[mask], Bz[mask]
+        self.add_sensors(positions, Bz)
+        self.ingested_rows[scan_rows] = True
+        self.next_row = first_row + len(Bz_rows)
+        LOGGER.debug(f'Ingested scan rows {first_row}-{self.next_row - 1}: '
+                     f'{self.n_sensors} sensors, residual norm = {self.residual_norm:.6e}')
+
+    def _solution(self) -> np.ndarray:
+        """Least squares solution for the ingested sensors, in Q column order
+
+        The solution is computed once after every update
+        """
+        if self._solution_cache is None:
+            self._solution_cache = self._solve()
+        return self._solution_cache
+
+    def _solve(self) -> np.ndarray:
+        R, z = self.R, self._Rz[:-1, -1]
+        # The column norms of R are the column norms of the forward matrix
+        norms = np.linalg.norm(R, axis=0)
+        norms[norms == 0.] = 1.
+        diagonal = np.abs(np.diag(R)) / norms
+        if self.n_sensors >= len(R) and diagonal.min() > 1e3 * np.finfo(float).eps * diagonal.max():
+            return slin.solve_triangular(R / norms, z) / norms
+        # Not enough sensors yet: minimum norm solution
+        LOGGER.warning('Rank deficient system: using the minimum norm solution')
+        return slin.lstsq(R / norms, z)[0] / norms
+
+    @property
+    def inv_multipole_moments(self) -> np.ndarray:
+        """`N_particles x N_multipoles` array with the moments (SI units)"""
+        return self._solution().reshape(self.N_particles, self.N_cols).copy()
+
+    @property
+    def covariance_matrix(self) -> Optional[np.ndarray]:
+        """Covariance matrix of the moments, `sigma^2 (R^T R)^-1`
+
+        Rows and columns are ordered by particles. `None` if no
+        `sigma_field_noise` was specified
+        """
+        if self.sigma_field_noise is None:
+            return None
+        if self._covariance_cache is None:
+            norms = np.linalg.norm(self.R, axis=0)
+            norms[norms == 0.] = 1.
+            R_inv = slin.solve_triangular(self.R / norms, np.eye(len(self.R))) / norms[:, np.newaxis]
+            self._covariance_cache = (self.sigma_field_noise ** 2) * np.dot(R_inv, R_inv.T)
+        return self._covariance_cache.copy()
+
+    @property
+    def inv_moments_std(self) -> Optional[np.ndarray]:
+        """Standard deviations of the moments, with the shape of the moments"""
+        covariance = self.covariance_matrix
+        if covariance is None:
+            return None
+        return np.sqrt(np.diag(covariance)).reshape(self.N_particles, self.N_cols)
@@ -0,0 +1,171 @@
+# Antiderivatives of the Bz susceptibility polynomials for area and volume
+# sensors. This file is generated by _kernel_codegen.py: do not edit
+import math
+import numpy as np
+import numba
+
+
+@numba.jit(nopython=True)
+def area_flux_antiderivative(x, y, z, multipole_order):
+    """Antiderivative in `x` and `y` of the Bz polynomials, in units of `m^2 / 1e-7`"""
+    n_terms = (multipole_order + 1) ** 2 - 1
+    F = np.zeros((len(x), n_terms))
+    for i in range(len(x)):
+        r = math.sqrt(x[i] ** 2 + y[i] ** 2 + z[i] ** 2)
+        xi, yi, zi = x[i], y[i], z[i]
+        if multipole_order > 0:
+            t1_0 = xi**2
+            t1_1 = zi**2
+            t1_2 = t1_0 + t1_1
+            t1_3 = 1/r
+            t1_4 = t1_3*zi
+            t1_5 = yi**2
+            t1_6 = t1_1 + t1_5
+            F[i, 0] = -t1_4*yi/t1_2
+            F[i, 1] = -t1_4*xi/t1_6
+            F[i, 2] = t1_3*xi*yi*(t1_0 + 2*t1_1 + t1_5)/(t1_2*t1_6)
+        if multipole_order > 1:
+            t2_0 = xi**2
+            t2_1 = yi**4
+            t2_2 = zi**4
+            t2_3 = 11*t2_2
+            t2_4 = xi**4
+            t2_5 = yi**2
+            t2_6 = zi**2
+            t2_7 = 7*t2_6
+            t2_8 = t2_0*t2_5
+            t2_9 = r**(-3)
+            t2_10 = yi/(t2_0 + t2_6)**2
+            t2_11 = xi/(t2_5 + t2_6)**2
+            t2_12 = t2_10*t2_11*t2_9*zi
+            t2_13 = t2_0*t2_6
+            t2_14 = t2_5*t2_6
+            t2_15 = -t2_0*t2_5 + t2_13 + t2_14 + 2*t2_2
+            t2_16 = 0.47140452079103168*t2_9
+            F[i, 3] = 0.40824829046386302*t2_12*(3*t2_0*t2_1 + t2_0*t2_3 + t2_1*t2_7 + t2_3*t2_5 + 3*t2_4*t2_5 + t2_4*t2_7 + 12*t2_6*t2_8 + 2*xi**6 + 2*yi**6 + 6*zi**6)
+            F[i, 4] = t2_10*t2_16*(-t2_15 + t2_4)
+            F[i, 5] = t2_11*t2_16*(t2_1 - t2_15)
+            F[i, 6] = 0.23570226039551584*t2_12*(xi - yi)*(xi + yi)*(2*t2_1 + 7*t2_13 + 7*t2_14 + 5*t2_2 + 2*t2_4 + 5*t2_8)
+            F[i, 7] = t2_16*zi
+        if multipole_order > 2:
+            t3_0 = xi**2
+            t3_1 = yi**10
+            t3_2 = zi**10
+            t3_3 = 72*t3_2
+            t3_4 = xi**4
+            t3_5 = yi**8
+            t3_6 = zi**8
+            t3_7 = 93*t3_6
+            t3_8 = xi**6
+            t3_9 = yi**6
+            t3_10 = zi**6
+            t3_11 = 72*t3_10
+            t3_12 = xi**8
+            t3_13 = yi**4
+            t3_14 = zi**4
+            t3_15 = 33*t3_14
+            t3_16 = xi**10
+            t3_17 = yi**2
+            t3_18 = zi**2
+            t3_19 = 6*t3_18
+            t3_20 = t3_0*t3_17
+            t3_21 = t3_0*t3_13
+            t3_22 = 104*t3_10
+            t3_23 = 36*t3_14
+            t3_24 = t3_0*t3_9
+            t3_25 = 4*t3_18
+            t3_26 = t3_17*t3_4
+            t3_27 = t3_13*t3_4
+            t3_28 = t3_17*t3_8
+            t3_29 = r**(-5)
+            t3_30 = yi/(t3_0 + t3_18)**3
+            t3_31 = xi/(t3_17 + t3_18)**3
+            t3_32 = t3_29*t3_30*t3_31
+            t3_33 = 3*t3_14
+            t3_34 = 12*t3_18
+            t3_35 = 6*t3_10
+            t3_36 = 10*t3_18
+            t3_37 = t3_20*t3_36
+            t3_38 = -t3_35 + t3_37
+            t3_39 = 5*t3_14
+            t3_40 = 2*t3_18
+            t3_41 = -t3_13*t3_40 - t3_17*t3_39 + 6*t3_21 + 15*t3_26
+            t3_42 = t3_29*zi
+            t3_43 = 0.12909944487358056*t3_42
+            t3_44 = -t3_0*t3_39 + 15*t3_21 + 6*t3_26 - t3_4*t3_40
+            t3_45 = 81*t3_6
+            t3_46 = 78*t3_10
+            t3_47 = 87*t3_14
+            t3_48 = 48*t3_18
+            t3_49 = t3_35 + t3_37
+            t3_50 = (1/30)*t3_42
+            F[i, 8] = -0.10540925533894598*t3_32*(2*t3_0*t3_1 - t3_0*t3_25*t3_5 - t3_0*t3_3 - t3_1*t3_19 - t3_11*t3_8 - t3_11*t3_9 + 5*t3_12*t3_13 - t3_12*t3_15 - t3_12*t3_17*t3_25 + 18*t3_13*t3_18*t3_8 - t3_13*t3_7 - 6*t3_14*t3_27 - t3_15*t3_5 + 2*t3_16*t3_17 - t3_16*t3_19 - t3_17*t3_3 + 18*t3_18*t3_4*t3_9 - 146*t3_20*t3_6 - t3_21*t3_22 - t3_22*t3_26 - t3_23*t3_24 - t3_23*t3_28 + 5*t3_4*t3_5 - t3_4*t3_7 + 6*t3_8*t3_9 - 24*zi**12)
+            F[i, 9] = t3_30*t3_43*(-t3_0*t3_33 + t3_34*t3_4 + t3_38 + t3_41 + 9*t3_8)
+            F[i, 10] = t3_31*t3_43*(t3_13*t3_34 - t3_17*t3_33 + t3_38 + t3_44 + 9*t3_9)
+            F[i, 11] = -0.081649658092772603*t3_32*(xi - yi)*(xi + yi)*(-t3_0*t3_45 + 2*t3_0*t3_5 - 156*t3_10*t3_20 + 2*t3_12*t3_17 - t3_12*t3_19 - t3_13*t3_46 + 7*t3_13*t3_8 - t3_15*t3_8 - t3_15*t3_9 - t3_17*t3_45 - t3_19*t3_5 - 30*t3_2 - t3_21*t3_47 - t3_24*t3_36 - t3_26*t3_47 - t3_27*t3_36 - t3_28*t3_36 - t3_4*t3_46 + 7*t3_4*t3_9)
+            F[i, 12] = -0.16329931618554521*t3_29*(t3_0 + t3_17 - t3_40)
+            F[i, 13] = -t3_30*t3_50*(t3_0*t3_15 + t3_4*t3_48 + t3_41 + t3_49 + 21*t3_8)
+            F[i, 14] = t3_31*t3_50*(t3_13*t3_48 + t3_15*t3_17 + t3_44 + t3_49 + 21*t3_9)
+    return F
+
+
+@numba.jit(nopython=True)
+def volume_flux_antiderivative(x, y, z, multipole_order):
+    """Antiderivative in `x`, `y` and `z` of the Bz polynomials, in units of `m^3 / 1e-7`"""
+    n_terms = (multipole_order + 1) ** 2 - 1
+    F = np.zeros((len(x), n_terms))
+    for i in range(len(x)):
+        r = math.sqrt(x[i] ** 2 + y[i] ** 2 + z[i] ** 2)
+        xi, yi, zi = x[i], y[i], z[i]
+        if multipole_order > 0:
+            t1_0 = 1/r
+            F[i, 0] = math.atanh(t1_0*yi)
+            F[i, 1] = math.atanh(t1_0*xi)
+            F[i, 2] = -math.atan2(xi*yi, r*zi)
+        if multipole_order > 1:
+            t2_0 = xi**2
+            t2_1 = yi**2
+            t2_2 = zi**2
+            t2_3 = 1/r
+            t2_4 = yi/(t2_0 + t2_2)
+            t2_5 = xi/(t2_1 + t2_2)
+            t2_6 = t2_3*t2_4*t2_5
+            t2_7 = 0.47140452079103168*t2_3
+            t2_8 = t2_7*zi
+            F[i, 3] = -0.40824829046386302*t2_6*(t2_0 + t2_1 + 2*t2_2)
+            F[i, 4] = t2_4*t2_8
+            F[i, 5] = t2_5*t2_8
+            F[i, 6] = -0.23570226039551584*t2_6*(xi - yi)*(xi + yi)
+            F[i, 7] = -t2_7
+        if multipole_order > 2:
+            t3_0 = xi**2
+            t3_1 = yi**4
+            t3_2 = zi**4
+            t3_3 = 11*t3_2
+            t3_4 = xi**4
+            t3_5 = yi**2
+            t3_6 = zi**2
+            t3_7 = 7*t3_6
+            t3_8 = t3_0*t3_5
+            t3_9 = r**(-3)
+            t3_10 = t3_9*zi
+            t3_11 = yi/(t3_0 + t3_6)**2
+            t3_12 = xi/(t3_5 + t3_6)**2
+            t3_13 = t3_10*t3_11*t3_12
+            t3_14 = 2*t3_2
+            t3_15 = t3_0*t3_6
+            t3_16 = t3_5*t3_6
+            t3_17 = -t3_0*t3_5 + t3_14 + t3_15 + t3_16
+            t3_18 = 0.12909944487358056*t3_9
+            t3_19 = 7*t3_15
+            t3_20 = 7*t3_16
+            t3_21 = t3_14 + t3_8
+            t3_22 = (1/30)*t3_9
+            F[i, 8] = -0.10540925533894598*t3_13*(3*t3_0*t3_1 + t3_0*t3_3 + t3_1*t3_7 + t3_3*t3_5 + 3*t3_4*t3_5 + t3_4*t3_7 + 12*t3_6*t3_8 + 2*xi**6 + 2*yi**6 + 6*zi**6)
+            F[i, 9] = -t3_11*t3_18*(-t3_17 + t3_4)
+            F[i, 10] = -t3_12*t3_18*(t3_1 - t3_17)
+            F[i, 11] = -0.081649658092772603*t3_13*(xi - yi)*(xi + yi)*(2*t3_1 + t3_19 + 5*t3_2 + t3_20 + 2*t3_4 + 5*t3_8)
+            F[i, 12] = -0.16329931618554521*t3_10
+            F[i, 13] = t3_11*t3_22*(-t3_16 + t3_19 + t3_21 + 5*t3_4)
+            F[i, 14] = -t3_12*t3_22*(5*t3_1 - t3_15 + t3_20 + t3_21)
+    return F
@@ -0,0 +1,240 @@
+# Code generator for the antiderivatives of the Bz susceptibility polynomials
+# used by the area and volume sensor modules. This script requires sympy; the
+# generated files are part of the repository, so that sympy is not needed to
+# build or use the library:
+#
+#     python -m mmt_multipole_inversion.susceptibility_modules._kernel_codegen
+#
+# writes `_flux_kernels.py` (numba kernels) and `openmp/_flux_kernels.pxi`
+# (Cython kernels included by `openmp/cpulib.pyx`). The test
+# `test_generated_flux_kernels` checks that the files in the repository are
+# the output of this script, hence it must be run after changing it.
+#
+# Instead of integrating the polynomials with `sympy.integrate`, which is too
+# slow for the octupole terms, every Bz polynomial of order `l` is written as
+# a combination of derivatives of 1 / r,
+#
+#     P = sum_a c_a ∂x^ax ∂y^ay ∂z^az (1 / r) ,   ax + ay + az = l + 1
+#
+# with 1 <= az <= 2 (Bz is the z-derivative of a harmonic potential, whose
+# harmonic basis is x^ax y^ay z^bz / r^(2l+1) with bz <= 1). The
+# antiderivatives in x and y (area) or x, y and z (volume) are then obtained
+# by cancelling the derivatives with the primitives of 1 / r:
+#
+#     ∫ dx 1 / r          -> atanh(x / r)
+#     ∫ dy 1 / r          -> atanh(y / r)
+#     ∂z ∫∫ dx dy 1 / r   -> -atan2(x y, z r)
+#
+# up to functions that do not depend on one of the integration variables,
+# which cancel in the alternating sums at the sensor corners. The resulting
+# rational functions of x, y, z and r are simplified using r^2 = x^2 + y^2 + z^2
+# and optimised with common subexpression elimination.
+import sympy as smp
+from sympy.printing.c import C99CodePrinter
+from pathlib import Path
+
+x, y, z = smp.symbols('x y z', real=True)
+r = smp.symbols('r', positive=True)
+_R = smp.sqrt(x ** 2 + y ** 2 + z ** 2)
+_R2 = x ** 2 + y ** 2 + z ** 2
+
+# Multipole orders generated for the area and volume sensors
+MAX_ORDER = 3
+
+# -----------------------------------------------------------------------------
+# Bz polynomials of the point sensors
+
+
+def spherical_harmonics_basis(order: int) -> list:
+    """Bz polynomials of `spherical_harmonics_basis.py` (in units of 1e-7)"""
+    if order == 1:
+        g = 1 / _R ** 5
+        return [g * 3 * x * z, g * 3 * y * z, g * (3 * z ** 2 - _R2)]
+    elif order == 2:
+        g = 1 / _R ** 7
+        return [g * smp.sqrt(smp.Rational(3, 2)) * z * (-3 * _R2 + 5 * z ** 2),
+                g * -smp.sqrt(2) * x * (_R2 - 5 * z ** 2),
+                g * -smp.sqrt(2) * y * (_R2 - 5 * z ** 2),
+                g * (5 / smp.sqrt(2)) * (x ** 2 - y ** 2) * z,
+                g * 5 * smp.sqrt(2) * x * y * z]
+    elif order == 3:
+        g = 1 / _R ** 9
+        return [g * (3 * _R2 ** 2 - 30 * _R2 * z ** 2 + 35 * z ** 4) / smp.sqrt(10),
+                g * smp.sqrt(15) * x * z * (-3 * _R2 + 7 * z ** 2) / 2,
+                g * smp.sqrt(15) * y * z * (-3 * _R2 + 7 * z ** 2) / 2,
+                g * -smp.sqrt(smp.Rational(3, 2)) * (x ** 2 - y ** 2) * (_R2 - 7 * z ** 2),
+                g * -smp.sqrt(6) * x * y * (_R2 - 7 * z ** 2),
+                g * smp.Rational(7, 2) * x * (x ** 2 - 3 * y ** 2) * z,
+                g * -smp.Rational(7, 2) * y * (-3 * x ** 2 + y ** 2) * z]
+    raise ValueError(f'Order {order} not implemented')
+
+
+BASES = {'SHB': spherical_harmonics_basis}
+
+# -----------------------------------------------------------------------------
+# Symbolic antiderivatives
+
+
+def derivative_orders(order: int) -> list:
+    """Derivatives (ax, ay, az) of 1 / r spanning the Bz polynomials"""
+    return [(ax, order - bz - ax, bz + 1) for bz in (0, 1) for ax in range(order - bz + 1)]
+
+
+def derivative_coefficients(P, order: int) -> dict:
+    """Coefficients of `P` in the basis of `derivative_orders`"""
+    alphas = derivative_orders(order)
+    coeffs = smp.symbols(f'c0:{len(alphas)}')
+    residual = sum(c * smp.diff(1 / _R, x, ax, y, ay, z, az)
+                   for c, (ax, ay, az) in zip(coeffs, alphas)) - P
+    # Multiply by r^(2l + 3) to obtain a polynomial in x, y, z
+    numerator = smp.expand(residual.subs(_R2, r ** 2) * r ** (2 * order + 3))
+    poly = smp.Poly(smp.expand(numerator.subs(r, _R)), x, y, z)
+    solution = smp.solve(poly.coeffs(), coeffs, dict=True)
+    if len(solution) != 1:
+        raise ValueError('The polynomial is not a z-derivative of a harmonic function')
+    return {a: solution[0][c] for c, a in zip(coeffs, alphas) if solution[0].get(c, 0) != 0}
+
+
+def _integrated_derivative(alpha: tuple, geometry: str):
+    """Antiderivative of ∂x^ax ∂y^ay ∂z^az (1 / r) in the sensor geometry"""
+    ax, ay, az = alpha
+    if geometry == 'volume':
+        az -= 1
+    if ax > 0 and ay > 0:
+        base = 1 / _R
+        ax, ay = ax - 1, ay - 1
+    elif ay > 0:
+        base = smp.atanh(x / _R)
+        ay -= 1
+    elif ax > 0:
+        base = smp.atanh(y / _R)
+        ax -= 1
+    else:
+        base = -smp.atan2(x * y, z * _R)
+        az -= 1
+    if az < 0:
+        raise ValueError(f'No antiderivative for the derivative {alpha}')
+    return smp.diff(base, x, ax, y, ay, z, az)
+
+
+def _reduce(expr):
+    """Simplify a rational function of x, y, z and r using r^2 = x^2 + y^2 + z^2
+
+    The powers of r are reduced to r^0 or r^1 in the numerator and in the
+    denominator, which removes the factors `r - x`, `r + x` (and the like)
+    that lose precision by cancellation
+    """
+    num, den = smp.fraction(smp.factor(smp.together(expr)))
+    reduced = []
+    for p in (num, den):
+        # Keep the powers of r that multiply the whole polynomial apart
+        r_power = 0
+        while p.has(r) and smp.rem(p, r, r) == 0:
+            p, r_power = smp.quo(p, r, r), r_power + 1
+        p = smp.rem(smp.expand(p), r ** 2 - _R2, r)
+        reduced.append(smp.factor(p) * r ** r_power)
+    return reduced[0] / reduced[1]
+
+
+def flux_antiderivatives(basis: str, geometry: str, order: int) -> list:
+    """Antiderivatives of the Bz polynomials of the given multipole order"""
+    antiderivatives = []
+    for P in BASES[basis](order):
+        F = sum(c * _integrated_derivative(alpha, geometry)
+                for alpha, c in derivative_coefficients(P, order).items())
+        F = F.subs(_R2, r ** 2)
+        if not F.has(smp.atan2, smp.atanh):
+            F = _reduce(F)
+        antiderivatives.append(F)
+    return antiderivatives
+
+# -----------------------------------------------------------------------------
+# Code printers
+
+
+def _float_constants(expr):
+    """Replace the irrational constants (e.g. sqrt(6)) by floats"""
+    return expr.xreplace({a: a.evalf(17) for a in expr.atoms(smp.Pow)
+                          if a.is_number})
+
+
+class _CPrinter(C99CodePrinter):
+    """Print integer powers as products"""
+
+    def _print_Pow(self, expr):
+        if expr.exp.is_Integer and 1 < abs(expr.exp) < 8:
+            product = '*'.join([self.parenthesize(expr.base, 100)] * abs(expr.exp))
+            return f'({product})' if expr.exp > 0 else f'(1.0/({product}))'
+        return super()._print_Pow(expr)
+
+
+def _blocks(basis: str, geometry: str):
+    """Common subexpressions and expressions of every multipole order"""
+    start = 0
+    for order in range(1, MAX_ORDER + 1):
+        exprs = [_float_constants(F) for F in flux_antiderivatives(basis, geometry, order)]
+        symbols = smp.numbered_symbols(f't{order}_')
+        replacements, reduced = smp.cse(exprs, symbols=symbols)
+        yield order, start, replacements, reduced
+        start += len(exprs)
+
+
+def numba_source(basis: str = 'SHB') -> str:
+    """Source of the numba kernels"""
+    lines = ['# Antiderivatives of the Bz susceptibility polynomials for area and volume',
+             '# sensors. This file is generated by _kernel_codegen.py: do not edit',
+             'import math',
+             'import numpy as np',
+             'import numba', '']
+    for geometry, variables in [('area', '`x` and `y`'), ('volume', '`x`, `y` and `z`')]:
+        units = 'm^2' if geometry == 'area' else 'm^3'
+        lines += ['', '@numba.jit(nopython=True)',
+                  f'def {geometry}_flux_antiderivative(x, y, z, multipole_order):',
+                  f'    """Antiderivative in {variables} of the Bz polynomials, in units of `{units} / 1e-7`"""',
+                  '    n_terms = (multipole_order + 1) ** 2 - 1',
+                  '    F = np.zeros((len(x), n_terms))',
+                  '    for i in range(len(x)):',
+                  '        r = math.sqrt(x[i] ** 2 + y[i] ** 2 + z[i] ** 2)',
+                  '        xi, yi, zi = x[i], y[i], z[i]']
+        for order, start, replacements, reduced in _blocks(basis, geometry):
+            subs = {x: smp.Symbol('xi'), y: smp.Symbol('yi'), z: smp.Symbol('zi')}
+            lines.append(f'        if multipole_order > {order - 1}:')
+            for s, e in replacements:
+                lines.append(f'            {s} = {smp.pycode(e.xreplace(subs))}')
+            for k, e in enumerate(reduced):
+                lines.append(f'            F[i, {start + k}] = {smp.pycode(e.xreplace(subs))}')
+        lines += ['    return F', '']
+    return '\n'.join(lines)
+
+
+def cython_source(basis: str = 'SHB') -> str:
+    """Source of the Cython kernels, which add `sign * Cm * F` to `q`"""
+    printer = _CPrinter()
+    lines = ['# Antiderivatives of the Bz susceptibility polynomials for area and volume',
+             '# sensors, included by cpulib.pyx. This file is generated by',
+             '# _kernel_codegen.py: do not edit',
+             'from libc.math cimport sqrt, atanh, atan2, pow', '']
+    for geometry in ['area', 'volume']:
+        blocks = list(_blocks(basis, geometry))
+        temps = [str(s) for *_, replacements, _ in blocks for s, _ in replacements]
+        lines += ['',
+                  f'cdef inline void {basis}_{geometry}_corner(double x, double y, double z, double sign,',
+                  '        double * q, int multipole_order) noexcept nogil:',
+                  '    cdef double r = sqrt(x * x + y * y + z * z)']
+        for k in range(0, len(temps), 8):
+            lines.append(f'    cdef double {", ".join(temps[k:k + 8])}')
+        lines += ['', '    sign *= Cm']
+        for order, start, replacements, reduced in blocks:
+            lines.append(f'    if multipole_order > {order - 1}:')
+            for s, e in replacements:
+                lines.append(f'        {s} = {printer.doprint(e)}')
+            for k, e in enumerate(reduced):
+                lines.append(f'        q[{start + k}] += sign * ({printer.doprint(e)})')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    directory = Path(__file__).resolve().parent
+    (directory / '_flux_kernels.py').write_text(numba_source())
+    (directory / 'openmp' / '_flux_kernels.pxi').write_text(cython_source())
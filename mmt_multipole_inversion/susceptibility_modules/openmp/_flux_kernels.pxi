@@ -0,0 +1,177 @@
+# Antiderivatives of the Bz susceptibility polynomials for area and volume
+# sensors, included by cpulib.pyx. This file is generated by
+# _kernel_codegen.py: do not edit
+from libc.math cimport sqrt, atanh, atan2, pow
+
+
+cdef inline void SHB_area_corner(double x, double y, double z, double sign,
+        double * q, int multipole_order) noexcept nogil:
+    cdef double r = sqrt(x * x + y * y + z * z)
+    cdef double t1_0, t1_1, t1_2, t1_3, t1_4, t1_5, t1_6, t2_0
+    cdef double t2_1, t2_2, t2_3, t2_4, t2_5, t2_6, t2_7, t2_8
+    cdef double t2_9, t2_10, t2_11, t2_12, t2_13, t2_14, t2_15, t2_16
+    cdef double t3_0, t3_1, t3_2, t3_3, t3_4, t3_5, t3_6, t3_7
+    cdef double t3_8, t3_9, t3_10, t3_11, t3_12, t3_13, t3_14, t3_15
+    cdef double t3_16, t3_17, t3_18, t3_19, t3_20, t3_21, t3_22, t3_23
+    cdef double t3_24, t3_25, t3_26, t3_27, t3_28, t3_29, t3_30, t3_31
+    cdef double t3_32, t3_33, t3_34, t3_35, t3_36, t3_37, t3_38, t3_39
+    cdef double t3_40, t3_41, t3_42, t3_43, t3_44, t3_45, t3_46, t3_47
+    cdef double t3_48, t3_49, t3_50
+
+    sign *= Cm
+    if multipole_order > 0:
+        t1_0 = (x*x)
+        t1_1 = (z*z)
+        t1_2 = t1_0 + t1_1
+        t1_3 = 1.0/r
+        t1_4 = t1_3*z
+        t1_5 = (y*y)
+        t1_6 = t1_1 + t1_5
+        q[0] += sign * (-t1_4*y/t1_2)
+        q[1] += sign * (-t1_4*x/t1_6)
+        q[2] += sign * (t1_3*x*y*(t1_0 + 2*t1_1 + t1_5)/(t1_2*t1_6))
+    if multipole_order > 1:
+        t2_0 = (x*x)
+        t2_1 = (y*y*y*y)
+        t2_2 = (z*z*z*z)
+        t2_3 = 11*t2_2
+        t2_4 = (x*x*x*x)
+        t2_5 = (y*y)
+        t2_6 = (z*z)
+        t2_7 = 7*t2_6
+        t2_8 = t2_0*t2_5
+        t2_9 = (1.0/(r*r*r))
+        t2_10 = y/((t2_0 + t2_6)*(t2_0 + t2_6))
+        t2_11 = x/((t2_5 + t2_6)*(t2_5 + t2_6))
+        t2_12 = t2_10*t2_11*t2_9*z
+        t2_13 = t2_0*t2_6
+        t2_14 = t2_5*t2_6
+        t2_15 = -t2_0*t2_5 + t2_13 + t2_14 + 2*t2_2
+        t2_16 = 0.47140452079103168*t2_9
+        q[3] += sign * (0.40824829046386302*t2_12*(3*t2_0*t2_1 + t2_0*t2_3 + t2_1*t2_7 + t2_3*t2_5 + 3*t2_4*t2_5 + t2_4*t2_7 + 12*t2_6*t2_8 + 2*(x*x*x*x*x*x) + 2*(y*y*y*y*y*y) + 6*(z*z*z*z*z*z)))
+        q[4] += sign * (t2_10*t2_16*(-t2_15 + t2_4))
+        q[5] += sign * (t2_11*t2_16*(t2_1 - t2_15))
+        q[6] += sign * (0.23570226039551584*t2_12*(x - y)*(x + y)*(2*t2_1 + 7*t2_13 + 7*t2_14 + 5*t2_2 + 2*t2_4 + 5*t2_8))
+        q[7] += sign * (t2_16*z)
+    if multipole_order > 2:
+        t3_0 = (x*x)
+        t3_1 = pow(y, 10)
+        t3_2 = pow(z, 10)
+        t3_3 = 72*t3_2
+        t3_4 = (x*x*x*x)
+        t3_5 = pow(y, 8)
+        t3_6 = pow(z, 8)
+        t3_7 = 93*t3_6
+        t3_8 = (x*x*x*x*x*x)
+        t3_9 = (y*y*y*y*y*y)
+        t3_10 = (z*z*z*z*z*z)
+        t3_11 = 72*t3_10
+        t3_12 = pow(x, 8)
+        t3_13 = (y*y*y*y)
+        t3_14 = (z*z*z*z)
+        t3_15 = 33*t3_14
+        t3_16 = pow(x, 10)
+        t3_17 = (y*y)
+        t3_18 = (z*z)
+        t3_19 = 6*t3_18
+        t3_20 = t3_0*t3_17
+        t3_21 = t3_0*t3_13
+        t3_22 = 104*t3_10
+        t3_23 = 36*t3_14
+        t3_24 = t3_0*t3_9
+        t3_25 = 4*t3_18
+        t3_26 = t3_17*t3_4
+        t3_27 = t3_13*t3_4
+        t3_28 = t3_17*t3_8
+        t3_29 = (1.0/(r*r*r*r*r))
+        t3_30 = y/((t3_0 + t3_18)*(t3_0 + t3_18)*(t3_0 + t3_18))
+        t3_31 = x/((t3_17 + t3_18)*(t3_17 + t3_18)*(t3_17 + t3_18))
+        t3_32 = t3_29*t3_30*t3_31
+        t3_33 = 3*t3_14
+        t3_34 = 12*t3_18
+        t3_35 = 6*t3_10
+        t3_36 = 10*t3_18
+        t3_37 = t3_20*t3_36
+        t3_38 = -t3_35 + t3_37
+        t3_39 = 5*t3_14
+        t3_40 = 2*t3_18
+        t3_41 = -t3_13*t3_40 - t3_17*t3_39 + 6*t3_21 + 15*t3_26
+        t3_42 = t3_29*z
+        t3_43 = 0.12909944487358056*t3_42
+        t3_44 = -t3_0*t3_39 + 15*t3_21 + 6*t3_26 - t3_4*t3_40
+        t3_45 = 81*t3_6
+        t3_46 = 78*t3_10
+        t3_47 = 87*t3_14
+        t3_48 = 48*t3_18
+        t3_49 = t3_35 + t3_37
+        t3_50 = (1.0/30.0)*t3_42
+        q[8] += sign * (-0.10540925533894598*t3_32*(2*t3_0*t3_1 - t3_0*t3_25*t3_5 - t3_0*t3_3 - t3_1*t3_19 - t3_11*t3_8 - t3_11*t3_9 + 5*t3_12*t3_13 - t3_12*t3_15 - t3_12*t3_17*t3_25 + 18*t3_13*t3_18*t3_8 - t3_13*t3_7 - 6*t3_14*t3_27 - t3_15*t3_5 + 2*t3_16*t3_17 - t3_16*t3_19 - t3_17*t3_3 + 18*t3_18*t3_4*t3_9 - 146*t3_20*t3_6 - t3_21*t3_22 - t3_22*t3_26 - t3_23*t3_24 - t3_23*t3_28 + 5*t3_4*t3_5 - t3_4*t3_7 + 6*t3_8*t3_9 - 24*pow(z, 12)))
+        q[9] += sign * (t3_30*t3_43*(-t3_0*t3_33 + t3_34*t3_4 + t3_38 + t3_41 + 9*t3_8))
+        q[10] += sign * (t3_31*t3_43*(t3_13*t3_34 - t3_17*t3_33 + t3_38 + t3_44 + 9*t3_9))
+        q[11] += sign * (-0.081649658092772603*t3_32*(x - y)*(x + y)*(-t3_0*t3_45 + 2*t3_0*t3_5 - 156*t3_10*t3_20 + 2*t3_12*t3_17 - t3_12*t3_19 - t3_13*t3_46 + 7*t3_13*t3_8 - t3_15*t3_8 - t3_15*t3_9 - t3_17*t3_45 - t3_19*t3_5 - 30*t3_2 - t3_21*t3_47 - t3_24*t3_36 - t3_26*t3_47 - t3_27*t3_36 - t3_28*t3_36 - t3_4*t3_46 + 7*t3_4*t3_9))
+        q[12] += sign * (-0.16329931618554521*t3_29*(t3_0 + t3_17 - t3_40))
+        q[13] += sign * (-t3_30*t3_50*(t3_0*t3_15 + t3_4*t3_48 + t3_41 + t3_49 + 21*t3_8))
+        q[14] += sign * (t3_31*t3_50*(t3_13*t3_48 + t3_15*t3_17 + t3_44 + t3_49 + 21*t3_9))
+
+
+cdef inline void SHB_volume_corner(double x, double y, double z, double sign,
+        double * q, int multipole_order) noexcept nogil:
+    cdef double r = sqrt(x * x + y * y + z * z)
+    cdef double t1_0, t2_0, t2_1, t2_2, t2_3, t2_4, t2_5, t2_6
+    cdef double t2_7, t2_8, t3_0, t3_1, t3_2, t3_3, t3_4, t3_5
+    cdef double t3_6, t3_7, t3_8, t3_9, t3_10, t3_11, t3_12, t3_13
+    cdef double t3_14, t3_15, t3_16, t3_17, t3_18, t3_19, t3_20, t3_21
+    cdef double t3_22
+
+    sign *= Cm
+    if multipole_order > 0:
+        t1_0 = 1.0/r
+        q[0] += sign * (atanh(t1_0*y))
+        q[1] += sign * (atanh(t1_0*x))
+        q[2] += sign * (-atan2(x*y, r*z))
+    if multipole_order > 1:
+        t2_0 = (x*x)
+        t2_1 = (y*y)
+        t2_2 = (z*z)
+        t2_3 = 1.0/r
+        t2_4 = y/(t2_0 + t2_2)
+        t2_5 = x/(t2_1 + t2_2)
+        t2_6 = t2_3*t2_4*t2_5
+        t2_7 = 0.47140452079103168*t2_3
+        t2_8 = t2_7*z
+        q[3] += sign * (-0.40824829046386302*t2_6*(t2_0 + t2_1 + 2*t2_2))
+        q[4] += sign * (t2_4*t2_8)
+        q[5] += sign * (t2_5*t2_8)
+        q[6] += sign * (-0.23570226039551584*t2_6*(x - y)*(x + y))
+        q[7] += sign * (-t2_7)
+    if multipole_order > 2:
+        t3_0 = (x*x)
+        t3_1 = (y*y*y*y)
+        t3_2 = (z*z*z*z)
+        t3_3 = 11*t3_2
+        t3_4 = (x*x*x*x)
+        t3_5 = (y*y)
+        t3_6 = (z*z)
+        t3_7 = 7*t3_6
+        t3_8 = t3_0*t3_5
+        t3_9 = (1.0/(r*r*r))
+        t3_10 = t3_9*z
+        t3_11 = y/((t3_0 + t3_6)*(t3_0 + t3_6))
+        t3_12 = x/((t3_5 + t3_6)*(t3_5 + t3_6))
+        t3_13 = t3_10*t3_11*t3_12
+        t3_14 = 2*t3_2
+        t3_15 = t3_0*t3_6
+        t3_16 = t3_5*t3_6
+        t3_17 = -t3_0*t3_5 + t3_14 + t3_15 + t3_16
+        t3_18 = 0.12909944487358056*t3_9
+        t3_19 = 7*t3_15
+        t3_20 = 7*t3_16
+        t3_21 = t3_14 + t3_8
+        t3_22 = (1.0/30.0)*t3_9
+        q[8] += sign * (-0.10540925533894598*t3_13*(3*t3_0*t3_1 + t3_0*t3_3 + t3_1*t3_7 + t3_3*t3_5 + 3*t3_4*t3_5 + t3_4*t3_7 + 12*t3_6*t3_8 + 2*(x*x*x*x*x*x) + 2*(y*y*y*y*y*y) + 6*(z*z*z*z*z*z)))
+        q[9] += sign * (-t3_11*t3_18*(-t3_17 + t3_4))
+        q[10] += sign * (-t3_12*t3_18*(t3_1 - t3_17))
+        q[11] += sign * (-0.081649658092772603*t3_13*(x - y)*(x + y)*(2*t3_1 + t3_19 + 5*t3_2 + t3_20 + 2*t3_4 + 5*t3_8))
+        q[12] += sign * (-0.16329931618554521*t3_10)
+        q[13] += sign * (t3_11*t3_22*(-t3_16 + t3_19 + t3_21 + 5*t3_4))
+        q[14] += sign * (-t3_12*t3_22*(5*t3_1 - t3_15 + t3_20 + t3_21))
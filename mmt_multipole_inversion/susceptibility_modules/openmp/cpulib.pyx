@@ -0,0 +1,260 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+# CPU (OpenMP) implementation of the susceptibility functions used to populate
+# the forward matrix Q. The kernels follow the numba functions in the
+# susceptibility_modules directory and populate Q with the same column
+# arrangement: every source j has `n_col_stride` columns starting at
+# `j * n_col_stride`, with the dipole terms in columns 0-2, the quadrupole terms
+# in columns 3-7 and the octupole terms in columns 8-14.
+# Rows (sensors) are distributed among the OpenMP threads via Cython's prange.
+cimport openmp
+from cython.parallel cimport prange
+from libc.math cimport sqrt
+
+# -----------------------------------------------------------------------------
+
+# Bases available for point sensors, mapped to the integer used in the kernels
+BASIS_IDS = {'spherical_harmonics_basis': 0,
+             'maxwell_cartesian_polynomials': 1,
+             'cartesian_spherical_harmonics': 2}
+
+cdef double Cm = 1e-7
+
+# -----------------------------------------------------------------------------
+# POINT SENSORS
+
+cdef inline void SHB_point(double x, double y, double z, double * q,
+                           int multipole_order) noexcept nogil:
+    cdef double x2 = x * x, y2 = y * y, z2 = z * z
+    cdef double r2 = x2 + y2 + z2
+    cdef double r = sqrt(r2)
+    cdef double f
+
+    if multipole_order > 0:
+        f = Cm / (r2 * r2 * r)
+        q[0] = f * (3 * x * z)
+        q[1] = f * (3 * y * z)
+        q[2] = f * (3 * z2 - r2)
+
+    if multipole_order > 1:
+        f = Cm / (r2 * r2 * r2 * r)
+        q[3] = f * sqrt(1.5) * z * (-3 * r2 + 5 * z2)
+        q[4] = f * -sqrt(2.) * x * (r2 - 5 * z2)
+        q[5] = f * -sqrt(2.) * y * (r2 - 5 * z2)
+        q[6] = f * (5 / sqrt(2.)) * (x2 - y2) * z
+        q[7] = f * 5 * sqrt(2.) * x * y * z
+
+    if multipole_order > 2:
+        f = Cm / (r2 * r2 * r2 * r2 * r)
+        q[8] = f * (3 * r2 * r2 - 30 * r2 * z2 + 35 * z2 * z2) / sqrt(10.)
+        q[9] = f * sqrt(15.) * x * z * (-3 * r2 + 7 * z2) / 2
+        q[10] = f * sqrt(15.) * y * z * (-3 * r2 + 7 * z2) / 2
+        q[11] = f * -sqrt(1.5) * (x2 - y2) * (r2 - 7 * z2)
+        q[12] = f * -sqrt(6.) * x * y * (r2 - 7 * z2)
+        q[13] = f * 7 * x * (x2 - 3 * y2) * z / 2
+        q[14] = f * -7 * y * (-3 * x2 + y2) * z / 2
+
+
+cdef inline void MCP_point(double x, double y, double z, double * q,
+                           int multipole_order) noexcept nogil:
+    cdef double z2 = z * z
+    cdef double r2 = x * x + y * y + z2
+    cdef double r = sqrt(r2)
+    cdef double f
+
+    if multipole_order > 0:
+        f = Cm / (r2 * r2 * r)
+        q[0] = f * (3 * x * z)
+        q[1] = f * (3 * y * z)
+        q[2] = f * (3 * z2) - Cm / (r2 * r)
+
+    if multipole_order > 1:
+        f = Cm / (r2 * r2 * r2 * r)
+        q[3] = f * (5. * z * (x * x - z2) + 2 * r2 * z)
+        q[4] = f * (10. * x * y * z)
+        q[5] = f * (2. * x * (5 * z2 - r2))
+        q[6] = f * (5. * z * (y * y - z2) + 2 * r2 * z)
+        q[7] = f * (2. * y * (5 * z2 - r2))
+
+    if multipole_order > 2:
+        f = Cm / (r2 * r2 * r2 * r2 * r)
+        q[8] = f * 5 * x * z * (7 * (x * x - 3 * z2) + 6 * r2)
+        q[9] = f * 15 * y * z * (7 * (x * x - z2) + 2 * r2)
+        q[10] = f * 5 * (7 * z2 * (3 * x * x - z2) - 3 * r2 * (x * x - z2))
+        q[11] = f * 30 * x * y * (7 * z2 - r2)
+        q[12] = f * 15 * x * z * (7 * (y * y - z2) + 2 * r2)
+        q[13] = f * 5 * y * z * (7 * (y * y - 3 * z2) + 6 * r2)
+        q[14] = f * 5 * (7 * z2 * (3 * y * y - z2) - 3 * r2 * (y * y - z2))
+
+
+cdef inline void CSH_point(double x, double y, double z, double * q,
+                           int multipole_order) noexcept nogil:
+    cdef double x2 = x * x, y2 = y * y, z2 = z * z
+    cdef double r2 = x2 + y2 + z2
+    cdef double r4 = r2 * r2
+    cdef double r = sqrt(r2)
+    cdef double f
+
+    if multipole_order > 0:
+        f = Cm / (r2 * r2 * r)
+        q[0] = f * sqrt(6.) * (3 * x * z)
+        q[1] = f * -sqrt(6.) * (3 * y * z)
+        q[2] = f * sqrt(1.5) * (3 * z2 - r2)
+
+    if multipole_order > 1:
+        f = Cm / (r2 * r2 * r2 * r)
+        q[3] = f * -sqrt(5.) * z * (3 * r2 - 5 * z2)
+        q[4] = f * -10 * sqrt(10.) * x * y * z
+        q[5] = f * -sqrt(15.) * x * (r2 - 5 * z2)
+        q[6] = f * 5 * sqrt(10.) * z * (x2 - y2)
+        q[7] = f * sqrt(15.) * y * (r2 - 5 * z2)
+
+    if multipole_order > 2:
+        f = Cm / (r4 * r4 * r)
+        q[8] = f * sqrt(7. / 10.) * (3 * r4 - 30 * r2 * z2 + 35 * z2 * z2)
+        q[9] = f * 5 * sqrt(42. / 19.) * y * z * (3 * r2 - 7 * z2)
+        q[10] = f * -sqrt(35.) * (x2 - y2) * (r2 - 7 * z2)
+        q[11] = f * 7 * sqrt(14.) * y * (-3 * x2 + y2) * z
+        q[12] = f * 5 * sqrt(42. / 19.) * x * z * (-3 * r2 + 7 * z2)
+        q[13] = f * 2 * sqrt(35.) * x * y * (r2 - 7 * z2)
+        q[14] = f * 7 * sqrt(14.) * x * (x2 - 3 * y2) * z
+
+# -----------------------------------------------------------------------------
+# AREA AND VOLUME SENSORS (spherical harmonics basis)
+# The functions SHB_area_corner and SHB_volume_corner add the antiderivative
+# evaluated at a sensor corner, scaled by `sign`, to the Q entries. They are
+# generated by _kernel_codegen.py, together with the numba functions used by
+# spherical_harmonics_basis_area.py and spherical_harmonics_basis_volume.py
+
+include "_flux_kernels.pxi"
+
+# -----------------------------------------------------------------------------
+
+cdef int _n_threads(int num_threads):
+    if num_threads < 1:
+        return openmp.omp_get_max_threads()
+    return num_threads
+
+
+def point_populate_matrix(const double [:, ::1] r_sources,
+                          const double [:, ::1] r_sensors,
+                          double [:, ::1] Q,
+                          int n_col_stride,
+                          int multipole_order,
+                          int basis,
+                          int num_threads=0
+                          ):
+    """Populate the forward matrix `Q` using point sensors
+
+    Parameters
+    ----------
+    r_sources
+        `N x 3` array with the positions of the magnetic point sources
+    r_sensors
+        `P x 3` array with the positions of the sensors
+    Q
+        `P x (N * n_col_stride)` forward matrix to be populated
+    n_col_stride
+        Number of columns per source in `Q`
+    multipole_order
+        1 -> dipole, 2 -> quadrupole, 3 -> octupole
+    basis
+        Integer from the `BASIS_IDS` dictionary
+    num_threads
+        Number of OpenMP threads. If smaller than 1, the OpenMP default is
+        used, which can be set with the `OMP_NUM_THREADS` env variable
+    """
+    cdef Py_ssize_t Nsources = r_sources.shape[0]
+    cdef Py_ssize_t Nsensors = r_sensors.shape[0]
+    cdef Py_ssize_t i, j
+    cdef double x, y, z
+    cdef int nt = _n_threads(num_threads)
+
+    if Q.shape[0] != Nsensors or Q.shape[1] < Nsources * n_col_stride:
+        raise ValueError('Q array does not match the number of sources and sensors')
+
+    with nogil:
+        for i in prange(Nsensors, schedule='static', num_threads=nt):
+            for j in range(Nsources):
+                x = r_sensors[i, 0] - r_sources[j, 0]
+                y = r_sensors[i, 1] - r_sources[j, 1]
+                z = r_sensors[i, 2] - r_sources[j, 2]
+                if basis == 0:
+                    SHB_point(x, y, z, &Q[i, j * n_col_stride], multipole_order)
+                elif basis == 1:
+                    MCP_point(x, y, z, &Q[i, j * n_col_stride], multipole_order)
+                else:
+                    CSH_point(x, y, z, &Q[i, j * n_col_stride], multipole_order)
+
+
+def area_populate_matrix(const double [:, ::1] r_sources,
+                         const double [:, ::1] r_sensors,
+                         double [:, ::1] Q,
+                         int n_col_stride,
+                         double dx_sensor, double dy_sensor,
+                         int multipole_order,
+                         int num_threads=0
+                         ):
+    """Populate the forward matrix `Q` with the area flux of rectangular sensors
+
+    `dx_sensor` and `dy_sensor` are the half lengths of the sensor area. `Q`
+    entries must be zero before calling this function. See
+    `point_populate_matrix` for the other parameters.
+    """
+    cdef Py_ssize_t Nsources = r_sources.shape[0]
+    cdef Py_ssize_t Nsensors = r_sensors.shape[0]
+    cdef Py_ssize_t i, j
+    cdef int sx, sy
+    cdef double x, y, z
+    cdef int nt = _n_threads(num_threads)
+
+    if Q.shape[0] != Nsensors or Q.shape[1] < Nsources * n_col_stride:
+        raise ValueError('Q array does not match the number of sources and sensors')
+
+    with nogil:
+        for i in prange(Nsensors, schedule='static', num_threads=nt):
+            for j in range(Nsources):
+                z = r_sensors[i, 2] - r_sources[j, 2]
+                for sy in range(-1, 2, 2):
+                    for sx in range(-1, 2, 2):
+                        x = r_sensors[i, 0] - r_sources[j, 0] + sx * dx_sensor
+                        y = r_sensors[i, 1] - r_sources[j, 1] + sy * dy_sensor
+                        SHB_area_corner(x, y, z, <double> (sx * sy),
+                                        &Q[i, j * n_col_stride], multipole_order)
+
+
+def volume_populate_matrix(const double [:, ::1] r_sources,
+                           const double [:, ::1] r_sensors,
+                           double [:, ::1] Q,
+                           int n_col_stride,
+                           double dx_sensor, double dy_sensor, double dz_sensor,
+                           int multipole_order,
+                           int num_threads=0
+                           ):
+    """Populate the forward matrix `Q` with the volume flux of cuboid sensors
+
+    `dx_sensor`, `dy_sensor` and `dz_sensor` are the half lengths of the
+    sensor volume. `Q` entries must be zero before calling this function. See
+    `point_populate_matrix` for the other parameters.
+    """
+    cdef Py_ssize_t Nsources = r_sources.shape[0]
+    cdef Py_ssize_t Nsensors = r_sensors.shape[0]
+    cdef Py_ssize_t i, j
+    cdef int sx, sy, sz
+    cdef double x, y, z
+    cdef int nt = _n_threads(num_threads)
+
+    if Q.shape[0] != Nsensors or Q.shape[1] < Nsources * n_col_stride:
+        raise ValueError('Q array does not match the number of sources and sensors')
+
+    with nogil:
+        for i in prange(Nsensors, schedule='static', num_threads=nt):
+            for j in range(Nsources):
+                for sz in range(-1, 2, 2):
+                    for sy in range(-1, 2, 2):
+                        for sx in range(-1, 2, 2):
+                            x = r_sensors[i, 0] - r_sources[j, 0] + sx * dx_sensor
+                            y = r_sensors[i, 1] - r_sources[j, 1] + sy * dy_sensor
+                            z = r_sensors[i, 2] - r_sources[j, 2] + sz * dz_sensor
+                            SHB_volume_corner(x, y, z, <double> (sx * sy * sz),
+                                              &Q[i, j * n_col_stride],
+                                              multipole_order)
@@ -206,3 +206,442 @@ def octupole_Bz_sus(dip_r, pos_r, Q, n_col_stride):
         Q[i][14::n_col_stride] = g * octp[:, 6]
 
     return None
+
+
+@numba.jit(nopython=True)
+def _bz_normalisation(multipole_order):
+    """Prefactors of the Bz polynomials computed by `multipole_Bz_sus`
+
+    Returns an array `c` such that the Bz polynomial of the order `l` and
+    azimuthal number `m` is `c[l, m] * Re/Im(S[l + 1, m]) / r^(2l + 3)`
+    """
+    c = np.zeros((multipole_order + 1, multipole_order + 1))
+    for l in range(1, multipole_order + 1):
+        # Normalisation of the basis: sqrt(l! / (2l - 1)!!)
+        basis = 1.
+        for k in range(1, l + 1):
+            basis *= k / (2. * k - 1.)
+        basis = np.sqrt(basis)
+        for m in range(l + 1):
+            # Schmidt semi-normalisation: sqrt(2 (l - m)! / (l + m)!)
+            schmidt = 1.
+            if m > 0:
+                for k in range(l - m + 1, l + m + 1):
+                    schmidt /= k
+                schmidt = np.sqrt(2. * schmidt)
+            # The z-derivative of P_l^m / r^(l + 1) is
+            # -(l - m + 1) P_(l+1)^m / r^(l + 2)
+            c[l, m] = basis * schmidt * (l - m + 1)
+    return c
+
+
+@numba.jit(nopython=True)
+def _solid_harmonics(x, y, z, r2, degree, re, im):
+    """Real and imaginary parts of the regular solid harmonics S[n, m]
+
+    Fills `re[n, m]` and `im[n, m]` for `0 <= m <= n <= degree`, see
+    `multipole_Bz_sus`. `re[0, 0]` must be set to 1
+    """
+    for m in range(degree + 1):
+        if m > 0:
+            re[m, m] = (2 * m - 1) * (x * re[m - 1, m - 1] - y * im[m - 1, m - 1])
+            im[m, m] = (2 * m - 1) * (x * im[m - 1, m - 1] + y * re[m - 1, m - 1])
+        if m < degree:
+            re[m + 1, m] = (2 * m + 1) * z * re[m, m]
+            im[m + 1, m] = (2 * m + 1) * z * im[m, m]
+        for n in range(m + 2, degree + 1):
+            re[n, m] = ((2 * n - 1) * z * re[n - 1, m] - (n + m - 1) * r2 * re[n - 2, m]) / (n - m)
+            im[n, m] = ((2 * n - 1) * z * im[n - 1, m] - (n + m - 1) * r2 * im[n - 2, m]) / (n - m)
+
+
+@numba.jit(nopython=True)
+def multipole_Bz_sus(dip_r, pos_r, Q, n_col_stride, multipole_order,
+                     min_order=1):
+    """Bz susceptibility of all the multipole orders up to `multipole_order`
+
+    Generalises `dipole_Bz_sus`, `quadrupole_Bz_sus` and `octupole_Bz_sus` to
+    any order. The potential of a multipole of order `l` in this basis is the
+    irregular solid harmonic::
+
+        Φ_lm = sqrt(l! / (2l - 1)!!) R_lm(x, y, z) / r^(2l + 1)
+
+    with `R_lm` the real regular solid harmonics with Schmidt
+    semi-normalisation, in the order `m = 0, 1c, 1s, ..., lc, ls` (the
+    dipoles are ordered as `1c, 1s, 0`, i.e. `mx, my, mz`). Since
+    `Bz = -∂z Φ_lm` is proportional to the solid harmonic of order `l + 1`
+    and the same `m`, all the orders are obtained in one pass from the
+    regular solid harmonics `S[n, m] = r^n P_n^m(z / r) (x + i y)^m / ρ^m`,
+    computed with the stable recurrences::
+
+        S[m, m] = (2m - 1) (x + i y) S[m - 1, m - 1]
+        S[m + 1, m] = (2m + 1) z S[m, m]
+        S[n, m] = ((2n - 1) z S[n - 1, m] - (n + m - 1) r^2 S[n - 2, m]) / (n - m)
+
+    Parameters
+    ----------
+    dip_r
+        N x 3 array OR 1 x 3 array
+    pos_r
+        M x 3 array OR 1 x 3 array
+    Q
+        Forward matrix. The moments of the order `l` of the source `j` are
+        stored from the column `j * n_col_stride + l^2 - min_order^2`
+    n_col_stride
+        Number of columns per source
+    multipole_order
+        Highest multipole order
+    min_order
+        Lowest multipole order stored in `Q`. For example, with
+        `min_order = multipole_order`, only the columns of the highest order
+        are populated
+    """
+    L = multipole_order
+    c = _bz_normalisation(L)
+    re = np.zeros((L + 2, L + 2))
+    im = np.zeros((L + 2, L + 2))
+    re[0, 0] = 1.
+    col_offset = min_order ** 2 - 1
+
+    for i in range(len(pos_r)):
+        for j in range(len(dip_r)):
+            x = pos_r[i, 0] - dip_r[j, 0]
+            y = pos_r[i, 1] - dip_r[j, 1]
+            z = pos_r[i, 2] - dip_r[j, 2]
+            r2 = x * x + y * y + z * z
+
+            _solid_harmonics(x, y, z, r2, L + 1, re, im)
+
+            # 1 / r^(2l + 3), starting from the dipoles
+            inv_r2 = 1. / r2
+            f = 1e-7 * inv_r2 * inv_r2 / np.sqrt(r2)
+            for l in range(1, L + 1):
+                if l == 1 and min_order == 1:
+                    # Dipoles are ordered as mx, my, mz
+                    col = j * n_col_stride
+                    Q[i, col] = f * c[1, 1] * re[2, 1]
+                    Q[i, col + 1] = f * c[1, 1] * im[2, 1]
+                    Q[i, col + 2] = f * c[1, 0] * re[2, 0]
+                elif l >= min_order:
+                    col = j * n_col_stride + l * l - 1 - col_offset
+                    Q[i, col] = f * c[l, 0] * re[l + 1, 0]
+                    for m in range(1, l + 1):
+                        Q[i, col + 2 * m - 1] = f * c[l, m] * re[l + 1, m]
+                        Q[i, col + 2 * m] = f * c[l, m] * im[l + 1, m]
+                f *= inv_r2
+
+    return None
+
+
+@numba.jit(nopython=True)
+def _solid_harmonics_gradient(x, y, z, r2, degree, re, im, gre, gim):
+    """Solid harmonics S[n, m] and their gradients
+
+    Differentiates the recurrences of `_solid_harmonics`: `gre[a, n, m]`
+    and `gim[a, n, m]` are the derivatives of `re[n, m]` and `im[n, m]`
+    with respect to the coordinate `a` (x, y or z)
+    """
+    _solid_harmonics(x, y, z, r2, degree, re, im)
+    pos = (x, y, z)
+    for m in range(degree + 1):
+        for a in range(3):
+            if m > 0:
+                # d(x + i y) is 1 for x and i for y
+                dre = re[m - 1, m - 1] if a == 0 else (-im[m - 1, m - 1] if a == 1 else 0.)
+                dim = im[m - 1, m - 1] if a == 0 else (re[m - 1, m - 1] if a == 1 else 0.)
+                gre[a, m, m] = (2 * m - 1) * (dre + x * gre[a, m - 1, m - 1] - y * gim[a, m - 1, m - 1])
+                gim[a, m, m] = (2 * m - 1) * (dim + x * gim[a, m - 1, m - 1] + y * gre[a, m - 1, m - 1])
+            dz = 1. if a == 2 else 0.
+            if m < degree:
+                gre[a, m + 1, m] = (2 * m + 1) * (dz * re[m, m] + z * gre[a, m, m])
+                gim[a, m + 1, m] = (2 * m + 1) * (dz * im[m, m] + z * gim[a, m, m])
+            for n in range(m + 2, degree + 1):
+                gre[a, n, m] = ((2 * n - 1) * (dz * re[n - 1, m] + z * gre[a, n - 1, m])
+                                - (n + m - 1) * (2 * pos[a] * re[n - 2, m] + r2 * gre[a, n - 2, m])) / (n - m)
+                gim[a, n, m] = ((2 * n - 1) * (dz * im[n - 1, m] + z * gim[a, n - 1, m])
+                                - (n + m - 1) * (2 * pos[a] * im[n - 2, m] + r2 * gim[a, n - 2, m])) / (n - m)
+
+
+@numba.jit(nopython=True)
+def multipole_Bz_sus_gradient(dip_r, pos_r, dQ, n_col_stride, multipole_order):
+    """Gradient of the Bz susceptibility with respect to the sensor position
+
+    Populates `dQ[a]`, for `a` = 0, 1, 2, with the derivatives of the
+    columns of `multipole_Bz_sus` with respect to the `x`, `y` and `z`
+    coordinates of the sensors. The derivatives with respect to the
+    positions of the sources have the opposite sign. The columns of the
+    multipoles of order `l` are `c[l, m] S[l + 1, m] f_l`, with
+    `f_l = 1e-7 / r^(2l + 3)`, and the gradients of the solid harmonics `S`
+    are obtained by differentiating their recurrences
+
+    Parameters
+    ----------
+    dip_r
+        N x 3 array OR 1 x 3 array
+    pos_r
+        M x 3 array OR 1 x 3 array
+    dQ
+        `3 x M x (N * n_col_stride)` array
+    n_col_stride
+        Number of columns per source
+    multipole_order
+        Highest multipole order
+    """
+    L = multipole_order
+    c = _bz_normalisation(L)
+    re = np.zeros((L + 2, L + 2))
+    im = np.zeros((L + 2, L + 2))
+    gre = np.zeros((3, L + 2, L + 2))
+    gim = np.zeros((3, L + 2, L + 2))
+    re[0, 0] = 1.
+
+    for i in range(len(pos_r)):
+        for j in range(len(dip_r)):
+            x = pos_r[i, 0] - dip_r[j, 0]
+            y = pos_r[i, 1] - dip_r[j, 1]
+            z = pos_r[i, 2] - dip_r[j, 2]
+            r2 = x * x + y * y + z * z
+            _solid_harmonics_gradient(x, y, z, r2, L + 1, re, im, gre, gim)
+
+            inv_r2 = 1. / r2
+            f = 1e-7 * inv_r2 * inv_r2 / np.sqrt(r2)
+            for l in range(1, L + 1):
+                for a in range(3):
+                    # Derivative of 1 / r^(2l + 3)
+                    df = -(2 * l + 3) * (x, y, z)[a] * inv_r2 * f
+                    if l == 1:
+                        # Dipoles are ordered as mx, my, mz
+                        col = j * n_col_stride
+                        dQ[a, i, col] = c[1, 1] * (df * re[2, 1] + f * gre[a, 2, 1])
+                        dQ[a, i, col + 1] = c[1, 1] * (df * im[2, 1] + f * gim[a, 2, 1])
+                        dQ[a, i, col + 2] = c[1, 0] * (df * re[2, 0] + f * gre[a, 2, 0])
+                    else:
+                        col = j * n_col_stride + l * l - 1
+                        dQ[a, i, col] = c[l, 0] * (df * re[l + 1, 0] + f * gre[a, l + 1, 0])
+                        for m in range(1, l + 1):
+                            dQ[a, i, col + 2 * m - 1] = c[l, m] * (df * re[l + 1, m] + f * gre[a, l + 1, m])
+                            dQ[a, i, col + 2 * m] = c[l, m] * (df * im[l + 1, m] + f * gim[a, l + 1, m])
+                f *= inv_r2
+
+    return None
+
+
+@numba.jit(nopython=True, parallel=True)
+def multipole_Bz_position_jacobian(dip_r, pos_r, moments, multipole_order, Bz, J):
+    """Bz of the multipole sources and its derivatives with respect to their positions
+
+    Computes the field of the sources with the given moments and, for every
+    source, the derivatives of the field with respect to its position,
+    i.e. the products of the derivatives of the `multipole_Bz_sus` columns
+    of source `j` with its moments. Since the field of a source only
+    depends on its own position, the Jacobian of `Bz` with respect to the
+    positions is stored in per-source blocks of 3 columns. The sensors are
+    distributed across threads
+
+    Parameters
+    ----------
+    dip_r
+        N x 3 array with the positions of the sources
+    pos_r
+        M x 3 array with the positions of the sensors
+    moments
+        `N x n_cols` array with the multipole moments of every source, in
+        the order of the `multipole_Bz_sus` columns
+    multipole_order
+        Highest multipole order
+    Bz
+        Array of length `M` that is populated with the field
+    J
+        `M x N x 3` array that is populated with the derivatives of `Bz`
+        with respect to the `x`, `y` and `z` coordinates of the sources
+    """
+    L = multipole_order
+    c = _bz_normalisation(L)
+
+    for i in numba.prange(len(pos_r)):
+        re = np.zeros((L + 2, L + 2))
+        im = np.zeros((L + 2, L + 2))
+        gre = np.zeros((3, L + 2, L + 2))
+        gim = np.zeros((3, L + 2, L + 2))
+        re[0, 0] = 1.
+        Bz_i = 0.
+        for j in range(len(dip_r)):
+            x = pos_r[i, 0] - dip_r[j, 0]
+            y = pos_r[i, 1] - dip_r[j, 1]
+            z = pos_r[i, 2] - dip_r[j, 2]
+            r2 = x * x + y * y + z * z
+            _solid_harmonics_gradient(x, y, z, r2, L + 1, re, im, gre, gim)
+
+            inv_r2 = 1. / r2
+            f = 1e-7 * inv_r2 * inv_r2 / np.sqrt(r2)
+            # Field of the source and its derivatives with respect to the
+            # sensor position, without the normalisation factors f_l
+            b = 0.
+            gx, gy, gz = 0., 0., 0.
+            for l in range(1, L + 1):
+                # Sums of c[l, m] S[l + 1, m] moments and their gradients
+                s = 0.
+                sx, sy, sz = 0., 0., 0.
+                col = l * l - 1
+                for m in range(l + 1):
+                    if l == 1:
+                        # Dipoles are ordered as mx, my, mz
+                        m_re = moments[j, 2] if m == 0 else moments[j, 0]
+                        m_im = 0. if m == 0 else moments[j, 1]
+                    else:
+                        m_re = moments[j, col] if m == 0 else moments[j, col + 2 * m - 1]
+                        m_im = 0. if m == 0 else moments[j, col + 2 * m]
+                    w_re, w_im = c[l, m] * m_re, c[l, m] * m_im
+                    s += w_re * re[l + 1, m] + w_im * im[l + 1, m]
+                    sx += w_re * gre[0, l + 1, m] + w_im * gim[0, l + 1, m]
+                    sy += w_re * gre[1, l + 1, m] + w_im * gim[1, l + 1, m]
+                    sz += w_re * gre[2, l + 1, m] + w_im * gim[2, l + 1, m]
+                # Derivative of f_l = 1e-7 / r^(2l + 3)
+                df = -(2 * l + 3) * inv_r2 * f * s
+                b += f * s
+                gx += f * sx + x * df
+                gy += f * sy + y * df
+                gz += f * sz + z * df
+                f *= inv_r2
+            Bz_i += b
+            J[i, j, 0] = -gx
+            J[i, j, 1] = -gy
+            J[i, j, 2] = -gz
+        Bz[i] = Bz_i
+
+    return None
+
+
+@numba.jit(nopython=True)
+def _solid_harmonics_hessian(x, y, z, r2, degree, re, im, gre, gim, hre, him):
+    """Solid harmonics S[n, m], their gradients and their second derivatives
+
+    Differentiates the recurrences of `_solid_harmonics_gradient`:
+    `hre[k, n, m]` and `him[k, n, m]` are the second derivatives of
+    `re[n, m]` and `im[n, m]` with respect to the pair of coordinates
+    `(a, b)` = `(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)` for `k` = 0
+    to 5
+    """
+    _solid_harmonics_gradient(x, y, z, r2, degree, re, im, gre, gim)
+    pos = (x, y, z)
+    k = 0
+    for a in range(3):
+        for b in range(a, 3):
+            dz_a = 1. if a == 2 else 0.
+            dz_b = 1. if b == 2 else 0.
+            d_ab = 1. if a == b else 0.
+            for m in range(degree + 1):
+                if m > 0:
+                    # d(x + i y) S' is S' for x and i S' for y
+                    sre, sim = 0., 0.
+                    if a == 0:
+                        sre += gre[b, m - 1, m - 1]
+                        sim += gim[b, m - 1, m - 1]
+                    elif a == 1:
+                        sre -= gim[b, m - 1, m - 1]
+                        sim += gre[b, m - 1, m - 1]
+                    if b == 0:
+                        sre += gre[a, m - 1, m - 1]
+                        sim += gim[a, m - 1, m - 1]
+                    elif b == 1:
+                        sre -= gim[a, m - 1, m - 1]
+                        sim += gre[a, m - 1, m - 1]
+                    hre[k, m, m] = (2 * m - 1) * (sre + x * hre[k, m - 1, m - 1] - y * him[k, m - 1, m - 1])
+                    him[k, m, m] = (2 * m - 1) * (sim + x * him[k, m - 1, m - 1] + y * hre[k, m - 1, m - 1])
+                if m < degree:
+                    hre[k, m + 1, m] = (2 * m + 1) * (dz_a * gre[b, m, m] + dz_b * gre[a, m, m]
+                                                      + z * hre[k, m, m])
+                    him[k, m + 1, m] = (2 * m + 1) * (dz_a * gim[b, m, m] + dz_b * gim[a, m, m]
+                                                      + z * him[k, m, m])
+                for n in range(m + 2, degree + 1):
+                    hre[k, n, m] = ((2 * n - 1) * (dz_a * gre[b, n - 1, m] + dz_b * gre[a, n - 1, m]
+                                                   + z * hre[k, n - 1, m])
+                                    - (n + m - 1) * (2 * d_ab * re[n - 2, m]
+                                                     + 2 * pos[a] * gre[b, n - 2, m]
+                                                     + 2 * pos[b] * gre[a, n - 2, m]
+                                                     + r2 * hre[k, n - 2, m])) / (n - m)
+                    him[k, n, m] = ((2 * n - 1) * (dz_a * gim[b, n - 1, m] + dz_b * gim[a, n - 1, m]
+                                                   + z * him[k, n - 1, m])
+                                    - (n + m - 1) * (2 * d_ab * im[n - 2, m]
+                                                     + 2 * pos[a] * gim[b, n - 2, m]
+                                                     + 2 * pos[b] * gim[a, n - 2, m]
+                                                     + r2 * him[k, n - 2, m])) / (n - m)
+            k += 1
+
+
+@numba.jit(nopython=True)
+def multipole_Bz_sus_hessian(dip_r, pos_r, d2Q, n_col_stride, multipole_order):
+    """Second derivatives of the Bz susceptibility with respect to the sensor position
+
+    Populates `d2Q[k]` with the second derivatives of the columns of
+    `multipole_Bz_sus` with respect to the pair of sensor coordinates
+    `(a, b)` = `(x, x), (x, y), (x, z), (y, y), (y, z), (z, z)` for `k` = 0
+    to 5. The second derivatives with respect to the positions of the
+    sources are the same. See `multipole_Bz_sus_gradient`
+
+    Parameters
+    ----------
+    dip_r
+        N x 3 array OR 1 x 3 array
+    pos_r
+        M x 3 array OR 1 x 3 array
+    d2Q
+        `6 x M x (N * n_col_stride)` array
+    n_col_stride
+        Number of columns per source
+    multipole_order
+        Highest multipole order
+    """
+    L = multipole_order
+    c = _bz_normalisation(L)
+    re = np.zeros((L + 2, L + 2))
+    im = np.zeros((L + 2, L + 2))
+    gre = np.zeros((3, L + 2, L + 2))
+    gim = np.zeros((3, L + 2, L + 2))
+    hre = np.zeros((6, L + 2, L + 2))
+    him = np.zeros((6, L + 2, L + 2))
+    re[0, 0] = 1.
+
+    for i in range(len(pos_r)):
+        for j in range(len(dip_r)):
+            x = pos_r[i, 0] - dip_r[j, 0]
+            y = pos_r[i, 1] - dip_r[j, 1]
+            z = pos_r[i, 2] - dip_r[j, 2]
+            r2 = x * x + y * y + z * z
+            _solid_harmonics_hessian(x, y, z, r2, L + 1, re, im, gre, gim, hre, him)
+            pos = (x, y, z)
+
+            inv_r2 = 1. / r2
+            f = 1e-7 * inv_r2 * inv_r2 / np.sqrt(r2)
+            for l in range(1, L + 1):
+                p = 2 * l + 3
+                k = 0
+                for a in range(3):
+                    for b in range(a, 3):
+                        # Derivatives of f_l = 1e-7 / r^(2l + 3)
+                        fa = -p * pos[a] * inv_r2 * f
+                        fb = -p * pos[b] * inv_r2 * f
+                        fab = p * f * inv_r2 * ((p + 2) * pos[a] * pos[b] * inv_r2 - (1. if a == b else 0.))
+                        for m in range(l + 1):
+                            v_re = (fab * re[l + 1, m] + fa * gre[b, l + 1, m]
+                                    + fb * gre[a, l + 1, m] + f * hre[k, l + 1, m])
+                            v_im = (fab * im[l + 1, m] + fa * gim[b, l + 1, m]
+                                    + fb * gim[a, l + 1, m] + f * him[k, l + 1, m])
+                            if l == 1:
+                                # Dipoles are ordered as mx, my, mz
+                                col = j * n_col_stride
+                                if m == 0:
+                                    d2Q[k, i, col + 2] = c[1, 0] * v_re
+                                else:
+                                    d2Q[k, i, col] = c[1, 1] * v_re
+                                    d2Q[k, i, col + 1] = c[1, 1] * v_im
+                            else:
+                                col = j * n_col_stride + l * l - 1
+                                if m == 0:
+                                    d2Q[k, i, col] = c[l, 0] * v_re
+                                else:
+                                    d2Q[k, i, col + 2 * m - 1] = c[l, m] * v_re
+                                    d2Q[k, i, col + 2 * m] = c[l, m] * v_im
+                        k += 1
+                f *= inv_r2
+
+    return None
@@ -4,6 +4,35 @@
 #
 import numpy as np
 import numba
+from . import _flux_kernels
+
+
+@numba.jit(nopython=True)
+def flux_antiderivative(x, y, z, multipole_order):
+    """Antiderivative in `x`, `y` and `z` of the Bz susceptibility polynomials
+
+    Parameters
+    ----------
+    x, y, z
+        Arrays with the coordinates of the evaluation points (e.g. the sensor
+        corners) relative to the magnetic sources
+    multipole_order
+        Expansion order of the magnetic potential
+
+    Returns
+    -------
+    F
+        Array of shape `(len(x), n)` with the antiderivative of the `n`
+        multipole terms (3 for dipoles, 8 for quadrupoles and 15 for
+        octupoles), in units of `m^3 / 1e-7`. The volume flux in a cuboid is
+        the alternating sum of `F` at its corners
+
+    Notes
+    -----
+    The expressions are generated with sympy by `_kernel_codegen.py`, see
+    `_flux_kernels.py`
+    """
+    return _flux_kernels.volume_flux_antiderivative(x, y, z, multipole_order)
 
 
 # TODO: Check size of Q array
@@ -63,7 +92,8 @@ def multipole_Bz_sus(dip_r, pos_r, Q, n_col_stride,
 
     Notes
     -----
-    The integration of the polynomials were obtained mostly with W. Mathematica
+    The integrals of the polynomials are generated with sympy by
+    `_kernel_codegen.py`, see `flux_antiderivative`
     """
     f = 1e-7
     for i, ref_pos in enumerate(pos_r):
@@ -75,28 +105,87 @@ def multipole_Bz_sus(dip_r, pos_r, Q, n_col_stride,
                 for sx in [-1., 1.]:
                     sign = sx * sy * sz
 
-                    x = dr[:, 0] + sx * dx_sensor
-                    y = dr[:, 1] + sy * dy_sensor
-                    z = dr[:, 2] + sz * dz_sensor
+                    F = flux_antiderivative(dr[:, 0] + sx * dx_sensor,
+                                            dr[:, 1] + sy * dy_sensor,
+                                            dr[:, 2] + sz * dz_sensor,
+                                            multipole_order)
+                    for k in range(F.shape[1]):
+                        Q[i][k::n_col_stride] += sign * F[:, k]
+
+    # Multiply by f here or for every loop? This seems more optimal:
+    Q *= f
 
-                    x2, y2, z2 = x ** 2, y ** 2, z ** 2
-                    r = np.sqrt(x2 + y2 + z2)
+    return None
 
-                    # Dipole
-                    if multipole_order > 0:
-                        Q[i][::n_col_stride] += sign * np.arctanh(y / r)
-                        Q[i][1::n_col_stride] += sign * np.arctanh(x / r)
-                        Q[i][2::n_col_stride] += sign * (-np.arctan2(x * y, r * z))
 
-                    # Quadrupole
-                    if multipole_order > 1:
-                        Q[i][3::n_col_stride] += sign * (-1 / np.sqrt(6.)) * (x * y * (r * r + z2)) / ((x2 + z2) * (y2 + z2) * r)
-                        Q[i][4::n_col_stride] += sign * (np.sqrt(2.) / 3.) * y * z / (r * (x2 + z2))
-                        Q[i][5::n_col_stride] += sign * (np.sqrt(2.) / 3.) * x * z / (r * (y2 + z2))
-                        Q[i][6::n_col_stride] += sign * (-1. / (np.sqrt(2.) * 3.)) * x * y * (x2 - y2) / ((x2 + z2) * (y2 + z2) * r)
-                        Q[i][7::n_col_stride] += sign * (-np.sqrt(2.) / 3.) / r
+@numba.jit(nopython=True)
+def multipole_Bz_sus_grid(dip_r, x_corners, y_corners, z_corners,
+                          ix_corners, iy_corners, Q, n_col_stride,
+                          multipole_order):
+    r"""Populate the susceptibility matrix using 3D sensors in a regular grid
+
+    Computes the same matrix than `multipole_Bz_sus` for sensors whose
+    centres form a regular `Nx x Ny` grid in a plane. Instead of evaluating
+    the antiderivative at the 8 corners of every sensor, it is evaluated once
+    per grain at every node of the lattice of sensor corners, and the sensor
+    flux is obtained by finite differences of the lattice. When the sensor
+    size is a multiple of the scan step, neighbouring sensors share corners:
+    the lattice has two layers (the lower and upper faces of the sensors) of
+    about one node per sensor. Hence the antiderivative is evaluated at about
+    2 nodes per sensor instead of at its 8 corners, a reduction by a factor
+    of approximately 4 (the sensors only share corners laterally).
 
-    # Multiply by f here or for every loop? This seems more optimal:
-    Q *= f
+    Parameters
+    ----------
+    dip_r
+        `N x 3` array with the positions of the magnetic point sources
+    x_corners, y_corners
+        Sorted arrays with the unique `x` and `y` coordinates of the sensor
+        corners
+    z_corners
+        Array with the lower and upper `z` coordinates of the sensors
+    ix_corners, iy_corners
+        `Nx x 2` and `Ny x 2` arrays with the indices in `x_corners` and
+        `y_corners` of the lower and upper corners of the sensors in every
+        grid column and row. The sensor in the row `j` and column `i` of the
+        grid populates the row `j * Nx + i` of `Q`
+    Q
+        Susceptibility / Forward matrix to be populated
+    n_col_stride
+        Number of column strides to populate the `Q` matrix. This is defined
+        by the multipole order of the potential expansion
+    multipole_order
+        Expansion order of the magnetic potential
+    """
+    f = 1e-7
+    Mx, My = len(x_corners), len(y_corners)
+    Nx, Ny = len(ix_corners), len(iy_corners)
+
+    x = np.empty(2 * My * Mx)
+    y = np.empty(2 * My * Mx)
+    z = np.empty(2 * My * Mx)
+
+    for j in range(len(dip_r)):
+        for n in range(2):
+            for m in range(My):
+                for l in range(Mx):
+                    x[(n * My + m) * Mx + l] = x_corners[l] - dip_r[j, 0]
+                    y[(n * My + m) * Mx + l] = y_corners[m] - dip_r[j, 1]
+                    z[(n * My + m) * Mx + l] = z_corners[n] - dip_r[j, 2]
+
+        F = flux_antiderivative(x, y, z, multipole_order)
+        F = F.reshape((2, My, Mx, F.shape[1]))
+
+        for iy in range(Ny):
+            y0, y1 = iy_corners[iy, 0], iy_corners[iy, 1]
+            for ix in range(Nx):
+                x0, x1 = ix_corners[ix, 0], ix_corners[ix, 1]
+                row = iy * Nx + ix
+                for k in range(F.shape[3]):
+                    flux = 0.
+                    for n, sz in [(0, -1.), (1, 1.)]:
+                        flux += sz * (F[n, y1, x1, k] - F[n, y1, x0, k]
+                                      - F[n, y0, x1, k] + F[n, y0, x0, k])
+                    Q[row, j * n_col_stride + k] = f * flux
 
     return None
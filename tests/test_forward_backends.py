@@ -0,0 +1,434 @@
+import numpy as np
+import mmt_multipole_inversion.multipole_inversion as minv
+import mmt_multipole_inversion.forward_backends as fwb
+from pathlib import Path
+import pytest
+from test_inversion import fw_model_fun
+
+
+def _inversion_model(limit='quadrupole', sus_module='spherical_harmonics_basis'):
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit=limit,
+        sus_functions_module=sus_module)
+    return inv_model
+
+
+def test_find_backends():
+    """
+    Test that backends are sorted by speed and filtered by capabilities
+    """
+    backends = fwb.find_backends('spherical_harmonics_basis', 'point', 3)
+    speeds = [b.speed for b in backends]
+    assert speeds == sorted(speeds, reverse=True)
+    assert 'numba' in [b.name for b in backends]
+
+    # The CUDA library only populates point sensors
+    backends = fwb.find_backends('spherical_harmonics_basis_area', 'area', 3)
+    assert 'numba' in [b.name for b in backends]
+    assert 'cuda' not in [b.name for b in backends]
+
+    inv_model = _inversion_model(limit='octupole',
+                                 sus_module='spherical_harmonics_basis_area')
+    inv_model.sensor_dims = (0.5e-6,)
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix()
+
+    # No backend populates area sensors beyond the highest quadrature order
+    order = fwb.MAX_ORDER + 1
+    assert len(fwb.find_backends('spherical_harmonics_basis_area', 'area', order)) == 0
+    inv_model.sensor_dims = (0.5e-6, 0.5e-6)
+    inv_model.expansion_limit = order
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='auto')
+    # The numba method does not integrate the octupole recurrence over areas
+    inv_model.expansion_limit = 4
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='numba')
+
+
+_GEOMETRY_DIMS = {'point': (), 'area': (0.5e-6, 0.5e-6), 'volume': (0.3e-6, 0.5e-6, 0.2e-6)}
+
+
+@pytest.mark.parametrize("name", sorted(fwb.BACKENDS))
+def test_advertised_orders(name):
+    """
+    Check that a backend populates Q for every susceptibility module, sensor
+    geometry and multipole order it declares
+    """
+    backend = fwb.BACKENDS[name]
+    if not backend.available():
+        pytest.skip(f'Backend {name} not available')
+    if name == 'table':
+        pytest.skip('The table backend interpolates a precomputed kernel table')
+
+    for basis in backend.bases:
+        geometry = ('area' if basis in fwb.AREA_BASES else
+                    'volume' if basis in fwb.VOLUME_BASES else 'point')
+        for order in range(1, fwb.MAX_ORDER + 2):
+            if not backend.supports(basis, geometry, order):
+                continue
+            inv_model = _inversion_model(limit=order, sus_module=basis)
+            inv_model.sensor_dims = _GEOMETRY_DIMS[geometry]
+            if name == 'psf':
+                inv_model.sensor_psf = np.full((3, 3), 1. / 9.)
+            inv_model.generate_forward_matrix(optimization=name)
+            assert np.all(np.isfinite(inv_model.Q)), (basis, order)
+            assert np.all(np.any(inv_model.Q != 0., axis=0)), (basis, order)
+
+
+def test_generated_flux_kernels():
+    """
+    Check that the area and volume flux kernels in the repository are the
+    output of the code generator
+    """
+    pytest.importorskip('sympy')
+    from mmt_multipole_inversion.susceptibility_modules import _kernel_codegen
+    directory = Path(_kernel_codegen.__file__).parent
+    assert (directory / '_flux_kernels.py').read_text() == _kernel_codegen.numba_source()
+    assert ((directory / 'openmp' / '_flux_kernels.pxi').read_text()
+            == _kernel_codegen.cython_source())
+
+
+def test_backend_fallback():
+    """
+    Register a fast backend that fails and check that the auto dispatch
+    falls back to the next available backend
+    """
+    def failing_populate(inv, r_sources, r_sensors, sensor_dims, **kwargs):
+        raise RuntimeError('Backend failure')
+
+    fwb.register_backend(fwb.ForwardBackend(
+        'TEST_failing', failing_populate,
+        bases=fwb.POINT_BASES, sensor_geometries=('point',), orders=(1, 2, 3),
+        speed=1e6))
+
+    try:
+        inv_model = _inversion_model()
+        inv_model.generate_forward_matrix(optimization='auto')
+        assert inv_model.forward_backend != 'TEST_failing'
+        Q_auto = np.copy(inv_model.Q)
+
+        inv_model.generate_forward_matrix(optimization='numba')
+        atol = 1e-10 * np.abs(inv_model.Q).max()
+        assert np.allclose(Q_auto, inv_model.Q, rtol=1e-8, atol=atol)
+
+        # A backend requested explicitly does not fall back
+        with pytest.raises(RuntimeError):
+            inv_model.generate_forward_matrix(optimization='TEST_failing')
+    finally:
+        fwb.BACKENDS.pop('TEST_failing')
+
+
+def test_backend_plugin():
+    """
+    Register a backend that takes the positions from the inversion instead of
+    the keyword arguments
+    """
+    def populate(inv, **kwargs):
+        inv.Q[:] = fwb.kernel_columns(inv.sus_functions_module,
+                                      fwb.multipole_order(inv.expansion_limit),
+                                      inv.particle_positions, inv.scan_positions)
+
+    fwb.register_backend(fwb.ForwardBackend(
+        'TEST_plugin', populate,
+        bases=fwb.POINT_BASES, sensor_geometries=('point',), orders=(1, 2, 3)))
+
+    try:
+        inv_model = _inversion_model()
+        inv_model.generate_forward_matrix(optimization='TEST_plugin')
+        assert inv_model.forward_backend == 'TEST_plugin'
+        Q_plugin = np.copy(inv_model.Q)
+        inv_model.generate_forward_matrix()
+        assert inv_model.forward_backend == 'numba'
+        assert np.allclose(Q_plugin, inv_model.Q, rtol=1e-12, atol=0.)
+    finally:
+        fwb.BACKENDS.pop('TEST_plugin')
+
+
+@pytest.mark.parametrize("sensor_dims", [(0.5e-6, 0.5e-6), (0.5e-6, 1e-6),
+                                         (0.3e-6, 0.5e-6, 0.2e-6)],
+                         ids=['area', 'area_overlap', 'volume'])
+@pytest.mark.parametrize("limit", ['dipole', 'quadrupole', 'octupole'])
+def test_compare_numba_grid_populate_array(limit, sensor_dims):
+    """
+    Compare the forward matrix of area and volume sensors computed sharing
+    the corners of the scan grid with the sensor by sensor calculation
+    """
+    sus_module = {2: 'spherical_harmonics_basis_area',
+                  3: 'spherical_harmonics_basis_volume'}[len(sensor_dims)]
+    inv_model = _inversion_model(limit=limit, sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+
+    inv_model.generate_forward_matrix(optimization='numba')
+    Q_numba = np.copy(inv_model.Q)
+    inv_model.generate_forward_matrix(optimization='numba_grid')
+    assert inv_model.forward_backend == 'numba_grid'
+
+    atol = 1e-10 * np.abs(Q_numba).max()
+    assert np.allclose(inv_model.Q, Q_numba, rtol=1e-8, atol=atol)
+
+    # Sensors outside the regular grid are not supported
+    positions = np.copy(inv_model.scan_positions)
+    positions[0, 0] += 1e-7
+    inv_model.scan_positions = positions
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='numba_grid')
+
+
+@pytest.mark.parametrize("sensor_dims", [(0.5e-6, 0.4e-6), (0.5e-6, 0.4e-6, 0.2e-6)],
+                         ids=['area', 'volume'])
+def test_area_volume_quadrature(sensor_dims):
+    """
+    Compare the forward matrix of area and volume sensors, up to octupoles,
+    with the average of the point sensor matrix computed with a Gauss-Legendre
+    quadrature over the sensors
+    """
+    sus_module = {2: 'spherical_harmonics_basis_area',
+                  3: 'spherical_harmonics_basis_volume'}[len(sensor_dims)]
+    inv_model = _inversion_model(limit='octupole', sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+    inv_model.generate_forward_matrix(optimization='numba')
+
+    nodes, weights = np.polynomial.legendre.leggauss(12)
+    offsets = [nodes * d for d in sensor_dims] + [np.zeros(1)] * (3 - len(sensor_dims))
+    wts = [weights / 2 for d in sensor_dims] + [np.ones(1)] * (3 - len(sensor_dims))
+    offsets = np.stack(np.meshgrid(*offsets, indexing='ij'), axis=-1).reshape(-1, 3)
+    wts = np.prod(np.stack(np.meshgrid(*wts, indexing='ij'), axis=-1), axis=-1).reshape(-1)
+
+    Q_quad = np.zeros_like(inv_model.Q)
+    positions = inv_model.scan_positions
+    for offset, w in zip(offsets, wts):
+        Q_quad += w * fwb.kernel_columns('spherical_harmonics_basis', 3,
+                                         inv_model.particle_positions,
+                                         positions + offset)
+    assert np.allclose(inv_model.Q, Q_quad, rtol=0., atol=1e-7 * np.abs(Q_quad).max())
+
+
+@pytest.mark.parametrize("sus_module,sensor_dims",
+                         [('spherical_harmonics_basis', ()),
+                          ('spherical_harmonics_basis_area', (0.5e-6, 0.5e-6))],
+                         ids=['point', 'area'])
+def test_sensor_grid(sus_module, sensor_dims):
+    """
+    Check that the forward matrix computed from the sensor grid descriptor
+    is the same than using an explicit array of sensor positions
+    """
+    inv_model = _inversion_model(sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+
+    # Positions generated from the grid follow the order of the Bz array
+    X_pos, Y_pos = np.meshgrid(inv_model.Sx_range, inv_model.Sy_range)
+    assert inv_model.scan_positions.shape == (inv_model.N_sensors, 3)
+    assert np.allclose(inv_model.scan_positions[:, 0], X_pos.reshape(-1))
+    assert np.allclose(inv_model.scan_positions[:, 1], Y_pos.reshape(-1))
+    assert np.allclose(inv_model.scan_positions[:, 2], inv_model.Hz)
+    # The positions of the grid are generated once
+    assert inv_model.scan_positions is inv_model.scan_positions
+
+    inv_model.generate_forward_matrix(optimization='numba')
+    Q_grid = np.copy(inv_model.Q)
+    assert inv_model._explicit_scan_positions() is None
+
+    # Positions modified in place are used as explicit positions
+    inv_model.scan_positions[0, 0] += 1e-7
+    inv_model.generate_forward_matrix(optimization='numba')
+    assert inv_model._explicit_scan_positions() is not None
+    assert not np.allclose(inv_model.Q[0], Q_grid[0])
+    assert np.array_equal(inv_model.Q[1:], Q_grid[1:])
+    inv_model.scan_positions = None
+    assert inv_model._explicit_scan_positions() is None
+
+    inv_model.scan_positions = inv_model.sensor_grid.positions()
+    inv_model.generate_forward_matrix(optimization='numba')
+    assert np.allclose(inv_model.Q, Q_grid, rtol=1e-12, atol=0.)
+
+    # Explicit positions of an irregular set of sensors
+    positions = inv_model.sensor_grid.positions()
+    positions[:, :2] += np.random.default_rng(42).normal(scale=1e-7, size=(inv_model.N_sensors, 2))
+    inv_model.scan_positions = positions
+    inv_model.generate_forward_matrix(optimization='numba')
+    assert not np.allclose(inv_model.Q, Q_grid)
+
+    with pytest.raises(ValueError):
+        inv_model.scan_positions = positions[1:]
+
+
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+@pytest.mark.parametrize("sus_module,sensor_dims,limit",
+                         [('spherical_harmonics_basis', (), 'octupole'),
+                          ('spherical_harmonics_basis_area', (0.5e-6, 0.5e-6), 'quadrupole')],
+                         ids=['point', 'area'])
+def test_compare_numba_lattice_populate_array(sus_module, sensor_dims, limit, layout):
+    """
+    Compare the forward matrix of particles aligned with the scan grid,
+    computed from one field image per group, with the numba calculation
+    """
+    inv_model = _inversion_model(limit=limit, sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+    inv_model.Q_layout = layout
+
+    # Two layers of particles in a voxel grid shifted from the scan grid by
+    # a quarter of the scan step, and a particle outside the voxel grid
+    step = inv_model.Sdx
+    X, Y = np.meshgrid(np.arange(4, 16, 3) * step, np.arange(5, 15, 4) * step)
+    layer = np.column_stack((X.reshape(-1) + 0.25 * step, Y.reshape(-1), np.zeros(X.size)))
+    positions = np.vstack((layer - [0., 0., 2e-6], layer - [0., 0., 3e-6],
+                           [[8.3e-6, 9.6e-6, -2.5e-6]]))
+    inv_model.particle_positions = positions
+    inv_model.N_particles = len(positions)
+
+    groups = fwb.lattice_groups(positions, inv_model.sensor_grid)
+    assert sorted(len(g[0]) for g in groups) == [1, X.size, X.size]
+    geometry = fwb.sensor_geometry(sus_module)
+    order = fwb.multipole_order(limit)
+    assert 'numba_lattice' in [b.name for b in fwb.find_backends(sus_module, geometry, order,
+                                                                 inv=inv_model)]
+
+    inv_model.generate_forward_matrix(optimization='numba')
+    Q_numba = np.copy(inv_model.Q)
+    inv_model.generate_forward_matrix(optimization='numba_lattice')
+    assert inv_model.forward_backend == 'numba_lattice'
+
+    atol = 1e-10 * np.abs(Q_numba).max()
+    assert np.allclose(inv_model.Q, Q_numba, rtol=1e-8, atol=atol)
+
+    # Particles that are not aligned with the grid are not computed with the
+    # lattice method by the automatic dispatch
+    positions[:, :2] += np.random.default_rng(0).uniform(-0.5, 0.5, (len(positions), 2)) * step
+    assert 'numba_lattice' not in [b.name for b in fwb.find_backends(sus_module, geometry, order,
+                                                                     inv=inv_model)]
+
+
+def test_multipole_recurrence():
+    """
+    Compare the recurrence of the spherical harmonics basis with the
+    functions of every multipole order, and check that the hexadecapole
+    columns are harmonic functions of the sensor position
+    """
+    sus_mod = fwb.sus_mods.spherical_harmonics_basis
+    rng = np.random.default_rng(1)
+    r_sources = rng.uniform(-2e-6, 2e-6, (4, 3))
+    r_sensors = rng.uniform(-5e-6, 5e-6, (30, 3))
+    r_sensors[:, 2] = 4e-6
+
+    Q_ref = np.zeros((30, 4 * 15))
+    sus_mod.dipole_Bz_sus(r_sources, r_sensors, Q_ref, 15)
+    sus_mod.quadrupole_Bz_sus(r_sources, r_sensors, Q_ref, 15)
+    sus_mod.octupole_Bz_sus(r_sources, r_sensors, Q_ref, 15)
+    Q = np.zeros_like(Q_ref)
+    sus_mod.multipole_Bz_sus(r_sources, r_sensors, Q, 15, 3)
+    assert np.allclose(Q, Q_ref, rtol=1e-12, atol=1e-12 * np.abs(Q_ref).max())
+
+    # Laplacian of the order 4 columns with finite differences
+    h = 1e-8
+    Q4 = fwb.kernel_columns('spherical_harmonics_basis', 4, r_sources[:1], r_sensors, ())
+    lap = -6 * Q4
+    for axis in range(3):
+        for sign in (-1, 1):
+            shifted = r_sensors.copy()
+            shifted[:, axis] += sign * h
+            lap += fwb.kernel_columns('spherical_harmonics_basis', 4, r_sources[:1], shifted, ())
+    cols = fwb.order_columns(4)
+    assert np.abs(lap[:, cols] / h ** 2).max() < 1e-4 * np.abs(Q4[:, cols]).max() / 1e-12
+
+
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_integer_expansion_limit(layout):
+    """
+    Test an inversion with hexadecapoles (expansion limit 4), whose forward
+    matrix contains the octupole matrix
+    """
+    inv_model = _inversion_model(limit=4)
+    inv_model.Q_layout = layout
+    assert inv_model._N_cols == 24
+    inv_model.generate_forward_matrix()
+    assert inv_model.Q.shape[1] == 24 * inv_model.N_particles
+
+    Q4 = inv_model.get_forward_submatrix('octupole')
+    inv_model.expansion_limit = 'octupole'
+    inv_model.generate_forward_matrix()
+    Q3 = inv_model.get_forward_submatrix('octupole')
+    scale = np.abs(Q3).max(axis=0)
+    assert np.allclose(Q4 / scale, Q3 / scale, rtol=1e-10, atol=1e-12)
+
+    inv_model.expansion_limit = 4
+    nested = inv_model.compare_expansion_limits()
+    assert list(nested) == ['dipole', 'quadrupole', 'octupole', 4]
+    assert nested[4]['inv_multipole_moments'].shape == (inv_model.N_particles, 24)
+    assert nested[4]['residual_norm'] <= nested['octupole']['residual_norm']
+
+    # Orders larger than 3 are not implemented for the other bases
+    inv_model = _inversion_model(limit=4, sus_module='maxwell_cartesian_polynomials')
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix()
+
+
+@pytest.mark.parametrize("sensor_dims", [(0.5e-6, 0.4e-6), (0.5e-6, 0.4e-6, 0.2e-6)],
+                         ids=['area', 'volume'])
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_sensor_quadrature(sensor_dims, layout):
+    """
+    Compare the Gauss-Legendre integration of the point kernels with the
+    closed-form flux of the area and volume sensors, and check that far
+    sensors are computed with the point kernel
+    """
+    sus_module = ('spherical_harmonics_basis_area' if len(sensor_dims) == 2
+                  else 'spherical_harmonics_basis_volume')
+    inv_model = _inversion_model(limit='octupole', sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+    inv_model.Q_layout = layout
+
+    inv_model.generate_forward_matrix(optimization='numba')
+    Q_ref = inv_model.Q.copy()
+    inv_model.generate_forward_matrix(optimization='quadrature', quadrature_tol=1e-8)
+    scale = np.abs(Q_ref).max(axis=0)
+    assert np.allclose(inv_model.Q / scale, Q_ref / scale, rtol=0., atol=1e-7)
+
+    r_sources = np.array([[0., 0., -2e-6]])
+    r_sensors = np.array([[1e-3, 0., 0.], [0., 2e-3, 0.]])
+    Q = np.zeros((2, 15))
+    n_evaluations = fwb.sensor_quadrature.integrate_point_kernel(
+        r_sources, r_sensors, sensor_dims, 3, Q, np.arange(15).reshape(1, 15))
+    assert n_evaluations == 2
+    Q_point = fwb.kernel_columns('spherical_harmonics_basis', 3, r_sources, r_sensors, ())
+    assert np.allclose(Q / np.prod(2 * np.array(sensor_dims)), Q_point, rtol=1e-12, atol=0.)
+
+    # Orders without closed-form antiderivatives use the quadrature
+    inv_model.expansion_limit = 4
+    inv_model.generate_forward_matrix(optimization='auto')
+    assert inv_model.forward_backend == 'quadrature'
+
+
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_sensor_psf(layout):
+    """
+    Compare the FFT convolution of the point-sensor columns with a
+    point-spread function with the sum of the displaced point-sensor fields
+    """
+    inv_model = _inversion_model(limit='octupole')
+    inv_model.Q_layout = layout
+    rng = np.random.default_rng(3)
+    psf = rng.uniform(size=(3, 5))
+    inv_model.sensor_psf = psf / psf.sum()
+    inv_model.generate_forward_matrix()
+    assert inv_model.forward_backend == 'psf'
+
+    positions = inv_model.scan_positions
+    Q_ref = np.zeros_like(inv_model.Q)
+    columns = inv_model.multipole_column_indices().reshape(-1)
+    for (v, u), weight in np.ndenumerate(inv_model.sensor_psf):
+        shift = np.array([(u - 2) * inv_model.Sdx, (v - 1) * inv_model.Sdy, 0.])
+        Q_ref[:, columns] += weight * fwb.kernel_columns(
+            'spherical_harmonics_basis', 3, inv_model.particle_positions,
+            positions + shift, ())
+    scale = np.abs(Q_ref).max(axis=0)
+    assert np.allclose(inv_model.Q / scale, Q_ref / scale, rtol=0., atol=1e-10)
+
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='numba_lattice')
+    with pytest.raises(ValueError):
+        inv_model.sensor_psf = np.ones((2, 3))
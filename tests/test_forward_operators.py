@@ -0,0 +1,165 @@
+import numpy as np
+import mmt_multipole_inversion.forward_operators as fwo
+import pytest
+from test_forward_backends import _inversion_model
+
+
+def _random_particles(inv_model, N=30, seed=0):
+    """Place particles at random lateral positions in three depth layers"""
+    rng = np.random.default_rng(seed)
+    positions = np.column_stack((rng.uniform(2e-6, 18e-6, (N, 2)),
+                                 rng.choice([-2e-6, -3e-6, -4.5e-6], N)))
+    inv_model.particle_positions = positions
+    inv_model.N_particles = N
+
+
+@pytest.mark.parametrize("sus_module,sensor_dims,limit",
+                         [('spherical_harmonics_basis', (), 'octupole'),
+                          ('spherical_harmonics_basis_area', (0.5e-6, 0.5e-6), 'quadrupole')],
+                         ids=['point', 'area'])
+def test_fft_forward_operator(sus_module, sensor_dims, limit):
+    """
+    Compare the products of the FFT forward operator with the forward matrix
+    """
+    inv_model = _inversion_model(limit=limit, sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+    _random_particles(inv_model)
+    inv_model.generate_forward_matrix()
+
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=inv_model.Q.shape[1])
+    y = rng.normal(size=inv_model.Q.shape[0])
+
+    op = fwo.FFTForwardOperator(inv_model, upsampling=4, interp_order=8)
+    assert len(op.layers) == 3
+    Qx, QTy = inv_model.Q @ x, inv_model.Q.T @ y
+    assert np.linalg.norm(op.matvec(x) - Qx) < 1e-4 * np.linalg.norm(Qx)
+    assert np.linalg.norm(op.rmatvec(y) - QTy) < 1e-4 * np.linalg.norm(QTy)
+    assert op.error_estimate(n_samples=5, seed=2) < 1e-4
+    assert np.allclose(op.column_norms(), np.linalg.norm(inv_model.Q, axis=0), rtol=1e-3)
+
+    # The operator and its transpose are consistent
+    assert np.isclose(np.dot(y, op.matvec(x)), np.dot(op.rmatvec(y), x), rtol=1e-10)
+
+    # The error decreases with the resolution of the fine grid
+    op_coarse = fwo.FFTForwardOperator(inv_model, upsampling=1, interp_order=4)
+    assert np.linalg.norm(op_coarse.matvec(x) - Qx) > np.linalg.norm(op.matvec(x) - Qx)
+
+
+def test_fft_forward_operator_depth_interpolation():
+    """
+    Particles at random depths share the layers of the depth interpolation,
+    whose error follows the tolerance
+    """
+    inv_model = _inversion_model(limit='octupole')
+    rng = np.random.default_rng(0)
+    N = 60
+    inv_model.particle_positions = np.column_stack((rng.uniform(2e-6, 18e-6, (N, 2)),
+                                                    rng.uniform(-4.5e-6, -2e-6, N)))
+    inv_model.N_particles = N
+    inv_model.generate_forward_matrix()
+
+    x = rng.normal(size=inv_model.Q.shape[1])
+    y = rng.normal(size=inv_model.Q.shape[0])
+    Qx = inv_model.Q @ x
+    errors = []
+    for depth_tol in [1e-3, 1e-5]:
+        op = fwo.FFTForwardOperator(inv_model, upsampling=4, interp_order=8, depth_tol=depth_tol)
+        assert len(op.layers) < N
+        errors.append(np.linalg.norm(op.matvec(x) - Qx) / np.linalg.norm(Qx))
+        assert np.isclose(np.dot(y, op.matvec(x)), np.dot(op.rmatvec(y), x), rtol=1e-10)
+    assert errors[0] < 1e-3 and errors[1] < 1e-5
+    assert errors[1] < errors[0]
+    assert np.allclose(op.column_norms(), np.linalg.norm(inv_model.Q, axis=0), rtol=1e-3)
+
+
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_inversion_fft_lsqr(layout):
+    """
+    Invert the single dipole sample with LSQR and the FFT forward operator.
+    The dipole is at a sensor position, hence the operator is exact
+    """
+    inv_model = _inversion_model(limit='quadrupole')
+    inv_model.Q_layout = layout
+    inv_model.generate_forward_operator(upsampling=1, interp_order=4)
+    assert inv_model.forward_operator.error_estimate() < 1e-10
+
+    inv_model.compute_inversion(method='fft_lsqr', atol=1e-14, btol=1e-14, iter_lim=500)
+    assert inv_model.Q.size == 0
+
+    inv_ref = _inversion_model(limit='quadrupole')
+    inv_ref.compute_inversion(method='direct')
+    assert np.allclose(inv_model.inv_multipole_moments, inv_ref.inv_multipole_moments,
+                       rtol=1e-4, atol=1e-6 * np.abs(inv_ref.inv_multipole_moments).max())
+    assert np.allclose(inv_model.inv_Bz_array, inv_ref.inv_Bz_array,
+                       rtol=1e-4, atol=1e-6 * np.abs(inv_ref.Bz_array).max())
+
+    # Weighted least squares with a noise map
+    rng = np.random.default_rng(0)
+    sigma = 1e-3 * np.abs(inv_ref.Bz_array).max() * rng.uniform(1., 10., inv_ref.Bz_array.shape)
+    inv_model.Bz_array = inv_ref.Bz_array + rng.normal(size=sigma.shape) * sigma
+    inv_ref.Bz_array = inv_model.Bz_array
+    inv_model.compute_inversion(method='fft_lsqr', sigma_field_noise=sigma,
+                                atol=1e-14, btol=1e-14, iter_lim=500)
+    inv_ref.compute_inversion(method='direct', sigma_field_noise=sigma)
+    assert np.allclose(inv_model.inv_multipole_moments, inv_ref.inv_multipole_moments,
+                       rtol=1e-4, atol=1e-6 * np.abs(inv_ref.inv_multipole_moments).max())
+
+    # Sensors that are not in a grid are not supported
+    inv_model.scan_positions = inv_model.sensor_grid.positions()
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_operator()
+
+
+@pytest.mark.parametrize("sus_module,sensor_dims,limit",
+                         [('spherical_harmonics_basis', (), 'octupole'),
+                          ('spherical_harmonics_basis_area', (0.5e-6, 0.5e-6), 'quadrupole')],
+                         ids=['point', 'area'])
+def test_hmatrix_forward_operator(sus_module, sensor_dims, limit):
+    """
+    Compare the products of the hierarchical matrix with the forward matrix
+    """
+    inv_model = _inversion_model(limit=limit, sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+    _random_particles(inv_model, N=60)
+    inv_model.generate_forward_matrix()
+
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=inv_model.Q.shape[1])
+    y = rng.normal(size=inv_model.Q.shape[0])
+
+    op = fwo.HMatrixForwardOperator(inv_model, leaf_size=16, eta=4., tol=1e-6)
+    assert op.compression_ratio < 1.
+    assert any(V is not None for _, _, _, V in op.blocks)
+    Qx, QTy = inv_model.Q @ x, inv_model.Q.T @ y
+    assert np.linalg.norm(op.matvec(x) - Qx) < 1e-5 * np.linalg.norm(Qx)
+    assert np.linalg.norm(op.rmatvec(y) - QTy) < 1e-5 * np.linalg.norm(QTy)
+    assert np.allclose(op.column_norms(), np.linalg.norm(inv_model.Q, axis=0), rtol=1e-5)
+
+    # Approximate factorization
+    n = min(op.shape)
+    U, s, Vt = op.factorize(rank=n, seed=3)
+    assert np.allclose(s, np.linalg.svd(inv_model.Q, compute_uv=False)[:n],
+                       rtol=1e-4, atol=1e-6 * s[0])
+
+
+def test_inversion_hmatrix_lsqr():
+    """
+    Invert the single dipole sample with LSQR and the hierarchical matrix
+    """
+    inv_model = _inversion_model(limit='quadrupole')
+    inv_model.generate_forward_operator('hmatrix', leaf_size=32, tol=1e-10)
+    inv_model.compute_inversion(method='hmatrix_lsqr', atol=1e-14, btol=1e-14, iter_lim=500)
+    assert inv_model.Q.size == 0
+
+    inv_ref = _inversion_model(limit='quadrupole')
+    inv_ref.compute_inversion(method='direct')
+    assert np.allclose(inv_model.inv_multipole_moments, inv_ref.inv_multipole_moments,
+                       rtol=1e-4, atol=1e-6 * np.abs(inv_ref.inv_multipole_moments).max())
+
+    # Truncated SVD solution
+    op = inv_model.forward_operator
+    op.factorize(rank=op.shape[1], seed=0)
+    solution = op.lstsq(inv_model.Bz_array.reshape(-1))
+    assert np.allclose(inv_model._moments_from_solution(solution), inv_ref.inv_multipole_moments,
+                       rtol=1e-4, atol=1e-6 * np.abs(inv_ref.inv_multipole_moments).max())
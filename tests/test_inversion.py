@@ -8,6 +8,11 @@ try:
     HASCUDA = True
 except ImportError:
     HASCUDA = False
+try:
+    from mmt_multipole_inversion.susceptibility_modules.openmp import cpulib as sus_cpulib
+    HASOPENMP = True
+except ImportError:
+    HASOPENMP = False
 
 LIMIT_params = ['dipole', 'quadrupole', 'octupole']
 
@@ -215,6 +220,209 @@ def test_inversion_single_dipole_cuda(limit):
         assert rel_diff < 1e-6
 
 
+@pytest.mark.skipif(not HASOPENMP, reason="OpenMP library not found")
+@pytest.mark.parametrize("limit", LIMIT_params, ids=['dip', 'quad', 'oct'])
+@pytest.mark.parametrize("sus_module,sensor_dims",
+                         [('spherical_harmonics_basis', ()),
+                          ('maxwell_cartesian_polynomials', ()),
+                          ('cartesian_spherical_harmonics', ()),
+                          ('spherical_harmonics_basis_area', (0.5e-6, 0.5e-6)),
+                          ('spherical_harmonics_basis_volume', (0.5e-6, 0.5e-6, 0.5e-6))],
+                         ids=['SHB', 'MCP', 'CSH', 'area', 'volume'])
+def test_compare_openmp_numba_populate_array(limit, sus_module, sensor_dims):
+    """
+    Compare the forward matrices populated with the OpenMP and numba functions
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+
+    Qs = {}
+    for optimization in ['openmp', 'numba']:
+        inv_model = minv.MultipoleInversion(
+            TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+            TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+            expansion_limit=limit,
+            sus_functions_module=sus_module)
+        inv_model.sensor_dims = sensor_dims
+        inv_model.generate_measurement_mesh()
+        inv_model.generate_forward_matrix(optimization=optimization)
+        Qs[optimization] = np.copy(inv_model.Q)
+
+    # Both libraries evaluate the same expressions in double precision, so the
+    # differences come only from the order of floating point operations
+    atol = 1e-10 * np.abs(Qs['numba']).max()
+    assert np.allclose(Qs['openmp'], Qs['numba'], rtol=1e-8, atol=atol)
+
+
+@pytest.mark.parametrize("optimization", ['numba', 'auto'])
+def test_order_blocked_layout(optimization):
+    """
+    Compare the forward matrix and inversion results using the interleaved
+    and order_blocked layouts of the Q columns
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+
+    inv_models = {}
+    for layout in ['interleaved', 'order_blocked']:
+        inv_model = minv.MultipoleInversion(
+            TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+            TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+            expansion_limit='quadrupole',
+            sus_functions_module='spherical_harmonics_basis',
+            Q_layout=layout)
+        # Add a second particle, otherwise both layouts are the same
+        inv_model.particle_positions = np.vstack(
+            (inv_model.particle_positions, [[5e-6, 12e-6, -3e-6]]))
+        inv_model.N_particles = 2
+        inv_model.generate_forward_matrix(optimization=optimization)
+        inv_model.compute_inversion(sigma_field_noise=1e-12)
+        inv_models[layout] = inv_model
+
+    inv_i, inv_b = inv_models['interleaved'], inv_models['order_blocked']
+    idx = inv_b.multipole_column_indices()
+    assert np.allclose(inv_b.Q[:, idx.reshape(-1)], inv_i.Q, rtol=1e-12, atol=0.)
+
+    # Results are independent of the layout
+    for attr in ['inv_multipole_moments', 'inv_moments_std', 'covariance_matrix']:
+        ref = getattr(inv_i, attr)
+        assert np.allclose(getattr(inv_b, attr), ref, rtol=1e-6, atol=1e-8 * np.abs(ref).max())
+
+    # Lower order sub-matrices are views of Q in the blocked layout
+    Qdip = inv_b.get_forward_submatrix('dipole')
+    assert np.shares_memory(Qdip, inv_b.Q)
+    assert np.array_equal(Qdip, inv_i.get_forward_submatrix('dipole'))
+    assert np.array_equal(inv_b.get_forward_submatrix('quadrupole'),
+                          inv_b.Q[:, :8 * inv_b.N_particles])
+
+
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_compare_expansion_limits(layout):
+    """
+    Compare the nested inversions from a single QR factorization with the
+    inversions computed independently for every expansion limit
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+
+    def inv_model_fun(limit):
+        inv_model = minv.MultipoleInversion(
+            TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+            TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+            expansion_limit=limit,
+            sus_functions_module='spherical_harmonics_basis',
+            Q_layout=layout)
+        return inv_model
+
+    inv_model = inv_model_fun('octupole')
+    results = inv_model.compare_expansion_limits(sigma_field_noise=1e-9)
+    Q_oct = np.copy(inv_model.Q)
+    assert list(results.keys()) == LIMIT_params
+
+    for limit in LIMIT_params:
+        ref_model = inv_model_fun(limit)
+        ref_model.compute_inversion(method='direct', column_scaling='column')
+        ref = ref_model.inv_multipole_moments
+        mom = results[limit]['inv_multipole_moments']
+        assert mom.shape == ref.shape
+        # Dipole moments are well defined for the single dipole source
+        assert np.allclose(mom[:, :3], ref[:, :3], rtol=1e-5)
+
+        res = np.linalg.norm(ref_model.Bz_array - ref_model.inv_Bz_array)
+        assert abs(results[limit]['residual_norm'] - res) < 1e-6 * np.linalg.norm(ref_model.Bz_array)
+
+    # Residuals cannot increase with the number of parameters, but the
+    # information criteria penalise the extra parameters
+    assert results['quadrupole']['residual_norm'] <= results['dipole']['residual_norm']
+    assert results['dipole']['BIC'] < results['octupole']['BIC']
+
+    # The forward matrix is not modified by the factorization
+    assert np.array_equal(Q_oct, inv_model.Q)
+
+
+@pytest.mark.parametrize("method", ['sp_pinv', 'direct'])
+@pytest.mark.parametrize("limit", LIMIT_params, ids=['dip', 'quad', 'oct'])
+def test_inversion_single_precision(limit, method):
+    """
+    Compare inversions using single and double precision forward matrices
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+
+    inv_models = {}
+    for dtype in ['float64', 'float32']:
+        inv_model = minv.MultipoleInversion(
+            TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+            TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+            expansion_limit=limit,
+            sus_functions_module='spherical_harmonics_basis')
+        inv_model.generate_forward_matrix(dtype=dtype)
+        inv_model.compute_inversion(method=method, sigma_field_noise=1e-12)
+        inv_models[dtype] = inv_model
+
+    inv64, inv32 = inv_models['float64'], inv_models['float32']
+    assert inv32.Q.dtype == np.float32
+    assert inv32.Q.nbytes == inv64.Q.nbytes // 2
+    # Q in SI units
+    assert np.allclose(inv32.Q * inv32.Q_col_scale, inv64.Q, rtol=1e-5,
+                       atol=1e-6 * np.abs(inv64.Q).max())
+
+    # The refinement steps recover the precision of the dipole moments
+    mom64 = inv64.inv_multipole_moments[0][:3]
+    mom32 = inv32.inv_multipole_moments[0][:3]
+    assert np.all(np.abs(mom32 - mom64) < 1e-5 * np.abs(mom64).max())
+
+    if method != 'direct':
+        std64 = inv64.inv_moments_std[0][:3]
+        assert np.allclose(inv32.inv_moments_std[0][:3], std64, rtol=1e-3)
+
+
+@pytest.mark.parametrize("column_scaling", ['column', 'block'])
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_inversion_column_scaling(column_scaling, layout):
+    """
+    Test the inversion using a forward matrix with equilibrated columns
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+
+    inv_models = {}
+    for scaling in [None, column_scaling]:
+        inv_model = minv.MultipoleInversion(
+            TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+            TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+            expansion_limit='octupole',
+            sus_functions_module='spherical_harmonics_basis',
+            Q_layout=layout)
+        inv_model.generate_forward_matrix()
+        inv_models[scaling] = inv_model
+        Q_ref = np.copy(inv_model.Q)
+        inv_model.compute_inversion(sigma_field_noise=1e-12, column_scaling=scaling)
+
+    inv_ref, inv_sc = inv_models[None], inv_models[column_scaling]
+    # The forward matrix is not modified
+    assert np.array_equal(inv_sc.Q, Q_ref)
+    assert inv_sc.Q_col_scale is None
+    Q_scaled = inv_sc.Q / inv_sc.column_scaling_factors
+    if column_scaling == 'column':
+        assert np.allclose(np.linalg.norm(Q_scaled, axis=0), 1.)
+    # Scaling improves the conditioning of the forward matrix
+    assert np.linalg.cond(Q_scaled) < 1e-3 * np.linalg.cond(inv_ref.Q)
+    # The pseudo-inverse is the inverse of the unscaled matrix
+    moments = inv_sc._moments_from_solution(inv_sc.IQ @ inv_sc.Bz_array.reshape(-1))
+    assert np.allclose(moments, inv_sc.inv_multipole_moments, rtol=0.,
+                       atol=1e-10 * np.abs(moments).max())
+
+    mom_ref = inv_ref.inv_multipole_moments[0][:3]
+    assert np.allclose(inv_sc.inv_multipole_moments[0][:3], mom_ref,
+                       rtol=1e-5, atol=1e-5 * np.abs(mom_ref).max())
+    assert np.allclose(inv_sc.inv_moments_std, inv_ref.inv_moments_std, rtol=1e-4)
+    assert np.allclose(np.diag(inv_sc.covariance_matrix), inv_sc.inv_moments_std.reshape(-1) ** 2)
+    # The residual of the scaled system is not larger than the reference
+    res = [np.linalg.norm(inv.inv_Bz_array - inv.Bz_array) for inv in [inv_sc, inv_ref]]
+    assert res[0] <= res[1] * (1 + 1e-6)
+
+
 @pytest.mark.parametrize("limit", ['dipole', 'quadrupole'], ids=['dip', 'quad'])
 def test_inversion_single_dipole_numba_sensor_3D(limit):
 
@@ -417,3 +625,365 @@ if __name__ == '__main__':
 
     test_inversion_single_dipole_with_image_mask_numba('quadrupole')
     # test_inversion_single_dipole_with_field_mask_numba('quadrupole')
+
+
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_forward_derivatives(layout):
+    """
+    Compare the analytic derivatives of Q with respect to the sensor
+    positions with finite differences of the forward matrix
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='octupole',
+        sus_functions_module='spherical_harmonics_basis',
+        Q_layout=layout)
+    inv_model.generate_forward_derivatives()
+    dQ = inv_model.Q_derivatives
+
+    h = 1e-10
+    for a, shift in enumerate(np.eye(3) * h):
+        Q_shifted = []
+        for sign in (1, -1):
+            inv_model._shift_sensors(*(sign * shift))
+            inv_model.generate_forward_matrix(optimization='numba')
+            Q_shifted.append(inv_model.Q.copy())
+            inv_model._shift_sensors(*(-sign * shift))
+        fd = (Q_shifted[0] - Q_shifted[1]) / (2 * h)
+        scale = np.abs(dQ[a]).max(axis=0)
+        assert np.allclose(fd / scale, dQ[a] / scale, rtol=0., atol=1e-6)
+
+
+def test_calibrate_sensor_offsets():
+    """
+    Recover the scan height and sensor origin of the single dipole sample
+    from wrong initial values
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='dipole',
+        sus_functions_module='spherical_harmonics_basis')
+    Hz, x0, y0 = inv_model.Hz, inv_model.sensor_origin_x, inv_model.sensor_origin_y
+    inv_model._shift_sensors(-1e-7, 5e-8, 2e-7)
+
+    result = inv_model.calibrate_sensor_offsets()
+    assert abs(result['Hz'] - Hz) < 1e-12
+    assert abs(result['sensor_origin_x'] - x0) < 1e-12
+    assert abs(result['sensor_origin_y'] - y0) < 1e-12
+    assert np.allclose(result['offset'], [1e-7, -5e-8, -2e-7], rtol=1e-6)
+
+    inv_model.compute_inversion(method='direct')
+    assert np.allclose(inv_model.inv_multipole_moments[0],
+                       1e-13 * np.array([1., 0., 1.]) / np.sqrt(2), rtol=1e-6)
+
+
+@pytest.mark.parametrize("z_only", [False, True])
+def test_refine_particle_positions(z_only):
+    """
+    Recover the position and moment of the single dipole sample from a
+    displaced initial position
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='dipole',
+        sus_functions_module='spherical_harmonics_basis')
+    true_positions = inv_model.particle_positions.copy()
+    shift = np.array([[0., 0., 3e-7]]) if z_only else np.array([[2e-7, -3e-7, 3e-7]])
+    inv_model.particle_positions = true_positions + shift
+
+    result = inv_model.refine_particle_positions(z_only=z_only)
+    assert result['converged']
+    assert np.allclose(inv_model.particle_positions, true_positions, rtol=0., atol=1e-12)
+    assert np.allclose(result['displacement'], -shift, rtol=0., atol=1e-12)
+    assert np.allclose(inv_model.inv_multipole_moments[0],
+                       1e-13 * np.array([1., 0., 1.]) / np.sqrt(2), rtol=1e-6, atol=1e-20)
+    assert np.allclose(inv_model.inv_Bz_array, inv_model.Bz_array, rtol=0.,
+                       atol=1e-8 * np.abs(inv_model.Bz_array).max())
+
+
+@pytest.mark.parametrize("taylor_order", [1, 2])
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_propagate_position_uncertainty(taylor_order, layout):
+    """
+    Compare the Monte Carlo samples with the least squares moments of the
+    expanded and of the exact forward matrices of the displaced particles
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='quadrupole',
+        sus_functions_module='spherical_harmonics_basis',
+        Q_layout=layout)
+    inv_model.generate_forward_matrix(optimization='numba')
+    result = inv_model.propagate_position_uncertainty(5e-8, n_samples=10, seed=42,
+                                                      taylor_order=taylor_order,
+                                                      batch_size=4)
+    assert result['samples'].shape == (10, 1, 8)
+    assert result['quantiles'].shape == (3, 1, 8)
+
+    Bz = inv_model.Bz_array.reshape(-1)
+    Q0 = inv_model.Q.copy()
+    idx = inv_model.multipole_column_indices()
+    for s in range(3):
+        d = result['displacements'][s, 0]
+        Q_taylor = Q0 - np.tensordot(d, inv_model.Q_derivatives, axes=1)
+        if taylor_order == 2:
+            for k, (a, b) in enumerate(minv.fwb.HESSIAN_PAIRS):
+                Q_taylor += (0.5 if a == b else 1.) * d[a] * d[b] * inv_model.Q_second_derivatives[k]
+        inv_model.particle_positions = inv_model.particle_positions + d
+        inv_model.generate_forward_matrix(optimization='numba')
+        Q_exact = inv_model.Q.copy()
+        inv_model.particle_positions = inv_model.particle_positions - d
+
+        for Q, rtol in [(Q_taylor, 1e-9), (Q_exact, 5e-3 if taylor_order == 1 else 3e-5)]:
+            norms = np.linalg.norm(Q, axis=0)
+            moments = np.linalg.lstsq(Q / norms, Bz, rcond=None)[0] / norms
+            assert np.allclose(result['samples'][s, 0], moments[idx[0]], rtol=0.,
+                               atol=rtol * np.abs(moments).max())
+
+
+def test_bootstrap_noise():
+    """
+    Compare the bootstrap deviations of the moments with the analytic
+    covariance, and check the statistics of the correlated noise fields
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='quadrupole',
+        sus_functions_module='spherical_harmonics_basis')
+    inv_model.generate_forward_matrix(optimization='numba')
+    inv_model.compute_inversion(method='np_pinv', sigma_field_noise=1e-6)
+
+    result = inv_model.bootstrap_noise(1e-6, n_samples=2000, seed=42)
+    assert np.allclose(result['std'], inv_model.inv_moments_std, rtol=0.1)
+    assert np.allclose(result['mean'], inv_model.inv_multipole_moments, rtol=0.,
+                       atol=0.1 * inv_model.inv_moments_std.max())
+    # The random streams do not depend on the batches
+    subset = inv_model.bootstrap_noise(1e-6, n_samples=100, seed=42, batch_size=7)
+    assert np.allclose(subset['samples'], result['samples'][:100], rtol=1e-10, atol=0.)
+
+    # Correlated noise: unit variance (also at the edges) and covariance
+    # exp(-d^2 / (2 l^2)) between neighbouring sensors, with d = l / 2
+    rng = np.random.default_rng(42)
+    fields = np.array([inv_model._noise_field(rng, 1., 2e-6) for _ in range(1000)])
+    assert abs(fields.std() - 1.) < 0.02
+    assert abs(fields[:, 0, 0].std() - 1.) < 0.1
+    assert abs(np.mean(fields[:, :, 1:] * fields[:, :, :-1]) - np.exp(-1 / 8)) < 0.02
+
+
+@pytest.mark.parametrize("method", ['huber_irls', 'tukey_irls'])
+def test_robust_inversion(method):
+    """
+    Invert the dipole field with Gaussian noise and strong outlier pixels,
+    which bias the least squares moments
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='quadrupole',
+        sus_functions_module='spherical_harmonics_basis')
+    inv_model.generate_forward_matrix(optimization='numba')
+
+    rng = np.random.default_rng(42)
+    Bz = inv_model.Bz_array.copy()
+    sigma = 0.01 * np.abs(Bz).max()
+    Bz += rng.normal(scale=sigma, size=Bz.shape)
+    outliers = rng.choice(Bz.size, 20, replace=False)
+    Bz.reshape(-1)[outliers] += np.abs(Bz).max() * rng.uniform(1., 2., 20)
+    inv_model.Bz_array = Bz
+    dipole = 1e-13 * np.array([1., 0., 1.]) / np.sqrt(2)
+
+    inv_model.compute_inversion(method='direct')
+    assert not np.allclose(inv_model.inv_multipole_moments[0, :3], dipole, rtol=0., atol=1e-14)
+
+    inv_model.compute_inversion(method=method, sigma_field_noise=float(sigma))
+    std = inv_model.inv_moments_std[0, :3]
+    assert np.all(np.abs(inv_model.inv_multipole_moments[0, :3] - dipole) < 5 * std)
+    assert np.all(inv_model.robust_weights.reshape(-1)[outliers] < 0.05)
+
+    # The solution is the weighted least squares solution with the final weights
+    w = np.sqrt(inv_model.robust_weights.reshape(-1))
+    Q = inv_model.Q * w[:, np.newaxis]
+    norms = np.linalg.norm(Q, axis=0)
+    moments = np.linalg.lstsq(Q / norms, w * Bz.reshape(-1), rcond=None)[0] / norms
+    assert np.allclose(inv_model.inv_multipole_moments[0], moments, rtol=0.,
+                       atol=1e-10 * np.abs(moments).max())
+
+
+def test_weighted_inversion():
+    """
+    Invert the dipole field with a noise map and compare with the weighted
+    least squares solution and covariance of a row scaled forward matrix
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='quadrupole',
+        sus_functions_module='spherical_harmonics_basis')
+    inv_model.generate_forward_matrix(optimization='numba')
+
+    rng = np.random.default_rng(42)
+    Bz = inv_model.Bz_array.copy()
+    sigma = 1e-3 * np.abs(Bz).max() * np.logspace(0, 1, Bz.shape[1])[np.newaxis, :].repeat(Bz.shape[0], axis=0)
+    Bz += rng.normal(size=Bz.shape) * sigma
+    inv_model.Bz_array = Bz
+
+    w = 1 / sigma.reshape(-1)
+    Qw = inv_model.Q * w[:, np.newaxis]
+    moments = np.linalg.lstsq(Qw, w * Bz.reshape(-1), rcond=None)[0]
+    covariance = np.linalg.inv(Qw.T @ Qw)
+
+    Q = inv_model.Q.copy()
+    for method in ['direct', 'np_pinv']:
+        inv_model.compute_inversion(method=method, sigma_field_noise=sigma)
+        assert np.array_equal(inv_model.Q, Q)
+        assert np.allclose(inv_model.inv_multipole_moments[0], moments, rtol=0.,
+                           atol=1e-10 * np.abs(moments).max())
+        assert np.allclose(inv_model.covariance_matrix, covariance, rtol=1e-8)
+        assert np.allclose(inv_model.inv_moments_std[0], np.sqrt(np.diag(covariance)), rtol=1e-8)
+    assert np.allclose(inv_model.IQ, np.linalg.pinv(Qw) * w, rtol=0.,
+                       atol=1e-8 * np.abs(inv_model.IQ).max())
+
+    # A uniform noise map gives the covariance of a scalar noise
+    inv_model.compute_inversion(method='np_pinv', sigma_field_noise=1e-6)
+    covariance = inv_model.covariance_matrix.copy()
+    inv_model.compute_inversion(method='direct', sigma_field_noise=np.full(Bz.shape, 1e-6))
+    assert np.allclose(inv_model.covariance_matrix, covariance, rtol=1e-8)
+
+    # Sensors with infinite noise are ignored, as masked sensors
+    sigma_inf = sigma.copy()
+    sigma_inf[:, :5] = np.inf
+    inv_model.compute_inversion(method='direct', sigma_field_noise=sigma_inf)
+    moments = inv_model.inv_multipole_moments.copy()
+    covariance = inv_model.covariance_matrix.copy()
+    inv_model.generate_field_mask(np.isfinite(sigma_inf))
+    inv_model.compute_inversion(method='direct', sigma_field_noise=sigma, apply_field_mask=True)
+    assert np.allclose(inv_model.inv_multipole_moments, moments, rtol=1e-10)
+
+    # Column scaling and the method options apply to the whitened system
+    inv_model.compute_inversion(method='direct', sigma_field_noise=sigma_inf,
+                                column_scaling='column', lapack_driver='gelsy')
+    assert np.allclose(inv_model.inv_multipole_moments, moments, rtol=1e-8)
+    assert np.allclose(inv_model.covariance_matrix, covariance, rtol=1e-8)
+
+    # An integer noise also gives the covariance
+    inv_model.compute_inversion(method='np_pinv', sigma_field_noise=1)
+    assert inv_model.covariance_matrix is not None
+
+    with pytest.raises(ValueError):
+        inv_model.compute_inversion(method='direct', sigma_field_noise=np.ones(5))
+
+
+def test_weighted_qr():
+    """
+    The triangular factor accumulated over blocks of rows is the factor of
+    the whitened matrix
+    """
+    rng = np.random.default_rng(0)
+    Q = rng.normal(size=(50, 6)).astype(np.float32)
+    rows = np.arange(3, 50)
+    sqrt_weights = rng.uniform(0.5, 2., size=len(rows))
+    b = rng.normal(size=len(rows))
+    R, z = minv._weighted_qr(Q, sqrt_weights, rows, b, max_chunk_size=40)
+    Qw = Q[rows].astype(np.float64) * sqrt_weights[:, np.newaxis]
+    assert np.allclose(np.triu(R), R)
+    assert np.allclose(R.T @ R, Qw.T @ Qw, rtol=1e-12, atol=1e-12)
+    assert np.allclose(np.linalg.solve(R, z), np.linalg.lstsq(Qw, sqrt_weights * b, rcond=None)[0])
+
+    # Fewer rows than columns
+    R, z = minv._weighted_qr(Q, sqrt_weights[:4], rows[:4], b[:4], max_chunk_size=12)
+    assert R.shape == (6, 6) and np.allclose(R[4:], 0.)
+    assert np.allclose(R.T @ R, Qw[:4].T @ Qw[:4], atol=1e-12)
+
+
+@pytest.mark.parametrize("layout", ['interleaved', 'order_blocked'])
+def test_group_lasso_inversion(layout):
+    """
+    Invert the dipole field with grains that carry no remanence: the group
+    lasso only activates the dipole, and the debiased moments are the least
+    squares moments of the active grain
+    """
+    TEST_SAVEDIR = Path('TEST_TMP')
+    fw_model_fun()
+    inv_model = minv.MultipoleInversion(
+        TEST_SAVEDIR / 'MetaDict_fw_model_test_inversion.json',
+        TEST_SAVEDIR / 'MagneticSample_fw_model_test_inversion.npz',
+        expansion_limit='quadrupole',
+        sus_functions_module='spherical_harmonics_basis')
+    inv_model.Q_layout = layout
+    dipole_position = inv_model.particle_positions[0]
+    inv_model.particle_positions = np.array([[4e-6, 4e-6, -3e-6],
+                                             dipole_position,
+                                             [16e-6, 5e-6, -4e-6],
+                                             [5e-6, 15e-6, -3e-6]])
+    inv_model.N_particles = 4
+
+    rng = np.random.default_rng(42)
+    Bz = inv_model.Bz_array.copy()
+    Bz += rng.normal(scale=1e-3 * np.abs(Bz).max(), size=Bz.shape)
+    inv_model.Bz_array = Bz
+
+    inv_model.compute_inversion(method='group_lasso', regularization=0.3, n_path=6)
+    assert np.array_equal(inv_model.active_particles, [False, True, False, False])
+    assert np.all(inv_model.inv_multipole_moments[[0, 2, 3]] == 0.)
+    dipole = 1e-13 * np.array([1., 0., 1.]) / np.sqrt(2)
+    assert np.allclose(inv_model.inv_multipole_moments[1, :3], dipole, rtol=0., atol=1e-15)
+
+    # Least squares with the active grain only
+    columns = inv_model.multipole_column_indices()[1]
+    Q = inv_model.Q[:, columns]
+    norms = np.linalg.norm(Q, axis=0)
+    moments = np.linalg.lstsq(Q / norms, Bz.reshape(-1), rcond=None)[0] / norms
+    assert np.allclose(inv_model.inv_multipole_moments[1], moments, rtol=0.,
+                       atol=1e-10 * np.abs(moments).max())
+
+    # The path starts with no active grains and the penalty shrinks the moments
+    path = inv_model.group_lasso_path
+    assert path['n_active'][0] == 0 and path['n_active'][-1] == 1
+    assert np.all(np.diff(path['regularization']) < 0)
+    assert np.linalg.norm(path['moments'][-1, 1]) < np.linalg.norm(moments)
+
+    # Covariance of the debiased moments of the active grain, and a uniform
+    # noise map gives the same solution
+    sigma = 1e-3 * np.abs(Bz).max()
+    inv_model.compute_inversion(method='group_lasso', regularization=0.3, n_path=6,
+                                sigma_field_noise=sigma)
+    covariance = sigma ** 2 * np.linalg.inv(Q.T @ Q)
+    std = inv_model.inv_moments_std
+    assert np.allclose(std[1], np.sqrt(np.diag(covariance)), rtol=1e-8)
+    assert np.all(std[[0, 2, 3]] == 0.)
+    inv_model.compute_inversion(method='group_lasso', regularization=0.3, n_path=6,
+                                sigma_field_noise=np.full(Bz.shape, sigma))
+    assert np.allclose(inv_model.inv_multipole_moments[1], moments, rtol=0.,
+                       atol=1e-10 * np.abs(moments).max())
+    assert np.allclose(inv_model.inv_moments_std, std, rtol=1e-8)
+
+    with pytest.raises(ValueError):
+        inv_model.compute_inversion(method='group_lasso', sigma_field_noise=sigma, debias=False)
+
+    # The block scaling of the penalty selects the same grain
+    inv_model.compute_inversion(method='group_lasso', regularization=0.3, n_path=6,
+                                column_scaling='block')
+    assert np.array_equal(inv_model.active_particles, [False, True, False, False])
+
+    # Without the penalty all the grains are active
+    inv_model.compute_inversion(method='group_lasso', regularization=[1e-8], debias=False)
+    assert np.all(inv_model.active_particles)
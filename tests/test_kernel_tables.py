@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from test_forward_backends import _inversion_model
+from test_forward_operators import _random_particles
+
+
+@pytest.mark.parametrize("sus_module,sensor_dims,limit",
+                         [('spherical_harmonics_basis_area', (0.5e-6, 0.5e-6), 'quadrupole'),
+                          ('spherical_harmonics_basis_volume', (0.3e-6, 0.5e-6, 0.2e-6), 'octupole')],
+                         ids=['area', 'volume'])
+def test_kernel_table(sus_module, sensor_dims, limit):
+    """
+    Compare the forward matrix interpolated from a kernel table with the
+    numba forward matrix, and save and load the table
+    """
+    inv_model = _inversion_model(limit=limit, sus_module=sus_module)
+    inv_model.sensor_dims = sensor_dims
+    _random_particles(inv_model, N=10)
+    inv_model.Q_layout = 'order_blocked'
+
+    inv_model.generate_forward_matrix(optimization='numba')
+    Q_numba = np.copy(inv_model.Q)
+
+    inv_model.generate_kernel_table(tol=1e-5, filename=Path('TEST_TMP') / 'kernel_table.npz')
+    table = inv_model.kernel_table
+    assert table.max_rel_error <= 1e-5
+    inv_model.generate_forward_matrix(optimization='table')
+    assert inv_model.forward_backend == 'table'
+    # The error is relative to the largest entry of every multipole order
+    assert np.allclose(inv_model.Q, Q_numba, rtol=0., atol=1e-5 * np.abs(Q_numba).max())
+    # The automatic dispatch does not use the table
+    inv_model.generate_forward_matrix(optimization='auto')
+    assert inv_model.forward_backend != 'table'
+
+    inv_model.kernel_table = None
+    inv_model.load_kernel_table(Path('TEST_TMP') / 'kernel_table.npz')
+    assert inv_model.kernel_table.max_rel_error == table.max_rel_error
+    assert np.array_equal(inv_model.kernel_table.values, table.values)
+
+    # Particles deeper than the tabulated range
+    inv_model.particle_positions[0, 2] = -10e-6
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='table')
+
+    # A table for another multipole order is not accepted
+    inv_model.particle_positions[0, 2] = -3e-6
+    inv_model.expansion_limit = 'dipole'
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='table')
+
+
+def test_kernel_table_point_sensors():
+    """
+    Point sensors are not tabulated, since the kernels are cheaper to
+    evaluate than to interpolate
+    """
+    inv_model = _inversion_model(limit='octupole')
+    with pytest.raises(ValueError):
+        inv_model.generate_kernel_table(tol=1e-5)
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='table')
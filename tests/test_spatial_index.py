@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from test_forward_backends import _inversion_model
+from test_forward_operators import _random_particles
+
+
+def test_spatial_index_queries():
+    """
+    Compare the queries of the spatial index with brute force calculations
+    """
+    inv_model = _inversion_model()
+    _random_particles(inv_model, N=40)
+    index = inv_model.spatial_index
+    # The index is reused while the geometry does not change
+    assert inv_model.spatial_index is index
+
+    particles = inv_model.particle_positions
+    sensors = inv_model.scan_positions
+    dist = np.linalg.norm(particles[:, np.newaxis] - sensors[np.newaxis], axis=2)
+
+    radius = 5e-6
+    for p, s in enumerate(index.sensors_within(radius)):
+        assert np.array_equal(s, np.where(dist[p] <= radius)[0])
+
+    s_pairs, p_pairs = index.sensor_particle_pairs(radius)
+    assert np.all(np.diff(p_pairs) >= 0)
+    assert np.array_equal(np.sort(s_pairs * len(particles) + p_pairs),
+                          np.sort(np.where((dist <= radius).T.reshape(-1))[0]))
+
+    tile = index.particles_in_tile((5e-6, 12e-6), (3e-6, 9e-6))
+    inside = np.where((particles[:, 0] >= 5e-6) & (particles[:, 0] <= 12e-6)
+                      & (particles[:, 1] >= 3e-6) & (particles[:, 1] <= 9e-6))[0]
+    assert np.array_equal(tile, inside)
+
+    pdist = np.linalg.norm(particles[:, np.newaxis] - particles[np.newaxis], axis=2)
+    np.fill_diagonal(pdist, np.inf)
+    distances, neighbours = index.nearest_particles(3)
+    assert np.array_equal(neighbours, np.argsort(pdist, axis=1)[:, :3])
+    assert np.allclose(distances, np.sort(pdist, axis=1)[:, :3])
+
+    # A new geometry rebuilds the index
+    inv_model.particle_positions = particles[:10]
+    assert inv_model.spatial_index is not index
+
+
+def test_forward_matrix_cutoff():
+    """
+    Check the forward matrix computed with a cut-off radius and the
+    proximity mask
+    """
+    inv_model = _inversion_model()
+    _random_particles(inv_model, N=10)
+    inv_model.generate_forward_matrix(optimization='numba')
+    Q_full = np.copy(inv_model.Q)
+
+    radius = 6e-6
+    inv_model.generate_forward_matrix(cutoff_radius=radius)
+    assert inv_model.forward_backend == 'numba'
+
+    dist = np.linalg.norm(inv_model.particle_positions[:, np.newaxis]
+                          - inv_model.scan_positions[np.newaxis], axis=2)
+    near = np.repeat(dist.T <= radius, inv_model._N_cols, axis=1)
+    assert np.allclose(inv_model.Q[near], Q_full[near], rtol=1e-12, atol=0)
+    assert np.all(inv_model.Q[~near] == 0.)
+
+    with pytest.raises(ValueError):
+        inv_model.generate_forward_matrix(optimization='numba_lattice', cutoff_radius=radius)
+
+    inv_model.generate_proximity_mask(radius, particles=[0])
+    assert np.array_equal(inv_model.fieldMask.reshape(-1), dist[0] <= radius)
@@ -0,0 +1,72 @@
+import numpy as np
+from mmt_multipole_inversion.streaming_inversion import StreamingInversion
+import pytest
+from test_forward_backends import _inversion_model
+
+
+def _least_squares(Q, Bz):
+    norms = np.linalg.norm(Q, axis=0)
+    return np.linalg.lstsq(Q / norms, Bz, rcond=None)[0] / norms
+
+
+def test_streaming_inversion():
+    """
+    Ingest the noisy scan of the single dipole sample in blocks of rows and
+    compare the moments and covariance with the inversions of the rows
+    scanned so far
+    """
+    inv_model = _inversion_model(limit='octupole')
+    rng = np.random.default_rng(42)
+    sigma = 1e-3 * np.abs(inv_model.Bz_array).max()
+    Bz = inv_model.Bz_array + rng.normal(scale=sigma, size=inv_model.Bz_array.shape)
+    inv_model.generate_forward_matrix(optimization='numba')
+    Q = inv_model.Q
+
+    stream = StreamingInversion(inv_model, sigma_field_noise=sigma)
+    Nx = inv_model.Nx_surf
+    for rows in [slice(0, 5), slice(5, 6), slice(6, 13), slice(13, 20)]:
+        stream.add_scan_rows(Bz[rows])
+        sensors = slice(0, rows.stop * Nx)
+        moments = _least_squares(Q[sensors], Bz.reshape(-1)[sensors])
+        assert np.allclose(stream.inv_multipole_moments.reshape(-1), moments, rtol=0.,
+                           atol=1e-10 * np.abs(moments).max())
+        residual = Bz.reshape(-1)[sensors] - Q[sensors] @ moments
+        assert np.isclose(stream.residual_norm, np.linalg.norm(residual), rtol=1e-8)
+    assert stream.n_sensors == inv_model.N_sensors
+
+    norms = np.linalg.norm(Q, axis=0)
+    covariance = sigma ** 2 * np.linalg.inv((Q / norms).T @ (Q / norms)) / np.outer(norms, norms)
+    std = np.sqrt(np.diag(covariance))
+    assert np.allclose(stream.covariance_matrix / np.outer(std, std),
+                       covariance / np.outer(std, std), rtol=0., atol=1e-10)
+    assert np.allclose(stream.inv_moments_std.reshape(-1), std, rtol=1e-10)
+
+    # Rows out of the grid
+    with pytest.raises(ValueError):
+        stream.add_scan_rows(Bz[:2], first_row=19)
+
+    # Rows that were already ingested are rejected, and the results are kept
+    with pytest.raises(ValueError):
+        stream.add_scan_rows(Bz[3:5], first_row=3)
+    assert stream.n_sensors == inv_model.N_sensors
+    assert np.allclose(stream.inv_moments_std.reshape(-1), std, rtol=1e-10)
+
+
+def test_streaming_inversion_mask():
+    """
+    Masked sensors are not ingested, and rows can arrive in any order
+    """
+    inv_model = _inversion_model(limit='quadrupole')
+    mask = np.ones(inv_model.Bz_array.shape, dtype=bool)
+    mask[8:12, 8:12] = False
+    inv_model.generate_field_mask(mask)
+    inv_model.compute_inversion(method='direct', apply_field_mask=True)
+
+    stream = StreamingInversion(inv_model, apply_field_mask=True)
+    for first_row in [10, 0, 15]:
+        stream.add_scan_rows(inv_model.Bz_array[first_row:first_row + 5], first_row=first_row)
+    stream.add_scan_rows(inv_model.Bz_array[5:10], first_row=5)
+    assert stream.n_sensors == mask.sum()
+    assert stream.covariance_matrix is None
+    assert np.allclose(stream.inv_multipole_moments, inv_model.inv_multipole_moments,
+                       rtol=1e-6, atol=1e-10 * np.abs(inv_model.inv_multipole_moments).max())